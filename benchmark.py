@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmarks for backy2. These use the null io (null://SIZE) and
+the null data backend, so no disk or network is involved and the numbers
+show the CPU-bound parts (hashing etc.) only.
+
+Usage:
+    ./benchmark.py hash [--size 4G] [--workers 1,2,4,8]
+    ./benchmark.py hashes [--size 4G] [--workers 1,2,4,8]
+    ./benchmark.py crypt [--size 4G] [--workers 1,2,4,8]
+    ./benchmark.py pipeline [--sizes 1G,4G,16G] [--workers 4]
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from backy2.config import Config as _Config
+from backy2.hashing import HASH_FUNCTIONS
+from backy2.hashing import HashPool
+from backy2.logging import init_logging
+from backy2.utils import backy_from_config
+from backy2.utils import humanize
+from backy2.utils import generate_block
+from functools import partial
+import hashlib
+import logging
+
+kB = 1024
+MB = kB * 1024
+GB = MB * 1024
+
+BLOCK_SIZE = 4*MB
+
+CONFIG = """
+[DEFAULTS]
+logfile: {testpath}/backy.log
+block_size: {block_size}
+hash_function: sha512
+lock_dir: {testpath}
+process_name: backy2-benchmark
+deduplication: 0
+hash_workers: {workers}
+
+[MetaBackend]
+type: backy2.meta_backends.sql
+engine: sqlite:///{testpath}/backy.sqlite
+
+[DataBackend]
+type: backy2.data_backends.null
+simultaneous_writes: {workers}
+simultaneous_reads: {workers}
+{data_backend_extra}
+
+[io_null]
+simultaneous_reads: {workers}
+simultaneous_writes: 1
+"""
+
+
+def parse_size(size):
+    units = {'k': kB, 'M': MB, 'G': GB}
+    if size[-1] in units:
+        return int(size[:-1]) * units[size[-1]]
+    return int(size)
+
+
+def report(name, workers, size, dt, base=None):
+    throughput = size / dt / MB
+    print('{:<16} workers {:>3}: {:>9.1f} MB/s  {:>6.2f}s{}'.format(
+        name,
+        workers,
+        throughput,
+        dt,
+        '  x{:.2f}'.format(base / dt) if base else '',
+        ))
+    return dt
+
+
+def bench_hash_pool(size, workers, hash_function=hashlib.sha512):
+    """ Pure HashPool throughput, without any io """
+    num_blocks = size // BLOCK_SIZE
+    data = [generate_block(i, BLOCK_SIZE) for i in range(min(num_blocks, 16))]
+    hash_pool = HashPool(hash_function, workers)
+    t1 = time.time()
+    for i in range(num_blocks):
+        hash_pool.submit(data[i % len(data)], i)
+        for result in hash_pool.finished():
+            pass
+    for result in hash_pool.drain():
+        pass
+    t2 = time.time()
+    hash_pool.close()
+    return t2 - t1
+
+
+def bench_backy(size, workers, data_backend_extra=''):
+    """ backup, scrub and restore of null://size to the null data backend """
+    testpath = tempfile.mkdtemp(prefix='backy2-benchmark-')
+    try:
+        Config = partial(_Config, cfg=CONFIG.format(
+            testpath=testpath,
+            block_size=BLOCK_SIZE,
+            workers=workers,
+            data_backend_extra=data_backend_extra,
+            ))
+        # backy instances can't be reused after a backup, so each operation
+        # gets its own.
+        backy = backy_from_config(Config)(initdb=True)
+        t1 = time.time()
+        version_uid = backy.backup('benchmark', 'benchmark', 'null://{}'.format(size), None, None)
+        t2 = time.time()
+        backy.close()
+        backy = backy_from_config(Config)()
+        t3 = time.time()
+        assert backy.scrub(version_uid) == True
+        t4 = time.time()
+        backy.close()
+        backy = backy_from_config(Config)()
+        t5 = time.time()
+        backy.restore(version_uid, 'null://')
+        t6 = time.time()
+        backy.close()
+        return t2 - t1, t4 - t3, t6 - t5
+    finally:
+        shutil.rmtree(testpath)
+
+
+def bench_pipeline(size, workers):
+    """ Duration, time to first block and peak memory usage of a backup of
+    null://size. Run this in a fresh process, as the peak memory usage is
+    per process.
+    """
+    testpath = tempfile.mkdtemp(prefix='backy2-benchmark-')
+    try:
+        Config = partial(_Config, cfg=CONFIG.format(
+            testpath=testpath,
+            block_size=BLOCK_SIZE,
+            workers=workers,
+            data_backend_extra='',
+            ))
+        backy = backy_from_config(Config)(initdb=True)
+        t1 = time.time()
+        backy.backup('benchmark', 'benchmark', 'null://{}'.format(size), None, None)
+        t2 = time.time()
+        stats = backy.last_backup_stats
+        backy.close()
+        return t2 - t1, stats['time_to_first_block'], stats['peak_rss_bytes']
+    finally:
+        shutil.rmtree(testpath)
+
+
+def bench_encode(size, workers, data_backend_extra=''):
+    """ Throughput of the data backend's encoding (compression, encryption)
+    and decoding in parallel threads
+    """
+    from backy2.data_backends.null import DataBackend
+    Config = partial(_Config, cfg=CONFIG.format(
+        testpath=tempfile.gettempdir(),
+        block_size=BLOCK_SIZE,
+        workers=1,
+        data_backend_extra=data_backend_extra,
+        ))
+    data_backend = DataBackend(Config(section='DataBackend'))
+    num_blocks = size // BLOCK_SIZE
+    data = generate_block(0, BLOCK_SIZE)
+    uid = data_backend._uid()
+    encoded = data_backend._encode(uid, data)
+
+    def run(f, *args):
+        threads = [threading.Thread(target=lambda: [f(*args) for i in range(num_blocks // workers)]) for i in range(workers)]
+        t1 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - t1
+
+    dt_encode = run(data_backend._encode, uid, data)
+    dt_decode = run(data_backend._decode, uid, encoded)
+    data_backend.close()
+    return dt_encode, dt_decode
+
+
+def hash(args):
+    size = parse_size(args.size)
+    base = {}
+    for workers in args.workers:
+        dt = bench_hash_pool(size, workers)
+        base.setdefault('hashpool', dt)
+        report('hashpool', workers, size, dt, base['hashpool'])
+    for workers in args.workers:
+        for name, dt in zip(('backup', 'scrub', 'restore'), bench_backy(size, workers)):
+            base.setdefault(name, dt)
+            report(name, workers, size, dt, base[name])
+
+
+def hashes(args):
+    size = parse_size(args.size)
+    for name, hash_function in sorted(HASH_FUNCTIONS.items()):
+        base = None
+        for workers in args.workers:
+            dt = bench_hash_pool(size, workers, hash_function)
+            base = base or dt
+            report(name, workers, size, dt, base)
+
+
+def crypt(args):
+    size = parse_size(args.size)
+    keys = 'encryption_keys: 1:{}\nencryption_key_id: 1\n'.format('00' * 32)
+    modes = (
+        ('none', ''),
+        ('aes', 'encryption: aes-256-gcm\n' + keys),
+        ('chacha', 'encryption: chacha20-poly1305\n' + keys),
+        ('zstd+aes', 'compression: zstd\nencryption: aes-256-gcm\n' + keys),
+    )
+    for workers in args.workers:
+        base = None
+        for mode, data_backend_extra in modes:
+            dt_encode, dt_decode = bench_encode(size, workers, data_backend_extra)
+            report('encode {}'.format(mode), workers, size, dt_encode)
+            report('decode {}'.format(mode), workers, size, dt_decode)
+            # relative to backups without encoding
+            dt_backup = bench_backy(size, workers, data_backend_extra)[0]
+            base = base or dt_backup
+            report('backup {}'.format(mode), workers, size, dt_backup, base)
+
+
+def pipeline(args):
+    for size in args.sizes:
+        with multiprocessing.Pool(1) as pool:
+            dt, dt_first_block, rss = pool.apply(bench_pipeline, (parse_size(size), args.workers))
+        report('backup {}'.format(size), args.workers, parse_size(size), dt)
+        print('{:<16}              first block after {:.2f}s, peak memory usage {}'.format(
+            '', dt_first_block, humanize(rss)))
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    default_workers = ','.join(str(2**i) for i in range(cpus.bit_length()) if 2**i <= cpus)
+
+    parser = argparse.ArgumentParser(description='backy2 benchmarks')
+    subparsers = parser.add_subparsers(title='Commands')
+
+    p = subparsers.add_parser('hash', help='Hashing throughput per number of workers')
+    p.add_argument('--size', default='4G', help='Amount of data, e.g. 4G (default: %(default)s)')
+    p.add_argument('--workers', default=default_workers,
+        type=lambda s: [int(w) for w in s.split(',')],
+        help='Comma separated list of worker counts (default: %(default)s)')
+    p.set_defaults(func=hash)
+
+    p = subparsers.add_parser('hashes', help='Throughput of all available hash functions')
+    p.add_argument('--size', default='4G', help='Amount of data, e.g. 4G (default: %(default)s)')
+    p.add_argument('--workers', default=default_workers,
+        type=lambda s: [int(w) for w in s.split(',')],
+        help='Comma separated list of worker counts (default: %(default)s)')
+    p.set_defaults(func=hashes)
+
+    p = subparsers.add_parser('crypt', help='Throughput with and without encryption of blobs')
+    p.add_argument('--size', default='4G', help='Amount of data, e.g. 4G (default: %(default)s)')
+    p.add_argument('--workers', default=default_workers,
+        type=lambda s: [int(w) for w in s.split(',')],
+        help='Comma separated list of worker counts (default: %(default)s)')
+    p.set_defaults(func=crypt)
+
+    p = subparsers.add_parser('pipeline', help='Time to first block and peak memory usage of backups by size')
+    p.add_argument('--sizes', default='1G,4G,16G', type=lambda s: s.split(','),
+        help='Comma separated list of sizes (default: %(default)s)')
+    p.add_argument('--workers', default=min(cpus, 4), type=int, help='Number of workers (default: %(default)s)')
+    p.set_defaults(func=pipeline)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_usage()
+        return
+    init_logging(os.path.join(tempfile.gettempdir(), 'backy2-benchmark.log'), logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,30 @@
 # -*- encoding: utf-8 -*-
 
 from backy2 import notify
+from backy2.data_backends import packed_location
+from backy2.dedup import DedupIndex
+from backy2.hashing import DEFAULT_HASH_FUNCTION
+from backy2.hashing import HashPool
+from backy2.hashing import MIN_CHECKSUM_LENGTH
+from backy2.hashing import get_hash_function
+from backy2.hashing import is_zero
+from backy2.hashing import zeroes
 from backy2.logging import logger
 from backy2.locking import Locking
 from backy2.locking import find_other_procs
 from backy2.utils import grouper
 from backy2.utils import status
 from backy2.utils import MinSequential
+from backy2.utils import RangeSet
+from backy2.utils import humanize
+from backy2.utils import peak_rss
+from backy2.utils import sorted_difference
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta
 from urllib import parse
 import datetime
 import importlib
+import itertools
 import math
 import queue
 import random
@@ -18,14 +32,22 @@ import time
 import sys
 
 
-def blocks_from_hints(hints, block_size):
-    """ Helper method """
-    blocks = set()
+def block_ranges_from_hints(hints, block_size, max_offset=None):
+    """ Yields (start_block, end_block, exists) for each hint, end_block
+    being exclusive. hints may be any iterable, e.g. a generator streaming
+    extents from the io. Raises ValueError if a hint ends after max_offset.
+    """
     for offset, length, exists in hints:
-        start_block = math.floor(offset / block_size)
-        end_block = math.ceil((offset + length) / block_size)
-        for i in range(start_block, end_block):
-            blocks.add(i)
+        if max_offset is not None and offset + length > max_offset:
+            raise ValueError('Hints have higher offsets than source file.')
+        yield offset // block_size, -(-(offset + length) // block_size), exists
+
+
+def blocks_from_hints(hints, block_size):
+    """ Returns the block ids covered by hints as a RangeSet """
+    blocks = RangeSet()
+    for start_block, end_block, exists in block_ranges_from_hints(hints, block_size):
+        blocks.add(start_block, end_block)
     return blocks
 
 
@@ -40,24 +62,35 @@ class Backy():
     """
     """
 
+    CLEANUP_RM_MANY_SIZE = 10000  # uids per data_backend.rm_many call during cleanup
+
     def __init__(self, meta_backend, data_backend, config, block_size=None,
             hash_function=None, lock_dir=None, process_name='backy2',
-            initdb=False, dedup=True):
+            initdb=False, dedup=True, dedup_index=False, checksum_length=None,
+            hash_workers=None, pipeline_window=None, dedup_index_entries=0):
         if block_size is None:
             block_size = 1024*4096  # 4MB
         if hash_function is None:
-            import hashlib
-            hash_function = hashlib.sha512
+            hash_function = DEFAULT_HASH_FUNCTION
+        get_hash_function(hash_function)  # raise early if unsupported
+        if checksum_length and checksum_length < MIN_CHECKSUM_LENGTH:
+            raise ValueError('checksum_length must be 0 (the full digest) or at least {} bytes.'.format(MIN_CHECKSUM_LENGTH))
         if initdb:
             meta_backend.initdb()
         self.meta_backend = meta_backend.open()
         self.data_backend = data_backend
         self.config = config
         self.block_size = block_size
-        self.hash_function = hash_function
+        self.hash_function = hash_function  # name of the hash function for new versions
+        self.checksum_length = checksum_length or None  # store only this many bytes of the digest (None: all)
+        self.hash_workers = hash_workers or None  # None: one per cpu
+        self.pipeline_window = pipeline_window or 1000  # read jobs in flight during backup
+        self.last_backup_stats = None
         self.locking = Locking(lock_dir)
         self.process_name = process_name
         self.dedup = dedup
+        self.dedup_index = dedup_index
+        self.dedup_index_entries = dedup_index_entries  # checksums mapped in memory (0: all)
 
         notify(process_name)  # i.e. set process name without notification
 
@@ -82,7 +115,12 @@ class Backy():
         return stats
 
 
-    def get_io_by_source(self, source):
+    def get_io_by_source(self, source, hash_function=None, hash_pool=None):
+        """ Returns an io for source. hash_function is the name of the hash
+        function used for checksums of read blocks (default: the configured
+        one). With a hash_pool (of the same hash function), the checksums
+        are computed by its workers.
+        """
         res = parse.urlparse(source)
         if res.params or res.query or res.fragment:
             raise ValueError('Invalid URL.')
@@ -93,11 +131,13 @@ class Backy():
         # and pass config section io_<scheme>
         IOLib = importlib.import_module('backy2.io.{}'.format(scheme))
         config = self.config(section='io_{}'.format(scheme))
-        return IOLib.IO(
+        io = IOLib.IO(
                 config=config,
                 block_size=self.block_size,
-                hash_function=self.hash_function,
+                hash_function=get_hash_function(hash_function or self.hash_function),
                 )
+        io.hash_pool = hash_pool
+        return io
 
 
     def du(self, version_uid):
@@ -134,7 +174,7 @@ class Backy():
             return
 
         if source:
-            io = self.get_io_by_source(source)
+            io = self.get_io_by_source(source, version.hash_function)
             io.open_r(source)
 
         state = True
@@ -159,7 +199,48 @@ class Backy():
                     block.uid,
                     ))
 
+        def verify(block, data, data_checksum):
+            """ Checks a scrubbed block's checksum and (if data is given)
+            compares it with the source. Returns False on errors.
+            """
+            if data_checksum[:len(block.checksum)] != block.checksum:
+                logger.error('Checksum mismatch during scrub for block '
+                    '{} (UID {}) (is: {} should-be: {}).'.format(
+                        block.id,
+                        block.uid,
+                        data_checksum.hex(),
+                        block.checksum.hex(),
+                        ))
+                self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+                return False
+
+            if data is not None:
+                source_data = io.read(block.id, sync=True)  # TODO: This is still sync, but how could we do better (easily)?
+                stats['source_blocks_read'] += 1
+                stats['source_bytes_read'] += len(source_data)
+                if source_data != data:
+                    logger.error('Source data has changed for block {} '
+                        '(UID {}) (is: {} should-be: {}). NOT setting '
+                        'this block invalid, because the source looks '
+                        'wrong.'.format(
+                            block.id,
+                            block.uid,
+                            hash_function(source_data).hexdigest(),
+                            data_checksum.hex(),
+                            ))
+                    # We are not setting the block invalid here because
+                    # when the block is there AND the checksum is good,
+                    # then the source is invalid.
+                    return False
+            logger.debug('Scrub of block {} (UID {}) ok.'.format(
+                block.id,
+                block.uid,
+                ))
+            return True
+
         # and read
+        hash_function = get_hash_function(version.hash_function)
+        hash_pool = HashPool(hash_function, self.hash_workers)
         _log_every_jobs = read_jobs // 200 + 1  # about every half percent
         _log_jobs_counter = 0
         t1 = time.time()
@@ -196,48 +277,18 @@ class Backy():
                 self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
                 state = False
                 continue
-            data_checksum = self.hash_function(data).hexdigest()
-            if data_checksum != block.checksum:
-                logger.error('Checksum mismatch during scrub for block '
-                    '{} (UID {}) (is: {} should-be: {}).'.format(
-                        block.id,
-                        block.uid,
-                        data_checksum,
-                        block.checksum,
-                        ))
-                self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
-                state = False
-                continue
-
-            if source:
-                source_data = io.read(block.id, sync=True)  # TODO: This is still sync, but how could we do better (easily)?
-                stats['source_blocks_read'] += 1
-                stats['source_bytes_read'] += len(source_data)
-                if source_data != data:
-                    logger.error('Source data has changed for block {} '
-                        '(UID {}) (is: {} should-be: {}). NOT setting '
-                        'this block invalid, because the source looks '
-                        'wrong.'.format(
-                            block.id,
-                            block.uid,
-                            self.hash_function(source_data).hexdigest(),
-                            data_checksum,
-                            ))
-                    state = False
-                    # We are not setting the block invalid here because
-                    # when the block is there AND the checksum is good,
-                    # then the source is invalid.
-            logger.debug('Scrub of block {} (UID {}) ok.'.format(
-                block.id,
-                block.uid,
-                ))
+            # hashing is done in the pool, the data is only needed again
+            # for comparing with the source.
+            hash_pool.submit(data, (block, data if source else None))
+            for (_block, _data), data_checksum in hash_pool.finished():
+                state = verify(_block, _data, data_checksum) and state
 
             if time.time() - t_last_run >= 1:
                 # TODO: Log source io status
                 t_last_run = time.time()
                 t2 = time.time()
                 dt = t2-t1
-                logger.debug(self.data_backend.thread_status())
+                logger.debug(self.data_backend.thread_status() + " " + hash_pool.thread_status())
 
                 db_queue_status = self.data_backend.queue_status()
                 _status = status(
@@ -253,6 +304,10 @@ class Backy():
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
 
+        for (block, data), data_checksum in hash_pool.drain():
+            state = verify(block, data, data_checksum) and state
+        hash_pool.close()
+
         if state == True:
             self.meta_backend.set_version_valid(version_uid)
             logger.info('Marked version valid: {}'.format(version_uid))
@@ -308,7 +363,7 @@ class Backy():
                 self.data_backend.read(block.deref())  # adds a read job
                 read_jobs += 1
             elif not sparse:
-                io.write(block, b'\0'*block.size)
+                io.write(block, zeroes(block.size))
                 stats['blocks_written'] += 1
                 stats['bytes_written'] += block.size
                 stats['blocks_throughput'] += 1
@@ -360,6 +415,25 @@ class Backy():
         t1 = time.time()
         t_last_run = 0
         min_sequential_block_id = MinSequential(continue_from)  # for finding the minimum block-ID until which we have restored ALL blocks
+
+        def verify(block, data_checksum):
+            if data_checksum[:len(block.checksum)] != block.checksum:
+                logger.error('Checksum mismatch during restore for block '
+                    '{} (is: {} should-be: {}, block-valid: {}). Block '
+                    'restored is invalid. Continuing.'.format(
+                        block.id,
+                        data_checksum.hex(),
+                        block.checksum.hex(),
+                        block.valid,
+                        ))
+                self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+            else:
+                logger.debug('Restored block {} successfully ({} bytes).'.format(
+                    block.id,
+                    block.size,
+                    ))
+
+        hash_pool = HashPool(get_hash_function(version.hash_function), self.hash_workers)
         for i in range(read_jobs):
             _log_jobs_counter -= 1
             try:
@@ -378,7 +452,6 @@ class Backy():
             stats['blocks_read'] += 1
             stats['bytes_read'] += block.size
 
-            data_checksum = self.hash_function(data).hexdigest()
             def callback(local_block_id):
                 def f():
                     min_sequential_block_id.put(local_block_id)
@@ -388,28 +461,15 @@ class Backy():
                     stats['bytes_throughput'] += block.size
                 return f
             io.write(block, data, callback(block.id))
-
-            if data_checksum != block.checksum:
-                logger.error('Checksum mismatch during restore for block '
-                    '{} (is: {} should-be: {}, block-valid: {}). Block '
-                    'restored is invalid. Continuing.'.format(
-                        block.id,
-                        data_checksum,
-                        block.checksum,
-                        block.valid,
-                        ))
-                self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
-            else:
-                logger.debug('Restored block {} successfully ({} bytes).'.format(
-                    block.id,
-                    block.size,
-                    ))
+            hash_pool.submit(data, block)  # verified when the checksum is ready
+            for _block, data_checksum in hash_pool.finished():
+                verify(_block, data_checksum)
 
             if time.time() - t_last_run >= 1:
                 t_last_run = time.time()
                 t2 = time.time()
                 dt = t2-t1
-                logger.debug(io.thread_status() + " " + self.data_backend.thread_status())
+                logger.debug(io.thread_status() + " " + self.data_backend.thread_status() + " " + hash_pool.thread_status())
 
                 io_queue_status = io.queue_status()
                 db_queue_status = self.data_backend.queue_status()
@@ -427,6 +487,9 @@ class Backy():
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
 
+        for block, data_checksum in hash_pool.drain():
+            verify(block, data_checksum)
+        hash_pool.close()
 
         self.locking.unlock(version_uid)
         io.close()
@@ -580,11 +643,14 @@ class Backy():
         return tags
 
 
-    def backup(self, name, snapshot_name, source, hints, from_version, tag=None, expire=None, continue_version=None):
+    def backup(self, name, snapshot_name, source, hints, from_version, tag=None, expire=None, continue_version=None, diff_from_snapshot=None):
         """ Create a backup from source.
         If hints are given, they must be tuples of (offset, length, exists)
         where offset and length are integers and exists is a boolean. Then, only
         data within hints will be backed up.
+        If diff_from_snapshot is given, the hints are computed by the io (rbd
+        only) as the changes since this snapshot. An empty string means the
+        allocated regions of the whole image.
         Otherwise, the backup reads source and looks if checksums match with
         the target.
         If continue_version is given, this version will be continued, i.e.
@@ -607,29 +673,50 @@ class Backy():
                 'blocks_throughput': 0,
                 'start_time': time.time(),
             }
-        io = self.get_io_by_source(source)
+
+        # Versions based on other versions share their checksums, so they must
+        # use the same hash function.
+        hash_function = self.hash_function
+        base_version_uid = continue_version or from_version
+        if base_version_uid:
+            hash_function = self.meta_backend.get_version(base_version_uid).hash_function  # raise if not exists
+            if hash_function != self.hash_function:
+                logger.info('Using hash function {} of version {} instead of {}. The configured hash function '
+                    'will be used with the next backup which is not based on another version.'.format(
+                        hash_function,
+                        base_version_uid,
+                        self.hash_function,
+                        ))
+
+        # The io readers wait for the hash workers, so hashing uses
+        # hash_workers cores independent of the number of readers.
+        hash_pool = HashPool(get_hash_function(hash_function), self.hash_workers)
+        io = self.get_io_by_source(source, hash_function, hash_pool)
         io.open_r(source)
         source_size = io.size()
+        if diff_from_snapshot is not None:
+            if hints is not None:
+                raise ValueError('Either give hints or diff_from_snapshot, not both.')
+            hints = io.changed_extents(diff_from_snapshot or None)
 
         size = math.ceil(source_size / self.block_size)
         stats['version_size_bytes'] = source_size
         stats['version_size_blocks'] = size
 
-        # Sanity check: check hints for validity, i.e. too high offsets, ...
-        if hints is not None and len(hints) > 0:
-            max_offset = max([h[0]+h[1] for h in hints])
-            if max_offset > source_size:
-                raise ValueError('Hints have higher offsets than source file.')
-
-        # Find out which blocks to read
+        # Find out which blocks to read. hints are consumed in a single pass
+        # as they may be streamed from the io. All block id sets are
+        # RangeSets, so their size depends on the number of extents only.
+        num_hints = 0
         if hints is not None:
-            sparse_blocks = blocks_from_hints([hint for hint in hints if not hint[2]], self.block_size)
-            read_blocks = blocks_from_hints([hint for hint in hints if hint[2]], self.block_size)
+            sparse_blocks = RangeSet()
+            read_blocks = RangeSet()
+            # Sanity check: check hints for validity, i.e. too high offsets, ...
+            for start_block, end_block, exists in block_ranges_from_hints(hints, self.block_size, source_size):
+                (read_blocks if exists else sparse_blocks).add(start_block, end_block)
+                num_hints += 1
         else:
-            sparse_blocks = []
-            read_blocks = range(size)
-        sparse_blocks = set(sparse_blocks)
-        read_blocks = set(read_blocks)
+            sparse_blocks = RangeSet()
+            read_blocks = RangeSet([(0, size)])
 
         # Validity check
         if from_version:
@@ -637,7 +724,7 @@ class Backy():
             if not old_version.valid:
                 raise RuntimeError('You cannot base on an invalid version.')
 
-        existing_block_ids = set()
+        existing_block_ids = RangeSet()
         if continue_version:
             version_uid = continue_version
             _v = self.meta_backend.get_version(version_uid)  # raise if version does not exist
@@ -646,12 +733,12 @@ class Backy():
             if _v.valid:
                 raise ValueError('You cannot continue a valid version.')
             # reduce read_blocks and sparse_blocks by existing blocks
-            existing_block_ids = set(self.meta_backend.get_block_ids_by_version(version_uid))
+            existing_block_ids = self.meta_backend.get_block_id_ranges_by_version(version_uid)
             read_blocks = read_blocks - existing_block_ids
             sparse_blocks = sparse_blocks - existing_block_ids
         else:
             # Create new version
-            version_uid = self.meta_backend.set_version(name, snapshot_name, size, source_size, 0)  # initially marked invalid
+            version_uid = self.meta_backend.set_version(name, snapshot_name, size, source_size, 0, hash_function=hash_function)  # initially marked invalid
             if not self.locking.lock(version_uid):
                 raise LockError('Version {} is locked.'.format(version_uid))
 
@@ -662,116 +749,121 @@ class Backy():
         # or source doesn't match. In any case, the resulting backup won't
         # be good.
         check_block_ids = set()
-        if from_version and hints:
-            ignore_blocks = list(set(range(size)) - read_blocks - sparse_blocks)
-            random.shuffle(ignore_blocks)
+        if from_version and num_hints:
+            ignore_blocks = RangeSet([(0, size)]) - read_blocks - sparse_blocks
             num_check_blocks = 10
-            # 50% from the start
-            check_block_ids = ignore_blocks[:num_check_blocks//2]
-            # and 50% from random locations
-            check_block_ids = set(check_block_ids + random.sample(ignore_blocks, num_check_blocks//2))
+            check_block_ids = set(ignore_blocks.sample(num_check_blocks))
 
         # Find blocks to base on
         if from_version:
             # Make sure we're based on a valid version.
-            old_blocks = iter(self.meta_backend.get_blocks_by_version(from_version).yield_per(1000))
+            # The block writer commits while plan() reads the old blocks, so
+            # they must be read in pages without an open cursor.
+            old_blocks = self.meta_backend.get_blocks_by_version_paged(from_version)
         else:
-            old_blocks = iter([])
-
-        # Create read jobs
-        _log_every_jobs = size // 200 + 1  # about every half percent
-        _log_jobs_counter = 0
-        t1 = time.time()
-        t_last_run = 0
-        for block_id in range(size):
-            _log_jobs_counter -= 1
-            # Create a block, either based on an old one (from_version) or a fresh one
-            _have_old_block = False
-            try:
-                old_block = next(old_blocks)
-            except StopIteration:  # No old block found, we create a fresh one
-                block_uid = None
-                checksum = None
-                block_size = self.block_size
-                valid = 1
-            else:  # Old block found, maybe base on that one
-                assert old_block.id == block_id
-                block_uid = old_block.uid
-                checksum = old_block.checksum
-                block_size = old_block.size
-                valid = old_block.valid
-                _have_old_block = True
-            # the last block can differ in size, so let's check
-            _offset = block_id * self.block_size
-            new_block_size = min(self.block_size, source_size - _offset)
-            if new_block_size != block_size:
-                # last block changed, so set back all info
-                block_size = new_block_size
-                block_uid = None
-                checksum = None
-                valid = 1
+            old_blocks = []
+
+        def plan():
+            """ Yields the read jobs (block_id, read, metadata) for all
+            blocks. This is a generator, so jobs are only created as fast
+            as the pipeline consumes them.
+            """
+            _old_blocks = ((b.id, b.uid, b.checksum, b.size, b.valid) for b in old_blocks)
+            for block_id in range(size):
+                # Create a block, either based on an old one (from_version) or a fresh one
                 _have_old_block = False
+                try:
+                    old_block_id, block_uid, checksum, block_size, valid = next(_old_blocks)
+                except StopIteration:  # No old block found, we create a fresh one
+                    block_uid = None
+                    checksum = None
+                    block_size = self.block_size
+                    valid = 1
+                else:  # Old block found, maybe base on that one
+                    assert old_block_id == block_id
+                    _have_old_block = True
+                # the last block can differ in size, so let's check
+                _offset = block_id * self.block_size
+                new_block_size = min(self.block_size, source_size - _offset)
+                if new_block_size != block_size:
+                    # last block changed, so set back all info
+                    block_size = new_block_size
+                    block_uid = None
+                    checksum = None
+                    valid = 1
+                    _have_old_block = False
+
+                # Build list of blocks to be read or skipped
+                # Read (read_blocks, check_block_ids or block is invalid) or not?
+                if block_id in read_blocks:
+                    logger.debug('Block {}: Reading'.format(block_id))
+                    yield block_id, True, None
+                elif block_id in check_block_ids and _have_old_block and checksum:
+                    logger.debug('Block {}: Reading / checking'.format(block_id))
+                    yield block_id, True, {'check': True, 'checksum': checksum, 'block_size': block_size}
+                elif not valid:
+                    logger.debug('Block {}: Reading because not valid'.format(block_id))
+                    assert _have_old_block
+                    yield block_id, True, None
+                elif block_id in sparse_blocks:
+                    logger.debug('Block {}: Sparse'.format(block_id))
+                    # Sparse blocks have uid and checksum None.
+                    yield block_id, False, {'block_uid': None, 'checksum': None, 'block_size': block_size}
+                elif block_id in existing_block_ids:
+                    logger.debug('Block {}: Exists in continued version'.format(block_id))
+                    yield block_id, False, {'skip': True}
+                else:
+                    logger.debug('Block {}: Fresh empty or existing'.format(block_id))
+                    yield block_id, False, {'block_uid': block_uid, 'checksum': checksum, 'block_size': block_size}
+
+        # Feed the read jobs to the io through a window of at most
+        # pipeline_window jobs in flight. Reading, hashing, dedup, writing to
+        # the data backend and committing the metadata all happen
+        # concurrently, and memory doesn't grow with the size of the source.
+        jobs = plan()
+
+        def submit():
+            """ Adds the next read job to the io. Returns False if there are
+            no more jobs.
+            """
+            job = next(jobs, None)
+            if job is None:
+                return False
+            block_id, read, metadata = job
+            io.read(block_id, read=read, metadata=metadata)
+            return True
 
-            # Build list of blocks to be read or skipped
-            # Read (read_blocks, check_block_ids or block is invalid) or not?
-            if block_id in read_blocks:
-                logger.debug('Block {}: Reading'.format(block_id))
-                io.read(block_id, read=True)
-            elif block_id in check_block_ids and _have_old_block and checksum:
-                logger.debug('Block {}: Reading / checking'.format(block_id))
-                io.read(block_id, read=True, metadata={'check': True, 'checksum': checksum, 'block_size': block_size})
-            elif not valid:
-                logger.debug('Block {}: Reading because not valid'.format(block_id))
-                io.read(block_id, read=True)
-                assert _have_old_block
-            elif block_id in sparse_blocks:
-                logger.debug('Block {}: Sparse'.format(block_id))
-                # Sparse blocks have uid and checksum None.
-                io.read(block_id, read=False, metadata={'block_uid': None, 'checksum': None, 'block_size': block_size})
-            elif block_id in existing_block_ids:
-                logger.debug('Block {}: Exists in continued version'.format(block_id))
-                io.read(block_id, read=False, metadata={'skip': True})
-            else:
-                logger.debug('Block {}: Fresh empty or existing'.format(block_id))
-                io.read(block_id, read=False, metadata={'block_uid': block_uid, 'checksum': checksum, 'block_size': block_size})
-
-            # log and process output
-            if time.time() - t_last_run >= 1:
-                t_last_run = time.time()
-                t2 = time.time()
-                dt = t2-t1
-                logger.debug(io.thread_status() + " " + self.data_backend.thread_status())
-
-                io_queue_status = io.queue_status()
-                db_queue_status = self.data_backend.queue_status()
-                _status = status(
-                    'Backing up (1/2: Prep) {}'.format(source),
-                    0,
-                    0,
-                    (block_id + 1) / size * 100,
-                    0.0,
-                    round(size / (block_id+1) * dt - dt),
-                    )
-                notify(self.process_name, _status)
-                if _log_jobs_counter <= 0:
-                    _log_jobs_counter = _log_every_jobs
-                    logger.info(_status)
-
+        for i in range(self.pipeline_window):
+            if not submit():
+                break
 
-        # now use the readers and write
         _log_every_jobs = size // 200 + 1  # about every half percent
         _log_jobs_counter = 0
         t1 = time.time()
         t_last_run = 0
+        t_first_block = None
 
         _written_blocks_queue = queue.Queue()  # contains ONLY blocks that have been written to the data backend.
+        block_writer = self.meta_backend.get_block_writer()  # stores the blocks from _written_blocks_queue in batches
+        dedup_index = None
+        if self.dedup and self.dedup_index:
+            notify(self.process_name, 'Loading dedup index')
+            dedup_index = DedupIndex(self.meta_backend, block_writer, hash_function,
+                    additional_capacity=size, max_mapped=self.dedup_index_entries).load()
 
         # consume the read jobs
         for i in range(size):
             _log_jobs_counter -= 1
             block_id, data, data_checksum, metadata = io.get()
+            submit()
 
             if data:
+                if t_first_block is None:
+                    t_first_block = time.time()
+                    logger.debug('Time to first block: {:.2f}s'.format(t_first_block - stats['start_time']))
+                # The io returns the full digest, but only checksum_length
+                # bytes of it are stored and used for dedup.
+                data_digest, data_checksum = data_checksum, data_checksum[:self.checksum_length]
                 block_size = len(data)
                 stats['blocks_read'] += 1
                 stats['bytes_read'] += block_size
@@ -779,10 +871,13 @@ class Backy():
                 stats['bytes_throughput'] += block_size
 
                 existing_block = None
-                if self.dedup:
-                    existing_block = self.meta_backend.get_block_by_checksum(data_checksum)
+                if dedup_index is not None:
+                    existing_block = dedup_index.get_block_by_checksum(data_checksum)
+                elif self.dedup:
+                    existing_block = block_writer.get_block_by_checksum(data_checksum) or \
+                        self.meta_backend.get_block_by_checksum(data_checksum, hash_function)
 
-                if data == b'\0' * block_size:
+                if is_zero(data):
                     block_uid = None
                     data_checksum = None
                     _written_blocks_queue.put((block_id, version_uid, block_uid, data_checksum, block_size))
@@ -806,7 +901,7 @@ class Backy():
 
                 if metadata and 'check' in metadata:
                     # Perform sanity check
-                    if not metadata['checksum'] == data_checksum or not metadata['block_size'] == block_size:
+                    if not metadata['checksum'] == data_digest[:len(metadata['checksum'])] or not metadata['block_size'] == block_size:
                         logger.error("Source and backup don't match in regions outside of the hints.")
                         logger.error("Looks like the hints don't match or the source is different.")
                         logger.error("Found wrong source data at block {}: offset {} with max. length {}".format(
@@ -841,19 +936,21 @@ class Backy():
                 except queue.Empty:
                     break
                 else:
-                    self.meta_backend.set_block(q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, valid=1, _commit=True, _upsert=False)
+                    block_writer.add(q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, valid=1)
+                    if dedup_index is not None and q_block_uid and q_data_checksum:
+                        dedup_index.add(q_data_checksum, q_block_uid, q_block_size)
 
             # log and process output
             if time.time() - t_last_run >= 1:
                 t_last_run = time.time()
                 t2 = time.time()
                 dt = t2-t1
-                logger.debug(io.thread_status() + " " + self.data_backend.thread_status())
+                logger.debug(io.thread_status() + " " + self.data_backend.thread_status() + " " + hash_pool.thread_status())
 
                 io_queue_status = io.queue_status()
                 db_queue_status = self.data_backend.queue_status()
                 _status = status(
-                    'Backing up (2/2: Data) {}'.format(source),
+                    'Backing up {}'.format(source),
                     io_queue_status['rq_filled']*100,
                     db_queue_status['wq_filled']*100,
                     (i + 1) / size * 100,
@@ -870,6 +967,7 @@ class Backy():
             logger.error("Exception during saving to the data backend: {}".format(str(self.data_backend.last_exception)))
         else:
             io.close()  # wait for all readers
+            hash_pool.close()
             self.data_backend.close()  # wait for all writers
 
         # Set the rest of the blocks from the _written_blocks_queue
@@ -879,7 +977,18 @@ class Backy():
             except queue.Empty:
                 break
             else:
-                self.meta_backend.set_block(q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, valid=1, _commit=True, _upsert=False)
+                block_writer.add(q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, valid=1)
+        block_writer.flush()
+        if dedup_index is not None:
+            logger.info(dedup_index.status())
+        if t_first_block is not None:
+            stats['time_to_first_block'] = t_first_block - stats['start_time']
+        stats['peak_rss_bytes'] = peak_rss()
+        logger.info('Time to first block: {}, peak memory usage: {}'.format(
+            '{:.2f}s'.format(stats['time_to_first_block']) if 'time_to_first_block' in stats else '-',
+            humanize(stats['peak_rss_bytes']),
+            ))
+        self.last_backup_stats = stats
 
         tags = []
         if tag is not None:
@@ -932,15 +1041,67 @@ class Backy():
         if not self.locking.lock('backy-cleanup-fast'):
             raise LockError('Another backy cleanup is running.')
 
-        for uid_list in self.meta_backend.get_delete_candidates(dt):
-            logger.debug('Cleanup-fast: Deleting UIDs from data backend: {}'.format(uid_list))
-            no_del_uids = []
-            no_del_uids = self.data_backend.rm_many(uid_list)
+        # The meta backend yields lists of candidates per batch. Collect them,
+        # so the data backend can delete in large (and concurrent) batches.
+        delete_candidates = itertools.chain.from_iterable(self.meta_backend.get_delete_candidates(dt))
+        segment_keys = set()
+
+        def deleted(deletion):
+            no_del_uids = deletion.result()
             if no_del_uids:
-                logger.info('Cleanup-fast: Unable to delete these UIDs from data backend: {}'.format(uid_list))
+                logger.info('Cleanup-fast: Unable to delete these UIDs from data backend: {}'.format(no_del_uids))
+
+        # a batch is deleted from the data backend while the meta backend
+        # resolves the next one.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            deletion = None
+            for uid_list in grouper(self.CLEANUP_RM_MANY_SIZE, delete_candidates):
+                # packed blobs are removed with their segment
+                locations = [packed_location(uid) for uid in uid_list]
+                segment_keys.update(location[0] for location in locations if location)
+                uid_list = [uid for uid, location in zip(uid_list, locations) if not location]
+                logger.debug('Cleanup-fast: Deleting UIDs from data backend: {}'.format(uid_list))
+                if deletion:
+                    deleted(deletion)
+                deletion = executor.submit(self.data_backend.rm_many, uid_list)
+            if deletion:
+                deleted(deletion)
+        if segment_keys:
+            self._cleanup_segments(segment_keys)
         self.locking.unlock('backy-cleanup-fast')
 
 
+    def _cleanup_segments(self, segment_keys):
+        """ Deletes segments without any referenced blobs. Segments with less
+        than pack_compact_ratio * pack_size referenced bytes are compacted,
+        i.e. their blobs are copied to new segments. The old uids then become
+        delete candidates, so the segment is deleted by a later cleanup.
+        """
+        delete_keys = []
+        compact_uids = []
+        num_compacted = 0
+        for segment_key in segment_keys:
+            live_uids = list(self.meta_backend.get_all_block_uids(segment_key))
+            if not live_uids:
+                delete_keys.append(segment_key)
+                continue
+            live_bytes = sum(packed_location(uid)[2] for uid in live_uids)
+            if live_bytes < self.data_backend.pack_size * self.data_backend.pack_compact_ratio:
+                logger.debug('Cleanup-fast: Compacting segment {} ({} blobs, {} bytes)'.format(
+                    segment_key, len(live_uids), live_bytes))
+                compact_uids.extend(live_uids)
+                num_compacted += 1
+        if compact_uids:
+            # the blobs of all these segments go into as few new segments as possible
+            uid_map = self.data_backend.compact(compact_uids)
+            self.meta_backend.update_block_uids(uid_map)
+        for uid_list in grouper(self.CLEANUP_RM_MANY_SIZE, delete_keys):
+            no_del_uids = self.data_backend.rm_many(uid_list)
+            if no_del_uids:
+                logger.info('Cleanup-fast: Unable to delete these segments from data backend: {}'.format(no_del_uids))
+        logger.info('Cleanup-fast: Deleted {} segments, compacted {} segments.'.format(len(delete_keys), num_compacted))
+
+
     def cleanup_full(self, prefix=None):
         """ Delete unreferenced blob UIDs starting with <prefix> """
         # in this mode, we compare all existing uids in data and meta.
@@ -951,16 +1112,28 @@ class Backy():
         # make sure, no other backy is running
         if len(find_other_procs(self.process_name)) > 1:
             raise LockError('Other backy instances are running.')
-        active_blob_uids = set(self.data_backend.get_all_blob_uids(prefix))
-        active_block_uids = set(self.meta_backend.get_all_block_uids(prefix))
-        delete_candidates = active_blob_uids.difference(active_block_uids)
-        for delete_candidate in delete_candidates:
-            logger.debug('Cleanup: Removing UID {}'.format(delete_candidate))
-            try:
-                self.data_backend.rm(delete_candidate)
-            except FileNotFoundError:
-                continue
-        logger.info('Cleanup: Removed {} blobs'.format(len(delete_candidates)))
+        # Both listings are sorted, so they are merged while they're streamed
+        # and never held in memory. Runs for different prefixes are
+        # independent.
+        active_blob_uids = self.data_backend.get_all_blob_uids(prefix)
+        # packed blobs keep their segment. The segment key is a prefix of
+        # their uids, so this keeps the order.
+        active_block_uids = (location[0] if location else uid for uid, location in
+                ((uid, packed_location(uid)) for uid in self.meta_backend.get_all_block_uids(prefix)))
+        delete_candidates = sorted_difference(active_blob_uids, active_block_uids)
+        num_deleted = 0
+        failed = False
+        for uid_list in grouper(self.CLEANUP_RM_MANY_SIZE, delete_candidates):
+            logger.debug('Cleanup: Removing UIDs {}'.format(uid_list))
+            # already removed blobs are no problem here
+            failed = bool(self.data_backend.rm_many(uid_list)) or failed
+            num_deleted += len(uid_list)
+            if not failed:
+                # a later run may resume after the blobs deleted so far
+                self.data_backend.set_list_checkpoint(prefix, uid_list[-1])
+        if not failed:
+            self.data_backend.set_list_checkpoint(prefix, None)
+        logger.info('Cleanup: Removed {} blobs'.format(num_deleted))
         self.locking.unlock('backy')
 
 
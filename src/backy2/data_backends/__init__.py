@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+from backy2.data_backends.compression import get_codec
+from backy2.data_backends.compression import get_codec_by_id
+from backy2.data_backends.compression import CODEC_NONE
+from backy2.data_backends.encryption import get_keyring
+from backy2.data_backends.encryption import parse_keys
+from backy2.logging import logger
 import shortuuid
 import hashlib
+import struct
+import threading
+import time
 
 STATUS_NOTHING = 0
 STATUS_READING = 1
@@ -10,12 +19,217 @@ STATUS_WRITING = 2
 STATUS_THROTTLING = 3
 STATUS_QUEUE = 4
 
+# Blobs which are compressed or encrypted start with a header:
+# magic, header format version, codec id, length of the uncompressed data
+# Encrypted blobs (format version 2) continue with:
+# cipher id, key id, nonce
+# and the rest is the ciphertext including the authentication tag.
+BLOB_MAGIC = b'BKY2'
+BLOB_HEADER = struct.Struct('>4sBBQ')
+BLOB_CRYPT_HEADER = struct.Struct('>BH12s')
+BLOB_FORMAT_VERSION = 1
+BLOB_FORMAT_VERSION_ENCRYPTED = 2
+
+# Packed blobs are stored in large segment objects. Their uid is the segment
+# key (10 hex chars, '-', 5 base57 chars), the blob's offset and its length
+# (8 hex chars each), so the blocks table holds their location. The '-'
+# never appears in other uids. The uid up to the offset is authenticated with
+# encrypted blobs, as the length is only known after encoding.
+SEGMENT_KEY_LENGTH = 16
+SEGMENT_KEY_SEPARATOR = '-'
+PACKED_UID_AAD_LENGTH = SEGMENT_KEY_LENGTH + 8
+MAX_PACK_SIZE = 2**31
+
+
+def packed_location(uid):
+    """ Returns (segment key, offset, length) of a packed blob uid or None
+    if the blob is stored in its own object.
+    """
+    if len(uid) != 32 or uid[10] != SEGMENT_KEY_SEPARATOR:
+        return None
+    return uid[:SEGMENT_KEY_LENGTH], int(uid[16:24], 16), int(uid[24:32], 16)
+
+
+class Segment():
+    """ A segment object which is filled with encoded blobs. callbacks holds
+    (callback, uid) of each blob, to be called when the segment has been
+    written.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.data = bytearray()
+        self.callbacks = []
+
+
+    def add(self, encode, data, callback=None):
+        """ Appends data encoded by encode(uid, data) and returns its uid """
+        uid = self.key + '{:08x}'.format(len(self.data))
+        encoded = encode(uid, data)
+        uid += '{:08x}'.format(len(encoded))
+        self.data += encoded
+        self.callbacks.append((callback, uid))
+        return uid
+
+
 class DataBackend():
     """ Holds BLOBs, never overwrites
     """
 
+    _SUPPORTS_PACKING = False
+
+    # Ranged reads up to this offset also read the blob's header, above it
+    # the header is read separately.
+    RANGED_READ_HEADER_DISTANCE = 65536
+
     def __init__(self, config):
-        pass
+        compression_level = config.get('compression_level', '')  # '': the codec's default
+        self.codec = get_codec(
+                config.get('compression', 'none'),
+                int(compression_level) if compression_level else None,
+                )
+        self._decoders = {}
+
+        encryption_keys = config.get('encryption_keys', '')
+        if not encryption_keys and config.get('encryption_keys_file', ''):
+            with open(config.get('encryption_keys_file'), 'r', encoding='ascii') as f:
+                encryption_keys = f.read()
+        self.keyring = get_keyring(
+                config.get('encryption', 'none'),
+                parse_keys(encryption_keys),
+                config.getint('encryption_key_id', 0),
+                )
+        # Else, anyone who can write to the storage could replace encrypted
+        # blobs by plaintext ones.
+        self.allow_unencrypted_reads = config.getboolean('allow_unencrypted_reads', False)
+
+        # Packing appends blobs to segments of (at least) pack_size bytes,
+        # one open segment per writer thread.
+        self.pack_size = config.getint('pack_size', 0)  # 0 disables packing
+        self.pack_compact_ratio = config.getfloat('pack_compact_ratio', 0.5)
+        if self.pack_size and not self._SUPPORTS_PACKING:
+            raise NotImplementedError('Packing (pack_size) is not supported by this data backend.')
+        if self.pack_size >= MAX_PACK_SIZE:
+            raise ValueError('pack_size must be smaller than {}.'.format(MAX_PACK_SIZE))
+        self._segments = {}
+
+        self._encode_stats_lock = threading.Lock()
+        self.encode_stats = {
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+
+    def _encode(self, uid, data):
+        """ Prepares data for storing as uid. Called in the writer threads
+        before throttling, so that the bandwidth limit applies to the stored
+        bytes.
+        Data which doesn't get smaller is stored uncompressed. Unencrypted
+        data is stored as is, unless it could be mistaken for a header.
+        """
+        codec = self.codec
+        encoded = codec.compress(data) if codec else None
+        if encoded is not None and len(encoded) + BLOB_HEADER.size >= len(data):
+            encoded = None  # not worth it
+        if self.keyring and self.keyring.encrypts:
+            nonce = self.keyring.new_nonce()
+            header = BLOB_HEADER.pack(
+                    BLOB_MAGIC,
+                    BLOB_FORMAT_VERSION_ENCRYPTED,
+                    codec.id if encoded is not None else CODEC_NONE,
+                    len(data),
+                    ) + BLOB_CRYPT_HEADER.pack(
+                    self.keyring.cipher_id,
+                    self.keyring.key_id,
+                    nonce,
+                    )
+            # the header and uid are authenticated, too. So blobs can't be
+            # exchanged or their header modified.
+            encoded = header + self.keyring.encrypt(
+                    nonce,
+                    data if encoded is None else encoded,
+                    header + uid.encode('ascii'),
+                    )
+        elif encoded is not None:
+            encoded = BLOB_HEADER.pack(BLOB_MAGIC, BLOB_FORMAT_VERSION, codec.id, len(data)) + encoded
+        elif data[:len(BLOB_MAGIC)] == BLOB_MAGIC:
+            encoded = BLOB_HEADER.pack(BLOB_MAGIC, BLOB_FORMAT_VERSION, CODEC_NONE, len(data)) + data
+        else:
+            encoded = data
+        if codec or self.keyring:
+            with self._encode_stats_lock:
+                self.encode_stats['bytes_in'] += len(data)
+                self.encode_stats['bytes_out'] += len(encoded)
+        return encoded
+
+
+    def _check_unencrypted(self, uid):
+        """ Raises if blob uid must be encrypted """
+        if self.keyring and self.keyring.encrypts and not self.allow_unencrypted_reads:
+            raise ValueError('Blob {} is not encrypted, but encryption is configured. '
+                'See allow_unencrypted_reads.'.format(uid))
+
+
+    def _decode(self, uid, data):
+        """ Returns the original data of a stored blob uid. Blobs without a
+        header are returned as they are. So are blobs with an (unencrypted)
+        header which doesn't validate: They have been written before blobs
+        had headers and their data just starts with BLOB_MAGIC.
+        """
+        if data[:len(BLOB_MAGIC)] != BLOB_MAGIC or len(data) < BLOB_HEADER.size:
+            self._check_unencrypted(uid)
+            return data
+        if packed_location(uid):
+            uid = uid[:PACKED_UID_AAD_LENGTH]
+        magic, format_version, codec_id, raw_length = BLOB_HEADER.unpack_from(data)
+        if format_version != BLOB_FORMAT_VERSION_ENCRYPTED:
+            self._check_unencrypted(uid)
+        if format_version == BLOB_FORMAT_VERSION:
+            payload = data[BLOB_HEADER.size:]
+        elif format_version == BLOB_FORMAT_VERSION_ENCRYPTED:
+            if not self.keyring:
+                raise ValueError('Blob {} is encrypted, but no encryption keys are configured.'.format(uid))
+            header_size = BLOB_HEADER.size + BLOB_CRYPT_HEADER.size
+            cipher_id, key_id, nonce = BLOB_CRYPT_HEADER.unpack_from(data, BLOB_HEADER.size)
+            payload = self.keyring.decrypt(
+                    cipher_id,
+                    key_id,
+                    nonce,
+                    data[header_size:],
+                    data[:header_size] + uid.encode('ascii'),
+                    )
+        else:
+            logger.debug('Blob {} has no valid header (format version {}), reading it raw.'.format(uid, format_version))
+            return data
+        # Encrypted blobs are authenticated, so they can't be legacy data.
+        legacy = format_version == BLOB_FORMAT_VERSION
+        if codec_id == CODEC_NONE:
+            decoded = payload
+        else:
+            try:
+                decoder = self._decoders[codec_id]
+            except KeyError:
+                try:
+                    decoder = self._decoders[codec_id] = get_codec_by_id(codec_id)
+                except ValueError:  # unknown codec id
+                    if legacy:
+                        logger.debug('Blob {} has no valid header (codec id {}), reading it raw.'.format(uid, codec_id))
+                        return data
+                    raise
+            try:
+                decoded = decoder.decompress(payload, raw_length)
+            except Exception as e:
+                if legacy:
+                    logger.debug('Blob {} has no valid header ({}), reading it raw.'.format(uid, e))
+                    return data
+                raise
+        if len(decoded) != raw_length:
+            if legacy:
+                logger.debug('Blob {} has no valid header (length {} instead of {}), reading it raw.'.format(
+                    uid, len(decoded), raw_length))
+                return data
+            raise ValueError('Blob has wrong size after decompression: is {} should be {}.'.format(len(decoded), raw_length))
+        return decoded
 
 
     def _uid(self):
@@ -28,17 +242,84 @@ class DataBackend():
         return hash[:10] + suuid
 
 
+    def _segment_key(self):
+        uid = self._uid()
+        return uid[:10] + SEGMENT_KEY_SEPARATOR + uid[10:15]
+
+
+    def _pack(self, id_, data, callback):
+        """ Appends data to the open segment of writer id_. Returns the
+        segment when it's full and must be written, else None.
+        """
+        segment = self._segments.get(id_)
+        if segment is None:
+            segment = self._segments[id_] = Segment(self._segment_key())
+        segment.add(self._encode, data, callback)
+        if len(segment.data) >= self.pack_size:
+            return self._segments.pop(id_)
+
+
+    def _pack_flush(self, id_):
+        """ Returns the open segment of writer id_ or None """
+        return self._segments.pop(id_, None)
+
+
+    def _write_object(self, key, data):
+        """ Stores data as object key """
+        raise NotImplementedError()
+
+
+    def _write_blobs(self, id_, key, data, callbacks):
+        """ Writes the object key for writer id_ and calls the callbacks of
+        the blobs in it. Returns False if it failed.
+        """
+        self.writer_thread_status[id_] = STATUS_THROTTLING
+        time.sleep(self.write_throttling.consume(len(data)))
+        self.writer_thread_status[id_] = STATUS_NOTHING
+        try:
+            self.writer_thread_status[id_] = STATUS_WRITING
+            self._write_object(key, data)
+            self.writer_thread_status[id_] = STATUS_NOTHING
+        except Exception as e:
+            self.last_exception = e
+            return False
+        for callback, uid in callbacks:
+            if callback:
+                callback(uid)
+        return True
+
+
     def save(self, data, _sync=False, callback=None):
-        """ Saves data, returns unique ID """
+        """ Saves data, returns unique ID.
+        With packing, the uid of a blob is known only when its segment has
+        been written. Then it's passed to callback and None is returned.
+        Synchronous saves are never packed.
+        """
         if self.last_exception:
             raise self.last_exception
-        uid = self._uid()
+        uid = None if self.pack_size and not _sync else self._uid()
         self._write_queue.put((uid, data, callback))
         if _sync:
             self._write_queue.join()
         return uid
 
 
+    def compact(self, uids):
+        """ Rewrites the packed blobs uids into new segments and returns a
+        dict old uid -> new uid.
+        """
+        uid_map = {}
+        segment = Segment(self._segment_key())
+        for uid in uids:
+            uid_map[uid] = segment.add(self._encode, self.read_raw(uid))
+            if len(segment.data) >= self.pack_size:
+                self._write_object(segment.key, segment.data)
+                segment = Segment(self._segment_key())
+        if segment.data:
+            self._write_object(segment.key, segment.data)
+        return uid_map
+
+
     def update(self, uid, data, offset=0):
         """ Updates data, returns written bytes.
         This is only available on *some* data backends.
@@ -75,11 +356,47 @@ class DataBackend():
         return block, offset, length, data
 
 
+    def _read_object(self, key, offset=0, length=None):
+        """ Returns length bytes (or all) of object key from offset """
+        raise NotImplementedError()
+
+
     def read_raw(self, uid, offset=0, length=None):
-        """ Read a block in sync. Returns block's data.
-        Used only by nbd server.
+        """ Read a block in sync. Returns block's data or length bytes of it
+        from offset.
+        Only the requested range is fetched from blobs which are stored as
+        they are. Compressed or encrypted blobs are fetched and decoded
+        completely. As this is only known from the blob's header, ranges
+        further into the blob cost a small additional read of the header,
+        unless the data backend compresses or encrypts anyway.
+        Ranges of packed blobs are clamped to the blob's length, as the
+        segment continues with other blobs.
         """
-        raise NotImplementedError()
+        key, start, size = packed_location(uid) or (uid, 0, None)
+        if length is not None and size is not None:
+            length = max(0, min(length, size - offset))
+        if length == 0:
+            return b''
+        if length is not None and not (self.codec or self.keyring):
+            if offset < self.RANGED_READ_HEADER_DISTANCE:
+                data = self._read_object(key, start, offset + length)
+                header = data
+            else:
+                data = None
+                header = self._read_object(key, start, len(BLOB_MAGIC))
+            if header[:len(BLOB_MAGIC)] != BLOB_MAGIC:
+                if data is None:
+                    data = self._read_object(key, start + offset, length)
+                else:
+                    data = data[offset:]
+                time.sleep(self.read_throttling.consume(len(data)))
+                return data
+        data = self._read_object(key, start, size)
+        time.sleep(self.read_throttling.consume(len(data)))
+        data = self._decode(uid, data)
+        if length is not None:
+            return data[offset:offset + length]
+        return data[offset:] if offset else data
 
 
     def rm(self, uid):
@@ -95,10 +412,21 @@ class DataBackend():
 
 
     def get_all_blob_uids(self, prefix=None):
-        """ Get all existing blob uids """
+        """ Yields all existing blob uids (starting with prefix) in
+        ascending (byte) order.
+        """
         raise NotImplementedError()
 
 
+    def set_list_checkpoint(self, prefix, uid):
+        """ Called when all blob uids (starting with prefix) up to uid have
+        been processed, so an interrupted listing may resume after uid.
+        uid None means that the listing has been processed completely.
+        Backends without resumable listings ignore this.
+        """
+        pass
+
+
     def queue_status(self):
         return {
             'rq_filled': self._read_data_queue.qsize() / self._read_data_queue.maxsize,  # 0..1
@@ -128,3 +456,9 @@ class DataBackend():
             self._read_queue.put(None)  # ends the thread
         for _reader_thread in self._reader_threads:
             _reader_thread.join()
+        if self.encode_stats['bytes_in']:
+            logger.info('Encoded {} bytes to {} bytes (ratio {:.2f}).'.format(
+                self.encode_stats['bytes_in'],
+                self.encode_stats['bytes_out'],
+                self.encode_stats['bytes_in'] / self.encode_stats['bytes_out'],
+                ))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import threading
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec ids are stored in each blob's header, so never change them.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_ZSTD = 3
+
+
+class Zlib():
+    id = CODEC_ZLIB
+    DEFAULT_LEVEL = 6
+
+    def __init__(self, level=None):
+        self.level = self.DEFAULT_LEVEL if level is None else level
+
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+
+    def decompress(self, data, raw_length):
+        return zlib.decompress(data, bufsize=raw_length)
+
+
+class LZ4():
+    id = CODEC_LZ4
+    DEFAULT_LEVEL = 0
+
+    def __init__(self, level=None):
+        if lz4 is None:
+            raise NotImplementedError('Compression lz4 needs the python module lz4.')
+        self.level = self.DEFAULT_LEVEL if level is None else level
+
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
+
+
+    def decompress(self, data, raw_length):
+        return lz4.frame.decompress(data)
+
+
+class Zstd():
+    id = CODEC_ZSTD
+    DEFAULT_LEVEL = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise NotImplementedError('Compression zstd needs the python module zstandard.')
+        self.level = self.DEFAULT_LEVEL if level is None else level
+        self._local = threading.local()  # (de)compressors are not thread safe
+
+
+    def compress(self, data):
+        try:
+            compressor = self._local.compressor
+        except AttributeError:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+
+    def decompress(self, data, raw_length):
+        try:
+            decompressor = self._local.decompressor
+        except AttributeError:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor()
+        return decompressor.decompress(data, max_output_size=raw_length)
+
+
+CODECS = {
+    'zlib': Zlib,
+    'lz4': LZ4,
+    'zstd': Zstd,
+}
+
+
+def get_codec(name, level=None):
+    """ Returns a codec instance for name or None for no compression. """
+    if not name or name == 'none':
+        return None
+    try:
+        return CODECS[name](level)
+    except KeyError:
+        raise NotImplementedError('Compression {} unsupported. Available: none, {}'.format(
+            name,
+            ', '.join(sorted(CODECS)),
+            ))
+
+
+def get_codec_by_id(id_):
+    """ Returns a codec instance (with default level) for decoding blobs
+    with this codec id.
+    """
+    for codec in CODECS.values():
+        if codec.id == id_:
+            return codec()
+    raise ValueError('Unknown codec id {}.'.format(id_))
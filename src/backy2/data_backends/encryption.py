@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import binascii
+import os
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = None
+
+# Cipher ids are stored in each blob's header, so never change them.
+CIPHER_AES_256_GCM = 1
+CIPHER_CHACHA20_POLY1305 = 2
+
+CIPHERS = {
+    'aes-256-gcm': CIPHER_AES_256_GCM,
+    'chacha20-poly1305': CIPHER_CHACHA20_POLY1305,
+}
+
+KEY_LENGTH = 32
+NONCE_LENGTH = 12
+
+
+def parse_keys(keys):
+    """ Parses a whitespace separated list of <key id>:<hex encoded key>
+    into a dict key id -> key.
+    """
+    result = {}
+    for entry in keys.split():
+        try:
+            key_id, key = entry.split(':', 1)
+            key_id = int(key_id)
+            key = binascii.unhexlify(key)
+        except ValueError:
+            raise ValueError('Invalid encryption key entry. Format is <key id>:<hex encoded key>.') from None
+        if not 0 < key_id < 2**16:
+            raise ValueError('Invalid encryption key id {}. Must be 1..65535.'.format(key_id))
+        if len(key) != KEY_LENGTH:
+            raise ValueError('Encryption key {} must be {} bytes long.'.format(key_id, KEY_LENGTH))
+        result[key_id] = key
+    return result
+
+
+class Keyring():
+    """ Authenticated encryption of blobs with a set of keys.
+    New blobs are encrypted with cipher and key_id. All keys (and both
+    ciphers) can be used for decryption, so keys can be rotated by adding a
+    new key and changing key_id.
+    The AEAD objects are stateless and thus shared by all worker threads.
+    """
+
+    def __init__(self, cipher, keys, key_id=None):
+        if AESGCM is None:
+            raise NotImplementedError('Encryption needs the python module cryptography.')
+        self.keys = keys
+        self.cipher_id = None
+        self.key_id = None
+        if cipher and cipher != 'none':
+            try:
+                self.cipher_id = CIPHERS[cipher]
+            except KeyError:
+                raise NotImplementedError('Encryption {} unsupported. Available: none, {}'.format(
+                    cipher,
+                    ', '.join(sorted(CIPHERS)),
+                    ))
+            if key_id not in keys:
+                raise ValueError('Encryption key id {} is not configured.'.format(key_id))
+            self.key_id = key_id
+        self._aeads = {}
+
+
+    def _aead(self, cipher_id, key_id):
+        try:
+            return self._aeads[(cipher_id, key_id)]
+        except KeyError:
+            pass
+        try:
+            key = self.keys[key_id]
+        except KeyError:
+            raise KeyError('Blob is encrypted with key id {} which is not configured.'.format(key_id)) from None
+        if cipher_id == CIPHER_AES_256_GCM:
+            aead = AESGCM(key)
+        elif cipher_id == CIPHER_CHACHA20_POLY1305:
+            aead = ChaCha20Poly1305(key)
+        else:
+            raise ValueError('Unknown cipher id {}.'.format(cipher_id))
+        self._aeads[(cipher_id, key_id)] = aead
+        return aead
+
+
+    @property
+    def encrypts(self):
+        return self.cipher_id is not None
+
+
+    def new_nonce(self):
+        return os.urandom(NONCE_LENGTH)
+
+
+    def encrypt(self, nonce, data, associated_data):
+        """ Encrypts data with the current cipher and key. Returns the
+        ciphertext including the authentication tag.
+        """
+        return self._aead(self.cipher_id, self.key_id).encrypt(nonce, data, associated_data)
+
+
+    def decrypt(self, cipher_id, key_id, nonce, data, associated_data):
+        """ Decrypts and authenticates data. Raises
+        cryptography.exceptions.InvalidTag if the blob has been tampered with.
+        """
+        return self._aead(cipher_id, key_id).decrypt(nonce, data, associated_data)
+
+
+def get_keyring(cipher, keys, key_id=None):
+    """ Returns a Keyring or None if there's nothing to encrypt or decrypt. """
+    if (not cipher or cipher == 'none') and not keys:
+        return None
+    return Keyring(cipher, keys, key_id)
@@ -3,9 +3,13 @@
 
 from backy2.data_backends import DataBackend as _DataBackend
 from backy2.data_backends import (STATUS_NOTHING, STATUS_READING, STATUS_WRITING, STATUS_THROTTLING, STATUS_QUEUE)
+from backy2.data_backends import BLOB_HEADER, BLOB_MAGIC, BLOB_FORMAT_VERSION
+from backy2.data_backends import packed_location
+from backy2.data_backends.compression import CODEC_NONE
 from backy2.logging import logger
 from backy2.utils import TokenBucket
-import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 import queue
 import threading
@@ -29,14 +33,19 @@ class DataBackend(_DataBackend):
     SUFFIX = '.blob'
     WRITE_QUEUE_LENGTH = 10
     READ_QUEUE_LENGTH = 20
+    LIST_AHEAD = 4  # directories listed ahead per list worker
+
+    _SUPPORTS_PACKING = True
 
     last_exception = None
 
 
     def __init__(self, config):
+        _DataBackend.__init__(self, config)
         self.path = config.get('path')
         simultaneous_writes = config.getint('simultaneous_writes')
         simultaneous_reads = config.getint('simultaneous_reads', 1)
+        self.list_workers = config.getint('list_workers', 8)
         self.write_queue_length = simultaneous_writes + self.WRITE_QUEUE_LENGTH
         self.read_queue_length = simultaneous_reads + self.READ_QUEUE_LENGTH
 
@@ -75,39 +84,45 @@ class DataBackend(_DataBackend):
         while True:
             entry = self._write_queue.get()
             if entry is None or self.last_exception:
+                segment = self._pack_flush(id_)
+                if entry is None and segment:
+                    self._write_blobs(id_, segment.key, segment.data, segment.callbacks)
                 logger.debug("Writer {} finishing.".format(id_))
                 break
             uid, data, callback = entry
 
-            # TODO: encrypt, compress data before throttling.
-
-            path = os.path.join(self.path, self._path(uid))
-            filename = self._filename(uid)
-            self.writer_thread_status[id_] = STATUS_THROTTLING
-            time.sleep(self.write_throttling.consume(len(data)))
-            self.writer_thread_status[id_] = STATUS_NOTHING
-            t1 = time.time()
-            try:
-                try:
-                    self.writer_thread_status[id_] = STATUS_WRITING
-                    with open(filename, 'wb') as f:
-                        r = f.write(data)
-                    self.writer_thread_status[id_] = STATUS_NOTHING
-                except FileNotFoundError:
-                    self.writer_thread_status[id_] = STATUS_WRITING
-                    makedirs(path)
-                    with open(filename, 'wb') as f:
-                        r = f.write(data)
-                    self.writer_thread_status[id_] = STATUS_NOTHING
-                assert r == len(data)
-            except Exception as e:
-                self.last_exception = e
-            else:
-                t2 = time.time()
-                if callback:
-                    callback(uid)
+            if uid is None:  # packed
+                segment = self._pack(id_, data, callback)
+                self._write_queue.task_done()
+                if segment:
+                    self._write_blobs(id_, segment.key, segment.data, segment.callbacks)
+            elif self._write_blobs(id_, uid, self._encode(uid, data), [(callback, uid)]):
                 self._write_queue.task_done()
-                #logger.debug('Writer {} wrote data async. uid {} in {:.2f}s (Queue size is {})'.format(id_, uid, t2-t1, self._write_queue.qsize()))
+
+
+    def _write_object(self, key, data):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'wb') as f:
+                r = f.write(data)
+        except FileNotFoundError:
+            makedirs(os.path.join(self.path, self._path(key)))
+            with open(filename, 'wb') as f:
+                r = f.write(data)
+        assert r == len(data)
+
+
+    def _read_object(self, key, offset=0, length=None):
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            raise FileNotFoundError('File {} not found.'.format(filename))
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(-1 if length is None else length)
+        if length is not None and len(data) != length:
+            raise ValueError('File {} is too short: read {} bytes at offset {}, expected {}.'.format(
+                filename, len(data), offset, length))
+        return data
 
 
     def _reader(self, id_):
@@ -149,7 +164,15 @@ class DataBackend(_DataBackend):
 
 
     def update(self, uid, data, offset=0):
+        if packed_location(uid):
+            raise NotImplementedError('Packed blobs can not be updated.')
         with open(self._filename(uid), 'r+b') as f:
+            header = f.read(BLOB_HEADER.size)
+            if header[:len(BLOB_MAGIC)] == BLOB_MAGIC and len(header) == BLOB_HEADER.size:
+                magic, format_version, codec_id, raw_length = BLOB_HEADER.unpack(header)
+                if codec_id != CODEC_NONE or format_version != BLOB_FORMAT_VERSION:
+                    raise NotImplementedError('Compressed or encrypted blobs can not be updated.')
+                offset += BLOB_HEADER.size
             f.seek(offset)
             return f.write(data)
 
@@ -174,22 +197,43 @@ class DataBackend(_DataBackend):
         return _no_del
 
 
-    def read_raw(self, uid):
-        filename = self._filename(uid)
-        if not os.path.exists(filename):
-            raise FileNotFoundError('File {} not found.'.format(filename))
-        # TODO: Decrypt, uncompress data
-        data = open(filename, 'rb').read()
-        time.sleep(self.read_throttling.consume(len(data)))
-        return data
+    def _leaf_dirs(self, prefix, path='', depth=0):
+        """ Yields the directories (relative to self.path) at DEPTH which
+        may contain uids starting with prefix in ascending order.
+        """
+        if depth == self.DEPTH:
+            yield path
+            return
+        part = prefix[depth*self.SPLIT:(depth+1)*self.SPLIT]
+        try:
+            with os.scandir(os.path.join(self.path, path)) as entries:
+                names = sorted(e.name for e in entries if e.is_dir() and e.name.startswith(part))
+        except FileNotFoundError:
+            return
+        for name in names:
+            yield from self._leaf_dirs(prefix, os.path.join(path, name), depth + 1)
+
+
+    def _list_dir(self, path, prefix):
+        try:
+            with os.scandir(os.path.join(self.path, path)) as entries:
+                return sorted(e.name[:-len(self.SUFFIX)] for e in entries
+                        if e.name.endswith(self.SUFFIX) and e.name.startswith(prefix))
+        except FileNotFoundError:
+            return []
 
 
     def get_all_blob_uids(self, prefix=None):
-        if prefix:
-            raise RuntimeError('prefix is not supported on file backends.')
-        matches = []
-        for root, dirnames, filenames in os.walk(self.path):
-            for filename in fnmatch.filter(filenames, '*.blob'):
-                uid = filename.split('.')[0]
-                matches.append(uid)
-        return matches
+        """ The leaf directories are listed by list_workers threads. As the
+        directories are the first chars of the uids, yielding their listings
+        in directory order yields the uids in ascending order.
+        """
+        prefix = prefix or ''
+        with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+            listings = deque()
+            for path in self._leaf_dirs(prefix):
+                listings.append(executor.submit(self._list_dir, path, prefix))
+                if len(listings) >= self.list_workers * self.LIST_AHEAD:
+                    yield from listings.popleft().result()
+            while listings:
+                yield from listings.popleft().result()
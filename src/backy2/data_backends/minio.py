@@ -15,6 +15,9 @@ from minio import Minio
 from minio.error import (ResponseError, BucketAlreadyOwnedByYou,
                          BucketAlreadyExists)
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
 import io
 import os
 import queue
@@ -30,10 +33,12 @@ class DataBackend(_DataBackend):
 
     WRITE_QUEUE_LENGTH = 20
     READ_QUEUE_LENGTH = 20
+    DELETE_BATCH_SIZE = 1000  # maximum number of keys per DeleteObjects request
 
     last_exception = None
 
     def __init__(self, config):
+        _DataBackend.__init__(self, config)
         self.aws_access_key_id = config.get('aws_access_key_id')
         if self.aws_access_key_id is None:
             aws_access_key_id_file = config.get('aws_access_key_id_file')
@@ -53,6 +58,7 @@ class DataBackend(_DataBackend):
 
         simultaneous_writes = config.getint('simultaneous_writes', 1)
         simultaneous_reads = config.getint('simultaneous_reads', 1)
+        self.simultaneous_deletes = config.getint('simultaneous_deletes', 10)
         bandwidth_read = config.getint('bandwidth_read', 0)
         bandwidth_write = config.getint('bandwidth_write', 0)
 
@@ -109,6 +115,7 @@ class DataBackend(_DataBackend):
             if client is None:
                 client = self._get_client()
             uid, data, callback = entry
+            data = self._encode(uid, data)
 
             self.writer_thread_status[id_] = STATUS_THROTTLING
             time.sleep(self.write_throttling.consume(len(data)))
@@ -142,7 +149,9 @@ class DataBackend(_DataBackend):
             t1 = time.time()
             try:
                 self.reader_thread_status[id_] = STATUS_READING
-                data = self.read_raw(block.uid, client)
+                data = self._read_object(block.uid, _client=client)
+                time.sleep(self.read_throttling.consume(len(data)))  # TODO: Need throttling in thread statistics!
+                data = self._decode(block.uid, data)
                 self.reader_thread_status[id_] = STATUS_NOTHING
                 #except FileNotFoundError:
             except Exception as e:
@@ -154,12 +163,17 @@ class DataBackend(_DataBackend):
                 logger.debug('Reader {} read data async. uid {} in {:.2f}s (Queue size is {})'.format(id_, block.uid, t2-t1, self._read_queue.qsize()))
 
 
-    def read_raw(self, block_uid, _client=None):
+    def _read_object(self, key, offset=0, length=None, _client=None):
         if not _client:
-            _client = self._get_client()
-
-        data = _client.get_object(self.bucket_name, block_uid).read()
-        time.sleep(self.read_throttling.consume(len(data)))  # TODO: Need throttling in thread statistics!
+            _client = self.client
+
+        if length is None:
+            data = _client.get_object(self.bucket_name, key).read()
+        else:
+            data = _client.get_partial_object(self.bucket_name, key, offset, length).read()
+            if len(data) != length:
+                raise ValueError('Key {} is too short: read {} bytes at offset {}, expected {}.'.format(
+                    key, len(data), offset, length))
         return data
 
 
@@ -170,17 +184,35 @@ class DataBackend(_DataBackend):
             raise
 
 
+    def _remove_objects(self, uids):
+        """ Deletes up to DELETE_BATCH_SIZE uids with a single request and
+        returns the uids which couldn't be deleted.
+        """
+        no_del = []
+        try:
+            # remove_objects is lazy, the request is sent while iterating.
+            for del_err in self.client.remove_objects(self.bucket_name, uids):
+                logger.error("S3 Object Deletion Error: {}".format(del_err))
+                no_del.append(del_err.object_name)
+        except ResponseError as e:
+            logger.error('S3 batch deletion of {} objects failed: {}'.format(len(uids), e))
+            return list(uids)
+        return no_del
+
+
     def rm_many(self, uids):
         """ Deletes many uids from the data backend and returns a list
         of uids that couldn't be deleted.
+        The uids are deleted in batches, which run concurrently.
         """
-        try:
-            for del_err in minioClient.remove_objects(self.bucket_name, uids):
-                logger.error("S3 Object Deletion Error: {}".format(del_err))
-        except ResponseError as err:
-            raise
+        uids = list(uids)
+        batches = [uids[i:i+self.DELETE_BATCH_SIZE] for i in range(0, len(uids), self.DELETE_BATCH_SIZE)]
+        if not batches:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.simultaneous_deletes, len(batches))) as executor:
+            return list(chain.from_iterable(executor.map(self._remove_objects, batches)))
 
 
     def get_all_blob_uids(self, prefix=None):
         objects = self.client.list_objects(self.bucket_name, prefix)
-        return [o.object_name for o in objects]
+        return (o.object_name for o in objects)
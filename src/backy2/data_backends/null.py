@@ -25,6 +25,7 @@ class DataBackend(_DataBackend):
     last_exception = None
 
     def __init__(self, config):
+        _DataBackend.__init__(self, config)
         self.default_block_size = int([value for key, value in config.items('DEFAULTS') if key=='block_size'][0])
 
         simultaneous_writes = config.getint('simultaneous_writes', 1)
@@ -69,6 +70,7 @@ class DataBackend(_DataBackend):
                 logger.debug("Writer {} finishing.".format(id_))
                 break
             uid, data, callback = entry
+            data = self._encode(uid, data)  # only to measure the cost
             self.writer_thread_status[id_] = STATUS_THROTTLING
             time.sleep(self.write_throttling.consume(len(data)))
             self.writer_thread_status[id_] = STATUS_NOTHING
@@ -132,4 +134,4 @@ class DataBackend(_DataBackend):
 
 
     def get_all_blob_uids(self, prefix=None):
-        return []
+        return iter(())
@@ -9,8 +9,11 @@ import boto3
 from botocore.client import Config as BotoCoreClientConfig
 from botocore.exceptions import ClientError
 from botocore.handlers import set_list_objects_encoding_type_url
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import hashlib
 #import io
+import json
 import os
 import queue
 import random
@@ -26,10 +29,17 @@ class DataBackend(_DataBackend):
 
     WRITE_QUEUE_LENGTH = 20
     READ_QUEUE_LENGTH = 20
+    DELETE_BATCH_SIZE = 1000  # maximum number of keys per DeleteObjects request
+    LIST_AHEAD = 4  # number of pages buffered per listed shard
+    LIST_CHECKPOINT_INTERVAL = 60  # seconds between two listing checkpoints
+    HEX_DIGITS = '0123456789abcdef'
+
+    _SUPPORTS_PACKING = True
 
     last_exception = None
 
     def __init__(self, config):
+        _DataBackend.__init__(self, config)
         aws_access_key_id = config.get('aws_access_key_id')
         if aws_access_key_id is None:
             aws_access_key_id_file = config.get('aws_access_key_id_file')
@@ -52,6 +62,13 @@ class DataBackend(_DataBackend):
 
         simultaneous_writes = config.getint('simultaneous_writes', 1)
         simultaneous_reads = config.getint('simultaneous_reads', 1)
+        self.simultaneous_deletes = config.getint('simultaneous_deletes', 10)
+        self.list_shards = config.getint('list_shards', 16)
+        if self.list_shards not in (1, 16, 256):
+            raise NotImplementedError('list_shards must be 1, 16 or 256.')
+        self.list_workers = config.getint('list_workers', 16)
+        self.list_checkpoint = config.get('list_checkpoint', '')
+        self._t_list_checkpoint = 0
         bandwidth_read = config.getint('bandwidth_read', 0)
         bandwidth_write = config.getint('bandwidth_write', 0)
 
@@ -82,8 +99,14 @@ class DataBackend(_DataBackend):
         if signature_version:
             resource_config['signature_version'] = signature_version
 
-        # TODO
-        #resource_config['max_pool_connections'] = 100
+        # All threads share one client and thus one connection pool. It
+        # needs a connection per concurrent request, otherwise connections
+        # are closed and reopened all the time.
+        resource_config['max_pool_connections'] = config.getint('max_pool_connections', 0) or \
+                simultaneous_writes + simultaneous_reads + self.simultaneous_deletes + self.list_workers
+        resource_config['tcp_keepalive'] = config.getboolean('tcp_keepalive', True)
+        resource_config['connect_timeout'] = config.getfloat('connect_timeout', 60)
+        resource_config['read_timeout'] = config.getfloat('read_timeout', 60)
         #resource_config['parameter_validation'] = False
         #resource_config['use_accelerate_endpoint'] = True
 
@@ -96,7 +119,7 @@ class DataBackend(_DataBackend):
         self._read_queue = queue.Queue()
         self._read_data_queue = queue.Queue(self.read_queue_length)
 
-        self.bucket = self._get_bucket()  # for read_raw
+        self.client = self._get_client()  # thread safe, used by all threads
 
         self._writer_threads = []
         self._reader_threads = []
@@ -116,15 +139,6 @@ class DataBackend(_DataBackend):
             self.reader_thread_status[i] = STATUS_NOTHING
 
 
-    def _get_bucket(self):
-        session = boto3.session.Session()
-        if self._disable_encoding_type:
-            session.events.unregister('before-parameter-build.s3.ListObjects', set_list_objects_encoding_type_url)
-        resource = session.resource('s3', **self._resource_config)
-        bucket = resource.Bucket(self._bucket_name)
-        return bucket
-
-
     def _get_client(self):
         session = boto3.session.Session()
         if self._disable_encoding_type:
@@ -133,54 +147,66 @@ class DataBackend(_DataBackend):
         return client
 
 
+    def pool_status(self):
+        """ Returns statistics of the client's connection pools: the number
+        of requests, of new connections (i.e. the churn) and the ratio of
+        requests which reused an existing connection.
+        """
+        requests = connections = 0
+        try:
+            manager = self.client._endpoint.http_session._manager  # botocore internals
+            pools = [manager.pools[key] for key in manager.pools.keys()]
+        except (AttributeError, KeyError):
+            pools = []
+        for pool in pools:
+            requests += pool.num_requests
+            connections += pool.num_connections
+        return {
+            'requests': requests,
+            'connections': connections,
+            'reuse_ratio': 1 - connections / requests if requests else 0.0,
+        }
+
+
     def _writer(self, id_):
         """ A threaded background writer """
-        #bucket = None
-        client = None
         while True:
             self.writer_thread_status[id_] = STATUS_QUEUE
             entry = self._write_queue.get()
             self.writer_thread_status[id_] = STATUS_NOTHING
             if entry is None or self.last_exception:
+                segment = self._pack_flush(id_)
+                if entry is None and segment:
+                    self._write_blobs(id_, segment.key, segment.data, segment.callbacks)
                 logger.debug("Writer {} finishing.".format(id_))
                 break
-            if client is None:
-                client = self._get_client()
             uid, data, callback = entry
 
-            self.writer_thread_status[id_] = STATUS_THROTTLING
-            time.sleep(self.write_throttling.consume(len(data)))
-            self.writer_thread_status[id_] = STATUS_NOTHING
-
-            try:
-                self.writer_thread_status[id_] = STATUS_WRITING
-                client.put_object(Body=data, Key=uid, Bucket=self._bucket_name)
-                #client.upload_fileobj(io.BytesIO(data), Key=uid, Bucket=self._bucket_name)
-                self.writer_thread_status[id_] = STATUS_NOTHING
-                #if random.random() > 0.9:
-                #    raise ValueError("This is a test")
-            except Exception as e:
-                self.last_exception = e
-            else:
-                if callback:
-                    callback(uid)
+            if uid is None:  # packed
+                segment = self._pack(id_, data, callback)
                 self._write_queue.task_done()
+                if segment:
+                    self._write_blobs(id_, segment.key, segment.data, segment.callbacks)
+            elif self._write_blobs(id_, uid, self._encode(uid, data), [(callback, uid)]):
+                self._write_queue.task_done()
+
+
+    def _write_object(self, key, data):
+        self.client.put_object(Body=data, Key=key, Bucket=self._bucket_name)
+        #client.upload_fileobj(io.BytesIO(data), Key=uid, Bucket=self._bucket_name)
 
 
     def _reader(self, id_):
         """ A threaded background reader """
-        bucket = None
         while True:
             block = self._read_queue.get()  # contains block
             if block is None or self.last_exception:
                 logger.debug("Reader {} finishing.".format(id_))
                 break
-            if bucket is None:
-                bucket = self._get_bucket()
             t1 = time.time()
             try:
                 self.reader_thread_status[id_] = STATUS_READING
-                data = self.read_raw(block.uid, bucket)
+                data = self.read_raw(block.uid)
                 self.reader_thread_status[id_] = STATUS_NOTHING
                 #except FileNotFoundError:
             except Exception as e:
@@ -192,14 +218,13 @@ class DataBackend(_DataBackend):
                 logger.debug('Reader {} read data async. uid {} in {:.2f}s (Queue size is {})'.format(id_, block.uid, t2-t1, self._read_queue.qsize()))
 
 
-    def read_raw(self, block_uid, _bucket=None):
-        if not _bucket:
-            _bucket = self.bucket
-
+    def _read_object(self, key, offset=0, length=None):
+        kwargs = {'Bucket': self._bucket_name, 'Key': key}
+        if length is not None:
+            kwargs['Range'] = 'bytes={}-{}'.format(offset, offset + length - 1)
         while True:
-            obj = _bucket.Object(block_uid)
             try:
-                data_dict = obj.get()
+                data_dict = self.client.get_object(**kwargs)
                 data = data_dict['Body'].read()
             except ClientError as e:
                 if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
@@ -220,37 +245,189 @@ class DataBackend(_DataBackend):
                 pass
             else:
                 break
-        time.sleep(self.read_throttling.consume(len(data)))  # TODO: Need throttling in thread statistics!
+        if length is not None and len(data) != length:
+            raise ValueError('Key {} is too short: read {} bytes at offset {}, expected {}.'.format(
+                key, len(data), offset, length))
         return data
 
 
+    def close(self):
+        _DataBackend.close(self)
+        pool_status = self.pool_status()
+        if pool_status['requests']:
+            logger.info('S3 connection pool: {} requests on {} connections (reuse ratio {:.2f}).'.format(
+                pool_status['requests'],
+                pool_status['connections'],
+                pool_status['reuse_ratio'],
+                ))
+
+
     def rm(self, uid):
-        obj = self.bucket.Object(uid)
         try:
-            obj.load()
+            self.client.head_object(Bucket=self._bucket_name, Key=uid)
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
                 raise FileNotFoundError('Key {} not found.'.format(uid)) from None
             else:
                 raise
         else:
-            obj.delete()
+            self.client.delete_object(Bucket=self._bucket_name, Key=uid)
+
+
+    def _delete_objects(self, uids):
+        """ Deletes up to DELETE_BATCH_SIZE uids with a single request and
+        returns the uids which couldn't be deleted.
+        """
+        try:
+            response = self.client.delete_objects(
+                Bucket=self._bucket_name,
+                Delete={
+                    'Objects': [{'Key': uid} for uid in uids],
+                    'Quiet': True,  # only report errors
+                    },
+                )
+        except Exception as e:
+            logger.error('S3 batch deletion of {} objects failed: {}'.format(len(uids), e))
+            return list(uids)
+        no_del = []
+        for error in response.get('Errors', []):
+            logger.error('S3 object deletion error for {}: {} {}'.format(error['Key'], error['Code'], error['Message']))
+            no_del.append(error['Key'])
+        return no_del
 
 
     def rm_many(self, uids):
         """ Deletes many uids from the data backend and returns a list
         of uids that couldn't be deleted.
+        The uids are deleted in batches via DeleteObjects, which run
+        concurrently. Note that S3 reports success for keys which don't
+        exist.
         """
-        for uid in uids:
-            self.rm(uid)
-        # TODO: maybe use delete_objects
+        uids = list(uids)
+        batches = [uids[i:i+self.DELETE_BATCH_SIZE] for i in range(0, len(uids), self.DELETE_BATCH_SIZE)]
+        if not batches:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.simultaneous_deletes, len(batches))) as executor:
+            return list(chain.from_iterable(executor.map(self._delete_objects, batches)))
+
+
+    def _list_shards(self, prefix, after):
+        """ Splits the keys with prefix into list_shards ascending shards of
+        the form (after, until), i.e. the keys k with after < k <= until (None
+        is unbounded). Uids start with hex digits of a hash, so the shards
+        are of about the same size, but together they cover all keys.
+        Only the keys after after are included.
+        """
+        if self.list_shards == 256:
+            bounds = [prefix + a + b for a in self.HEX_DIGITS for b in self.HEX_DIGITS][1:]
+        else:
+            bounds = [prefix + c for c in self.HEX_DIGITS[1:self.list_shards]]
+        shards = []
+        for lower, upper in zip([None] + bounds, bounds + [None]):
+            if after is not None:
+                if upper is not None and upper <= after:
+                    continue
+                lower = after if lower is None else max(lower, after)
+            shards.append((lower, upper))
+        return shards
+
+
+    def _list_shard(self, prefix, after, until, pages, stop):
+        """ Puts the pages of keys of one shard into the queue pages,
+        followed by None. Exceptions are put into the queue, too.
+        """
+        def _put(item):
+            while not stop.is_set():  # nobody fetches the pages anymore
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
+        try:
+            paginator = self.client.get_paginator('list_objects')
+            kwargs = {'Bucket': self._bucket_name, 'Prefix': prefix}
+            if after is not None:
+                kwargs['Marker'] = after
+            for page in paginator.paginate(**kwargs):
+                keys = [o['Key'] for o in page.get('Contents', [])]
+                done = until is not None and keys and keys[-1] > until
+                if done:
+                    keys = [key for key in keys if key <= until]
+                if keys and not _put(keys):
+                    return
+                if done:
+                    break
+        except Exception as e:
+            _put(e)
+        _put(None)
+
+
+    def _read_list_checkpoint(self, prefix):
+        if not self.list_checkpoint:
+            return None
+        try:
+            with open(self.list_checkpoint, 'r') as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if checkpoint.get('prefix') != prefix:
+            return None
+        logger.info('Resuming the listing of {} after {}.'.format(self._bucket_name, checkpoint['after']))
+        return checkpoint['after']
+
+
+    def set_list_checkpoint(self, prefix, uid):
+        """ Writes the checkpoint (at most every LIST_CHECKPOINT_INTERVAL
+        seconds), so an interrupted listing with prefix resumes after uid.
+        uid None removes the checkpoint.
+        """
+        if not self.list_checkpoint:
+            return
+        prefix = prefix or ''
+        if uid is None:
+            if os.path.exists(self.list_checkpoint):
+                os.unlink(self.list_checkpoint)
+            return
+        if time.time() - self._t_list_checkpoint < self.LIST_CHECKPOINT_INTERVAL:
+            return
+        with open(self.list_checkpoint + '.tmp', 'w') as f:
+            json.dump({'prefix': prefix, 'after': uid}, f)
+        os.rename(self.list_checkpoint + '.tmp', self.list_checkpoint)
+        self._t_list_checkpoint = time.time()
 
-    def get_all_blob_uids(self, prefix=None):
-        if prefix is None:
-            objects_iterable = self.bucket.objects.all()
-        else:
-            objects_iterable = self.bucket.objects.filter(Prefix=prefix)
 
-        return [o.key for o in objects_iterable]
+    def get_all_blob_uids(self, prefix=None):
+        """ Yields all keys (with prefix) in ascending order. The key space
+        is split into shards which are listed concurrently by list_workers
+        threads, but yielded one after the other. Only LIST_AHEAD pages per
+        shard are buffered.
+        With list_checkpoint, the listing continues after the checkpoint
+        which the caller has set (see set_list_checkpoint).
+        """
+        prefix = prefix or ''
+        shards = self._list_shards(prefix, self._read_list_checkpoint(prefix))
+        self._t_list_checkpoint = time.time()
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=min(self.list_workers, len(shards)))
+        try:
+            # The executor starts the shards in order, so the shard which is
+            # consumed is always running.
+            shard_pages = []
+            for after, until in shards:
+                pages = queue.Queue(self.LIST_AHEAD)
+                executor.submit(self._list_shard, prefix, after, until, pages, stop)
+                shard_pages.append(pages)
+            for pages in shard_pages:
+                while True:
+                    keys = pages.get()
+                    if keys is None:
+                        break
+                    if isinstance(keys, Exception):
+                        raise keys
+                    yield from keys
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
 
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from backy2.data_backends import DataBackend as _DataBackend
+from backy2.data_backends import BLOB_MAGIC
+from backy2.logging import logger
+from backy2.utils import TokenBucket
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import asyncio
+import os
+import queue
+import threading
+import time
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+    from botocore.exceptions import ClientError
+except ImportError:
+    get_session = None
+
+
+class DataBackend(_DataBackend):
+    """ A DataBackend which stores in S3 compatible storages like
+    backy2.data_backends.s3, but performs all requests on a single asyncio
+    event loop instead of one blocking request per thread. So thousands of
+    requests can be in flight, which is needed to saturate object stores
+    with a high latency.
+    """
+
+    WRITE_QUEUE_LENGTH = 20
+    DELETE_BATCH_SIZE = 1000  # maximum number of keys per DeleteObjects request
+
+    last_exception = None
+
+    def __init__(self, config):
+        if get_session is None:
+            raise NotImplementedError('DataBackend s3async needs the python module aiobotocore.')
+        _DataBackend.__init__(self, config)
+        aws_access_key_id = config.get('aws_access_key_id')
+        if aws_access_key_id is None:
+            aws_access_key_id_file = config.get('aws_access_key_id_file')
+            with open(aws_access_key_id_file, 'r', encoding="ascii") as f:
+                aws_access_key_id = f.read().rstrip()
+
+        aws_secret_access_key = config.get('aws_secret_access_key')
+        if aws_secret_access_key is None:
+            aws_secret_access_key_file = config.get('aws_secret_access_key_file')
+            with open(aws_secret_access_key_file, 'r', encoding="ascii") as f:
+                aws_secret_access_key = f.read().rstrip()
+
+        region_name = config.get('region_name', '')
+        endpoint_url = config.get('endpoint_url', '')
+        use_ssl = config.get('use_ssl', '')
+        self._bucket_name = config.get('bucket_name', '')
+        addressing_style = config.get('addressing_style', '')
+        signature_version = config.get('signature_version', '')
+
+        self.simultaneous_writes = config.getint('simultaneous_writes', 100)
+        self.simultaneous_reads = config.getint('simultaneous_reads', 100)
+        self.simultaneous_deletes = config.getint('simultaneous_deletes', 10)
+        bandwidth_read = config.getint('bandwidth_read', 0)
+        bandwidth_write = config.getint('bandwidth_write', 0)
+
+        self.read_throttling = TokenBucket()
+        self.read_throttling.set_rate(bandwidth_read)  # 0 disables throttling
+        self.write_throttling = TokenBucket()
+        self.write_throttling.set_rate(bandwidth_write)  # 0 disables throttling
+
+        self._client_config = {
+            'aws_access_key_id': aws_access_key_id,
+            'aws_secret_access_key': aws_secret_access_key,
+        }
+
+        if region_name:
+            self._client_config['region_name'] = region_name
+
+        if endpoint_url:
+            self._client_config['endpoint_url'] = endpoint_url
+
+        if use_ssl:
+            self._client_config['use_ssl'] = use_ssl
+
+        client_config = {}
+        if addressing_style:
+            client_config['s3'] = {'addressing_style': addressing_style}
+
+        if signature_version:
+            client_config['signature_version'] = signature_version
+
+        client_config['max_pool_connections'] = config.getint('max_pool_connections', 0) or \
+                self.simultaneous_writes + self.simultaneous_reads + self.simultaneous_deletes
+        client_config['connect_timeout'] = config.getfloat('connect_timeout', 60)
+        client_config['read_timeout'] = config.getfloat('read_timeout', 60)
+
+        self._client_config['config'] = AioConfig(**client_config)
+
+        # Compression and encryption are CPU bound, so they run in threads
+        # instead of blocking the event loop.
+        self._executor = ThreadPoolExecutor(max_workers=config.getint('encode_workers', 0) or os.cpu_count() or 1)
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        self.client = self._run(self._create_client())
+
+        # The queues keep the contract (and the backpressure) of the other
+        # backends. A dispatcher thread for each of them starts a request on
+        # the event loop for each entry as long as there are free slots.
+        self.write_queue_length = self.simultaneous_writes + self.WRITE_QUEUE_LENGTH
+        self._write_queue = queue.Queue(self.write_queue_length)
+        self._read_queue = queue.Queue()
+        self._read_data_queue = queue.Queue()  # bounded by the read slots
+        self._write_slots = threading.BoundedSemaphore(self.simultaneous_writes)
+        self._read_slots = threading.BoundedSemaphore(self.simultaneous_reads)
+        self._writes_in_flight = 0
+        self._reads_in_flight = 0
+        self._closing = False
+
+        self._writer_threads = [threading.Thread(target=self._write_dispatcher)]
+        self._reader_threads = [threading.Thread(target=self._read_dispatcher)]
+        for _thread in self._writer_threads + self._reader_threads:
+            _thread.daemon = True
+            _thread.start()
+
+
+    def _run(self, coro):
+        """ Runs coro on the event loop and waits for its result """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+
+    async def _create_client(self):
+        self._client_context = get_session().create_client('s3', **self._client_config)
+        return await self._client_context.__aenter__()
+
+
+    def _write_dispatcher(self):
+        """ Starts a put request for each entry in the write queue. Each
+        request holds one of simultaneous_writes slots.
+        """
+        while True:
+            entry = self._write_queue.get()
+            if entry is None:
+                logger.debug("Write dispatcher finishing.")
+                self._write_queue.task_done()
+                break
+            if self.last_exception:
+                self._write_queue.task_done()  # drop, save() will raise
+                continue
+            self._write_slots.acquire()
+            uid, data, callback = entry
+            asyncio.run_coroutine_threadsafe(self._write(uid, data, callback), self._loop)
+
+
+    async def _write(self, uid, data, callback):
+        self._writes_in_flight += 1
+        try:
+            if self.codec or self.keyring:
+                data = await self._loop.run_in_executor(self._executor, self._encode, uid, data)
+            else:
+                data = self._encode(uid, data)  # cheap, only escapes data which looks like a header
+            await asyncio.sleep(self.write_throttling.consume(len(data)))
+            await self.client.put_object(Body=data, Key=uid, Bucket=self._bucket_name)
+        except Exception as e:
+            self.last_exception = e
+        else:
+            if callback:
+                callback(uid)
+        finally:
+            self._writes_in_flight -= 1
+            self._write_slots.release()
+            self._write_queue.task_done()
+
+
+    def _read_dispatcher(self):
+        """ Starts a get request for each block in the read queue. Each
+        request holds one of simultaneous_reads slots until its data has been
+        fetched by read_get.
+        """
+        while True:
+            block = self._read_queue.get()
+            if block is None or self.last_exception:
+                logger.debug("Read dispatcher finishing.")
+                break
+            # don't block forever if nobody fetches the data anymore
+            while not self._read_slots.acquire(timeout=1):
+                if self._closing:
+                    logger.debug("Read dispatcher finishing.")
+                    return
+            asyncio.run_coroutine_threadsafe(self._read(block), self._loop)
+
+
+    async def _read(self, block):
+        self._reads_in_flight += 1
+        t1 = time.time()
+        try:
+            data = await self._get_object(block.uid)
+            await asyncio.sleep(self.read_throttling.consume(len(data)))
+            if data[:len(BLOB_MAGIC)] == BLOB_MAGIC or self.keyring:
+                data = await self._loop.run_in_executor(self._executor, self._decode, block.uid, data)
+        except Exception as e:
+            self.last_exception = e
+            self._read_slots.release()
+        else:
+            self._read_data_queue.put((block, data))
+            t2 = time.time()
+            logger.debug('Read data async. uid {} in {:.2f}s (Queue size is {})'.format(block.uid, t2-t1, self._read_queue.qsize()))
+        finally:
+            self._reads_in_flight -= 1
+
+
+    async def _get_object(self, uid, offset=0, length=None):
+        kwargs = {'Bucket': self._bucket_name, 'Key': uid}
+        if length is not None:
+            kwargs['Range'] = 'bytes={}-{}'.format(offset, offset + length - 1)
+        try:
+            response = await self.client.get_object(**kwargs)
+            async with response['Body'] as stream:
+                data = await stream.read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                raise FileNotFoundError('Key {} not found.'.format(uid)) from None
+            else:
+                raise
+        if length is not None and len(data) != length:
+            raise ValueError('Key {} is too short: read {} bytes at offset {}, expected {}.'.format(
+                uid, len(data), offset, length))
+        return data
+
+
+    def read_get(self, timeout=30):
+        """
+        Returns (block, offset, length, data) from the event loop.
+        """
+        result = _DataBackend.read_get(self, timeout)
+        self._read_slots.release()
+        return result
+
+
+    def _read_object(self, key, offset=0, length=None):
+        return self._run(self._get_object(key, offset, length))
+
+
+    def rm(self, uid):
+        async def _rm():
+            try:
+                await self.client.head_object(Bucket=self._bucket_name, Key=uid)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                    raise FileNotFoundError('Key {} not found.'.format(uid)) from None
+                else:
+                    raise
+            await self.client.delete_object(Bucket=self._bucket_name, Key=uid)
+        self._run(_rm())
+
+
+    async def _delete_objects(self, uids, slots):
+        """ Deletes up to DELETE_BATCH_SIZE uids with a single request and
+        returns the uids which couldn't be deleted.
+        """
+        async with slots:
+            try:
+                response = await self.client.delete_objects(
+                    Bucket=self._bucket_name,
+                    Delete={
+                        'Objects': [{'Key': uid} for uid in uids],
+                        'Quiet': True,  # only report errors
+                        },
+                    )
+            except Exception as e:
+                logger.error('S3 batch deletion of {} objects failed: {}'.format(len(uids), e))
+                return list(uids)
+        no_del = []
+        for error in response.get('Errors', []):
+            logger.error('S3 object deletion error for {}: {} {}'.format(error['Key'], error['Code'], error['Message']))
+            no_del.append(error['Key'])
+        return no_del
+
+
+    def rm_many(self, uids):
+        """ Deletes many uids from the data backend and returns a list
+        of uids that couldn't be deleted.
+        The uids are deleted in batches via DeleteObjects, which run
+        concurrently. Note that S3 reports success for keys which don't
+        exist.
+        """
+        uids = list(uids)
+        batches = [uids[i:i+self.DELETE_BATCH_SIZE] for i in range(0, len(uids), self.DELETE_BATCH_SIZE)]
+
+        async def _rm_many():
+            slots = asyncio.Semaphore(self.simultaneous_deletes)
+            return await asyncio.gather(*[self._delete_objects(batch, slots) for batch in batches])
+        return list(chain.from_iterable(self._run(_rm_many())))
+
+
+    def get_all_blob_uids(self, prefix=None):
+        paginator = self.client.get_paginator('list_objects')
+        kwargs = {'Bucket': self._bucket_name}
+        if prefix is not None:
+            kwargs['Prefix'] = prefix
+        # S3 lists keys in ascending order. Pages are fetched one at a time,
+        # so only one of them is in memory.
+        pages = paginator.paginate(**kwargs).__aiter__()
+
+        async def _next_page():
+            return await pages.__anext__()
+        while True:
+            try:
+                page = self._run(_next_page())
+            except StopAsyncIteration:
+                return
+            for o in page.get('Contents', []):
+                yield o['Key']
+
+
+    def queue_status(self):
+        return {
+            'rq_filled': self._read_data_queue.qsize() / self.simultaneous_reads,  # 0..1
+            'wq_filled': self._write_queue.qsize() / self._write_queue.maxsize,
+        }
+
+
+    def thread_status(self):
+        return "DaBaR: F{} QL{}  DaBaW: F{} QL{}".format(
+                self._reads_in_flight,
+                self._read_queue.qsize(),
+                self._writes_in_flight,
+                self._write_queue.qsize(),
+                )
+
+
+    def close(self):
+        if self._closing:
+            return  # backup closes the data backend before Backy.close does
+        self._closing = True
+        self._write_queue.join()  # wait for the writes in flight
+        _DataBackend.close(self)  # ends the dispatchers
+        self._run(self._client_context.__aexit__(None, None, None))
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._executor.shutdown()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from backy2.hashing import MIN_CHECKSUM_LENGTH
+from backy2.logging import logger
+from collections import namedtuple
+import hashlib
+import math
+import time
+
+
+# What the map knows about a block; enough to reference its data.
+IndexedBlock = namedtuple('IndexedBlock', ['uid', 'size'])
+
+
+class BloomFilter():
+    """ A simple bloom filter. If a key is not in the filter, it has never been
+    added. If it is, it has been added with a probability of 1 - error_rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1000)
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+
+    def _positions(self, key):
+        if isinstance(key, str):
+            key = key.encode('ascii')
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class DedupIndex():
+    """ Answers dedup lookups (checksum -> block) for a backup run.
+    All valid checksums from the meta backend are preloaded into a map from
+    their first MIN_CHECKSUM_LENGTH bytes to (uid, size), so lookups never
+    reach the database. Keys are not shorter than the shortest checksums
+    backy stores, so they are just as collision safe. The map needs about
+    250 bytes of RAM per block, so it may be limited to max_mapped entries.
+    A bloom filter over all checksums then answers lookups for new data and
+    only probable hits of unmapped checksums are looked up in the database.
+    Blocks which are stored during this run must be added via add().
+    """
+
+    ERROR_RATE = 0.001
+
+    def __init__(self, meta_backend, block_writer, hash_function=None, additional_capacity=0, max_mapped=0):
+        self.meta_backend = meta_backend
+        self.block_writer = block_writer
+        self.hash_function = hash_function  # only find blocks checksummed with this
+        self.additional_capacity = additional_capacity
+        self.max_mapped = max_mapped  # 0: map all checksums
+        self.bloom_filter = None
+        self.blocks = {}  # checksum[:MIN_CHECKSUM_LENGTH] -> (uid, size)
+        self.mapped_all = True  # False once a checksum didn't fit into blocks
+        self.stats = {
+            'hits': 0,  # found in the pending batch, the map or in the database
+            'hits_mapped': 0,  # hits answered by the map
+            'misses': 0,  # not found at all
+            'misses_filtered': 0,  # misses answered by the map or bloom filter
+        }
+
+
+    def _map(self, checksum, uid, size):
+        if self.max_mapped and len(self.blocks) >= self.max_mapped:
+            self.mapped_all = False
+            return
+        self.blocks[checksum[:MIN_CHECKSUM_LENGTH]] = (uid, size)
+
+
+    def load(self):
+        t1 = time.time()
+        num_checksums = self.meta_backend.count_checksums(self.hash_function)
+        self.bloom_filter = BloomFilter(num_checksums + self.additional_capacity, self.ERROR_RATE)
+        for checksum, uid, size in self.meta_backend.get_all_checksum_blocks(self.hash_function):
+            self.bloom_filter.add(checksum)
+            self._map(checksum, uid, size)
+        t2 = time.time()
+        logger.debug('Loaded dedup index with {} checksums ({} mapped, {} bytes bloom filter) in {:.2f}s'.format(
+            num_checksums,
+            len(self.blocks),
+            len(self.bloom_filter.bits),
+            t2-t1,
+            ))
+        return self
+
+
+    def add(self, checksum, uid, size):
+        self.bloom_filter.add(checksum)
+        self._map(checksum, uid, size)
+
+
+    def get_block_by_checksum(self, checksum):
+        block = self.block_writer.get_block_by_checksum(checksum)
+        if block is None:
+            mapped = self.blocks.get(checksum[:MIN_CHECKSUM_LENGTH])
+            if mapped is not None:
+                self.stats['hits'] += 1
+                self.stats['hits_mapped'] += 1
+                return IndexedBlock(*mapped)
+            if self.mapped_all or checksum not in self.bloom_filter:
+                self.stats['misses'] += 1
+                self.stats['misses_filtered'] += 1
+                return None
+            block = self.meta_backend.get_block_by_checksum(checksum, self.hash_function)
+        if block is None:
+            self.stats['misses'] += 1
+        else:
+            self.stats['hits'] += 1
+        return block
+
+
+    def status(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return 'Dedup index: {} lookups, {} hits ({:.1f}%, {} from memory), {} misses ({} answered without database)'.format(
+            lookups,
+            self.stats['hits'],
+            self.stats['hits'] / lookups * 100 if lookups else 0.0,
+            self.stats['hits_mapped'],
+            self.stats['misses'],
+            self.stats['misses_filtered'],
+            )
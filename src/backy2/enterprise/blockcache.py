@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from backy2.logging import logger
+from collections import OrderedDict
+import json
+import mmap
+import os
+import threading
+
+
+class BlockCache():
+    """ A cache of blobs (by uid) with a memory tier in front of a disk tier,
+    each with its own byte budget and LRU eviction. Blobs evicted from memory
+    move to disk, blobs evicted from disk are dropped. Blobs never change, so
+    the disk tier is kept across restarts via an index file.
+    Only blobs which miss repeatedly are admitted (second hit), so a single
+    scan over a large image doesn't flush the cache.
+    The lock only guards the bookkeeping, files are written, read and
+    removed outside of it.
+    """
+
+    INDEX = 'index.json'
+    MISS_HISTORY = 10000  # number of recently missed uids which are remembered
+
+    def __init__(self, path, memory_size, disk_size):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory = OrderedDict()  # uid -> data, least recently used first
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # uid -> size, least recently used first
+        self._disk_bytes = 0
+        self._missed = OrderedDict()  # uid -> None
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits_memory': 0,
+            'hits_disk': 0,
+            'misses': 0,
+            'evictions_memory': 0,
+            'evictions_disk': 0,
+        }
+        os.makedirs(self.path, exist_ok=True)
+        self._load_index()
+
+
+    def _filename(self, uid):
+        return os.path.join(self.path, uid)
+
+
+    def _load_index(self):
+        """ Restores the disk tier from the index. Files without a valid
+        index entry (e.g. after a crash) are removed.
+        """
+        try:
+            with open(os.path.join(self.path, self.INDEX), 'r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = []
+        for uid, size in index:
+            try:
+                if os.path.getsize(self._filename(uid)) != size:
+                    continue
+            except FileNotFoundError:
+                continue
+            self._disk[uid] = size
+            self._disk_bytes += size
+        for filename in os.listdir(self.path):
+            if filename != self.INDEX and filename not in self._disk:
+                os.unlink(self._filename(filename))
+        self._unlink(self._evict_disk())
+        logger.debug('Block cache: Restored {} blobs ({} bytes) from {}'.format(
+            len(self._disk), self._disk_bytes, self.path))
+
+
+    def _write_index(self, index):
+        filename = os.path.join(self.path, self.INDEX)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(filename + '.tmp', filename)
+
+
+    def _evict_memory(self):
+        """ Returns the evicted (uid, data) which must be written to disk
+        via _put_disk (outside of the lock).
+        """
+        evicted = []
+        while self._memory_bytes > self.memory_size:
+            uid, data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(data)
+            self.stats['evictions_memory'] += 1
+            evicted.append((uid, data))
+        return evicted
+
+
+    def _put_disk(self, evicted):
+        """ Writes blobs to the disk tier. Must be called without the lock. """
+        for uid, data in evicted:
+            with self._lock:
+                if uid in self._disk or len(data) > self.disk_size:
+                    continue
+            filename = self._filename(uid)
+            # unique, as another thread may write the same uid meanwhile
+            tmp_filename = '{}.{}.tmp'.format(filename, threading.get_ident())
+            with open(tmp_filename, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_filename, filename)
+            with self._lock:
+                if uid in self._disk:
+                    continue
+                self._disk[uid] = len(data)
+                self._disk_bytes += len(data)
+                unlink_uids = self._evict_disk()
+            self._unlink(unlink_uids)
+
+
+    def _evict_disk(self):
+        """ Returns the evicted uids whose files must be removed via _unlink
+        (outside of the lock).
+        """
+        unlink_uids = []
+        while self._disk_bytes > self.disk_size:
+            uid, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.stats['evictions_disk'] += 1
+            unlink_uids.append(uid)
+        return unlink_uids
+
+
+    def _unlink(self, uids):
+        for uid in uids:
+            try:
+                os.unlink(self._filename(uid))
+            except FileNotFoundError:
+                pass
+
+
+    def _read_disk(self, uid, size, offset, length):
+        if size == 0:
+            return b''  # empty files can't be mapped
+        with open(self._filename(uid), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[offset:] if length is None else m[offset:offset + length]
+
+
+    def get(self, uid, offset=0, length=None):
+        """ Returns length bytes (or the rest) of blob uid from offset or
+        None if it's not cached.
+        """
+        with self._lock:
+            data = self._memory.get(uid)
+            if data is not None:
+                self._memory.move_to_end(uid)
+                self.stats['hits_memory'] += 1
+                return data[offset:] if length is None else data[offset:offset + length]
+            size = self._disk.get(uid)
+            if size is None:
+                self.stats['misses'] += 1
+                return None
+            self._disk.move_to_end(uid)
+        try:
+            data = self._read_disk(uid, size, offset, length)
+        except FileNotFoundError:
+            # evicted meanwhile (and maybe removed after being put again)
+            with self._lock:
+                if self._disk.pop(uid, None) is not None:
+                    self._disk_bytes -= size
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['hits_disk'] += 1
+        return data
+
+
+    def __contains__(self, uid):
+        with self._lock:
+            return uid in self._memory or uid in self._disk
+
+
+    def admit(self, uid):
+        """ Records a miss of uid and returns True if it has been missed
+        recently, i.e. it should be put into the cache.
+        """
+        with self._lock:
+            if uid in self._missed:
+                del self._missed[uid]
+                return True
+            self._missed[uid] = None
+            if len(self._missed) > self.MISS_HISTORY:
+                self._missed.popitem(last=False)
+            return False
+
+
+    def put(self, uid, data):
+        with self._lock:
+            if uid in self._memory:
+                return
+            self._memory[uid] = data
+            self._memory_bytes += len(data)
+            evicted = self._evict_memory()
+        self._put_disk(evicted)
+
+
+    def status(self):
+        """ Returns the metrics and the current fill of the cache """
+        with self._lock:
+            lookups = self.stats['hits_memory'] + self.stats['hits_disk'] + self.stats['misses']
+            status = dict(self.stats)
+            status.update({
+                'memory_blobs': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_blobs': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'hit_ratio': (lookups - self.stats['misses']) / lookups if lookups else 0.0,
+            })
+            return status
+
+
+    def close(self):
+        """ Moves the memory tier to disk and writes the index """
+        with self._lock:
+            evicted = list(self._memory.items())
+            self._memory.clear()
+            self._memory_bytes = 0
+        self._put_disk(evicted)
+        with self._lock:
+            index = list(self._disk.items())
+        self._write_index(index)
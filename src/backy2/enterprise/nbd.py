@@ -1,9 +1,200 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+from backy2.enterprise.blockcache import BlockCache
+from backy2.hashing import get_hash_function
 from backy2.logging import logger
-from io import BytesIO
+from backy2.utils import RangeSet
+from array import array
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import math
 import os
+import threading
+import time
+
+
+class Readahead():
+    """ Tracks the reads of one nbd connection. When they are sequential,
+    the following blocks are prefetched into the store's cache in the
+    background.
+    The window (the number of blocks fetched ahead) adapts to the observed
+    throughput: It's the number of blocks the client reads while one block
+    is being fetched (i.e. the bandwidth-delay product), doubled to absorb
+    jitter, and bounded by max_blocks.
+    """
+
+    SEQUENTIAL_READS = 2  # sequential reads before readahead starts
+    SMOOTHING = 0.2  # weight of new samples in the moving averages
+
+    def __init__(self, store, version_uid, max_blocks):
+        self.store = store
+        self.version_uid = version_uid
+        self.block_size = store.backy.block_size
+        self.max_blocks = max_blocks
+        self.sequential = 0
+        self.next_offset = None
+        self.last_read = None
+        self.read_rate = None  # bytes/s of sequential reads
+        self.fetch_time = None  # s per prefetched block
+        self.prefetched_until = 0  # first block id which hasn't been prefetched
+
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.SMOOTHING * (sample - average)
+
+
+    def window(self):
+        """ Returns the number of blocks to fetch ahead """
+        if not self.read_rate or self.fetch_time is None:
+            return 1
+        blocks = math.ceil(self.read_rate * self.fetch_time / self.block_size) * 2
+        return max(1, min(blocks, self.max_blocks))
+
+
+    def _fetched(self, future):
+        fetch_time = future.result() if not future.exception() else None
+        if fetch_time is not None:
+            self.fetch_time = self._average(self.fetch_time, fetch_time)
+
+
+    def read(self, offset, length):
+        """ Called for each read of the connection """
+        now = time.time()
+        if offset == self.next_offset:
+            self.sequential += 1
+            dt = now - self.last_read
+            if dt > 0:
+                self.read_rate = self._average(self.read_rate, length / dt)
+        else:
+            self.sequential = 0
+            self.prefetched_until = 0
+        self.next_offset = offset + length
+        self.last_read = now
+        if self.sequential < self.SEQUENTIAL_READS or not self.max_blocks:
+            return
+        next_block = (offset + length) // self.block_size
+        first = max(next_block, self.prefetched_until)
+        last = next_block + self.window()
+        for block_id in range(first, last):
+            future = self.store.prefetch(self.version_uid, block_id)
+            if future:
+                future.add_done_callback(self._fetched)
+        self.prefetched_until = max(self.prefetched_until, last)
+
+
+Block = namedtuple('Block', 'id uid size')
+
+
+class BlockMap():
+    """ The blocks of a version by id, loaded lazily from the meta backend
+    in windows of WINDOW blocks. Each window is stored as arrays of fixed
+    width uids and sizes instead of ORM objects, and only the MAX_WINDOWS
+    most recently used windows are kept. So opening even a huge version
+    is instant and needs little memory.
+    """
+
+    WINDOW = 16384  # blocks
+    MAX_WINDOWS = 64
+    UID_LENGTH = 32
+
+    def __init__(self, meta_backend, version_uid, num_blocks, block_size):
+        self.meta_backend = meta_backend
+        self.version_uid = version_uid
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self._windows = OrderedDict()  # window number -> (uids, sizes)
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return self.num_blocks
+
+
+    def _load(self, window):
+        first_id = window * self.WINDOW
+        # missing blocks are sparse
+        uids = bytearray(self.WINDOW * self.UID_LENGTH)
+        sizes = array('q', [self.block_size]) * self.WINDOW
+        for id_, uid, size in self.meta_backend.get_block_window(self.version_uid, first_id, first_id + self.WINDOW):
+            i = id_ - first_id
+            if uid is not None:
+                uids[i * self.UID_LENGTH:(i + 1) * self.UID_LENGTH] = uid.encode('ascii').ljust(self.UID_LENGTH, b'\0')
+            sizes[i] = size
+        logger.debug('Loaded blocks {}-{} of version {}'.format(first_id, first_id + self.WINDOW - 1, self.version_uid))
+        return uids, sizes
+
+
+    def _window(self, window):
+        with self._lock:
+            if window in self._windows:
+                self._windows.move_to_end(window)
+                return self._windows[window]
+        data = self._load(window)
+        with self._lock:
+            self._windows[window] = data
+            if len(self._windows) > self.MAX_WINDOWS:
+                self._windows.popitem(last=False)
+        return data
+
+
+    def __getitem__(self, block_id):
+        if not 0 <= block_id < self.num_blocks:
+            raise IndexError('Block {} is beyond the end of version {}'.format(block_id, self.version_uid))
+        uids, sizes = self._window(block_id // self.WINDOW)
+        i = block_id % self.WINDOW
+        uid = bytes(uids[i * self.UID_LENGTH:(i + 1) * self.UID_LENGTH]).rstrip(b'\0')
+        return Block(block_id, uid.decode('ascii') if uid else None, sizes[i])
+
+
+class CowOverlay():
+    """ The changes to a cow version. Written data is stored at its offset
+    in a sparse local file and the written extents of each block are
+    tracked, so original blocks are only fetched when the unwritten parts
+    of partially written blocks are read (or fixated).
+    """
+
+    def __init__(self, path, block_size, hash_function):
+        self.path = path
+        self.block_size = block_size
+        self.hash_function = hash_function
+        self.dirty = {}  # block id -> RangeSet of written offsets in the block
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+
+    def write(self, block_id, offset, data):
+        os.pwrite(self._fd, data, block_id * self.block_size + offset)
+        with self._lock:
+            self.dirty.setdefault(block_id, RangeSet()).add(offset, offset + len(data))
+
+
+    def written(self, block_id, offset, length):
+        """ Returns the written (start, end) extents within offset and
+        offset + length of a block.
+        """
+        end = offset + length
+        with self._lock:
+            if block_id not in self.dirty:
+                return []
+            return [(max(_start, offset), min(_end, end)) for _start, _end in self.dirty[block_id].ranges()
+                    if _start < end and _end > offset]
+
+
+    def read(self, block_id, offset, length):
+        return os.pread(self._fd, length, block_id * self.block_size + offset)
+
+
+    def block_ids(self):
+        with self._lock:
+            return sorted(self.dirty)
+
+
+    def close(self):
+        os.close(self._fd)
+        os.unlink(self.path)
 
 
 class BackyStore():
@@ -11,13 +202,41 @@ class BackyStore():
     Also has a COW method.
     """
 
-    def __init__(self, backy, cachedir, hash_function):
+    CACHE_MEMORY_SIZE = 256*1024*1024
+    CACHE_DISK_SIZE = 4*1024*1024*1024
+
+    READAHEAD_BLOCKS = 16
+    READAHEAD_WORKERS = 4
+
+    FIXATE_WORKERS = 8
+    FIXATE_PROGRESS_INTERVAL = 10  # seconds
+
+    def __init__(self, backy, cachedir, cache_memory_size=None, cache_disk_size=None,
+            readahead_blocks=None, readahead_workers=None, fixate_workers=None):
         self.backy = backy
         self.cachedir = cachedir
-        self.hash_function = hash_function
-        self.blocks = {}  # block list cache by version
-        self.block_cache = set()
-        self.cow = {}  # contains version_uid: dict() of block id -> uid
+        self.blocks = {}  # BlockMap by version
+        self.cache = BlockCache(
+                os.path.join(cachedir, 'backy2-blockcache'),
+                self.CACHE_MEMORY_SIZE if cache_memory_size is None else cache_memory_size,
+                self.CACHE_DISK_SIZE if cache_disk_size is None else cache_disk_size,
+                )
+        self.cow = {}  # CowOverlay by version
+        # Connections and fixations using a version. Its BlockMap and overlay
+        # are kept until the last of them releases it.
+        self._users = {}  # version uid -> number of users
+        self._users_lock = threading.Lock()
+        self.readahead_blocks = self.READAHEAD_BLOCKS if readahead_blocks is None else readahead_blocks
+        self._readahead_executor = ThreadPoolExecutor(
+                max_workers=readahead_workers or self.READAHEAD_WORKERS)
+        self._prefetching = set()  # uids
+        self._prefetching_lock = threading.Lock()
+        self._fixate_executor = ThreadPoolExecutor(
+                max_workers=fixate_workers or self.FIXATE_WORKERS)
+        # read, write, get_cow_version, fixate_data and fixate are called
+        # from other threads. get_cow_version and fixate use their own meta
+        # backend sessions. All other methods use the meta backend and so
+        # must be called from the thread which created it.
 
 
     def get_versions(self):
@@ -28,11 +247,15 @@ class BackyStore():
         return self.backy.meta_backend.get_version(uid)
 
 
+    def _get_blocks(self, version_uid):
+        if version_uid not in self.blocks:
+            self.blocks[version_uid] = BlockMap(self.backy.meta_backend, version_uid,
+                    self.get_version(version_uid).size, self.backy.block_size)
+        return self.blocks[version_uid]
+
+
     def _block_list(self, version_uid, offset, length):
-        # get cached blocks data
-        if not self.blocks.get(version_uid):
-            self.blocks[version_uid] = self.backy.meta_backend.get_blocks_by_version(version_uid).all()
-        blocks = self.blocks[version_uid]
+        blocks = self._get_blocks(version_uid)
 
         block_number = offset // self.backy.block_size
         block_offset = offset % self.backy.block_size
@@ -51,13 +274,9 @@ class BackyStore():
                 read_list.append((None, 0, length))  # hint: return \0s
             else:
                 assert block.id == block_number
-                if block.uid is None:
-                    block = None
-                    read_length = length
-                    read_list.append((None, 0, length))  # hint: return \0s
-                else:
-                    read_length = min(block.size-block_offset, length)
-                    read_list.append((block, block_offset, read_length))
+                # sparse blocks have no uid
+                read_length = min(block.size-block_offset, length)
+                read_list.append((block, block_offset, read_length))
             block_number += 1
             block_offset = 0
             length -= read_length
@@ -69,82 +288,189 @@ class BackyStore():
 
 
     def _read(self, block_uid, offset=0, length=None):
-        if block_uid not in self.block_cache:
-            data = self.backy.data_backend.read_raw(block_uid)
-            open(os.path.join(self.cachedir, block_uid), 'wb').write(data)
-            self.block_cache.add(block_uid)
-        with open(os.path.join(self.cachedir, block_uid), 'rb') as f:
-            f.seek(offset)
-            if length is None:
-                return f.read()
-            else:
-                return f.read(length)
+        data = self.cache.get(block_uid, offset, length)
+        if data is not None:
+            return data
+        if not self.cache.admit(block_uid):
+            # cold read, fetch only the requested range
+            return self.backy.data_backend.read_raw(block_uid, offset, length)
+        data = self.backy.data_backend.read_raw(block_uid)
+        self.cache.put(block_uid, data)
+        return data[offset:] if length is None else data[offset:offset + length]
+
+
+    def _read_block(self, overlay, block, offset, length):
+        """ Reads from a block with the changes in overlay (if any) applied """
+        written = overlay.written(block.id, offset, length) if overlay else []
+        if written == [(offset, offset + length)]:
+            return overlay.read(block.id, offset, length)
+        if block.uid is None:
+            data = b'\0'*length
+        else:
+            data = self._read(block.uid, offset, length)
+        if not written:
+            return data
+        data = bytearray(data)
+        for start, end in written:
+            data[start - offset:end - offset] = overlay.read(block.id, start, end - start)
+        return bytes(data)
+
+
+    def _sparse(self, overlay, block, offset, length):
+        if block is None:
+            return True  # beyond the end
+        return block.uid is None and not (overlay and overlay.written(block.id, offset, length))
+
+
+    def open_version(self, version_uid):
+        """ Registers a connection using version_uid and returns a Readahead
+        for it. The connection must call release_version when it's done.
+        """
+        # reads and writes must not query the meta backend's session
+        size = self.get_version(version_uid).size
+        with self._users_lock:
+            self._users[version_uid] = self._users.get(version_uid, 0) + 1
+            if version_uid not in self.blocks:
+                self.blocks[version_uid] = BlockMap(self.backy.meta_backend, version_uid, size, self.backy.block_size)
+        return Readahead(self, version_uid, self.readahead_blocks)
+
+
+    def release_version(self, version_uid):
+        """ Releases a version from open_version (or the fixation of a cow
+        version). The last user removes its BlockMap and overlay, so a cow
+        version's overlay stays readable until it's fixated and no
+        connection reads it anymore.
+        """
+        with self._users_lock:
+            self._users[version_uid] -= 1
+            if self._users[version_uid]:
+                return
+            del self._users[version_uid]
+            self.blocks.pop(version_uid, None)  # the fixated blocks have new uids
+            overlay = self.cow.pop(version_uid, None)
+        if overlay is not None:
+            overlay.close()
+
+
+    def _prefetch(self, block_uid):
+        try:
+            t1 = time.time()
+            self.cache.put(block_uid, self.backy.data_backend.read_raw(block_uid))
+            return time.time() - t1
+        finally:
+            with self._prefetching_lock:
+                self._prefetching.discard(block_uid)
+
+
+    def prefetch(self, version_uid, block_id):
+        """ Fetches a block of version_uid into the cache in the background.
+        Returns a future of the seconds it took or None if the block is
+        sparse, beyond the end or already cached.
+        """
+        blocks = self.blocks[version_uid]
+        if block_id >= len(blocks):
+            return None
+        block_uid = blocks[block_id].uid
+        if block_uid is None or block_uid in self.cache:
+            return None
+        with self._prefetching_lock:
+            if block_uid in self._prefetching:
+                return None
+            self._prefetching.add(block_uid)
+        return self._readahead_executor.submit(self._prefetch, block_uid)
+
+
+    def read_chunks(self, version_uid, offset, length):
+        """ Reads like read, but returns a list of (offset, length, data)
+        with data None for sparse regions. Adjacent regions of the same kind
+        are merged.
+        """
+        overlay = self.cow.get(version_uid)
+        chunks = []  # [offset, length, list of data or None]
+        for block, block_offset, read_length in self._block_list(version_uid, offset, length):
+            logger.debug('Reading block {}:{}:{}'.format(block, block_offset, read_length))
+            if not read_length:
+                continue
+            sparse = self._sparse(overlay, block, block_offset, read_length)
+            if not chunks or (chunks[-1][2] is None) != sparse:
+                chunks.append([offset, 0, None if sparse else []])
+            chunks[-1][1] += read_length
+            if not sparse:
+                chunks[-1][2].append(self._read_block(overlay, block, block_offset, read_length))
+            offset += read_length
+        return [(offset, length, None if data is None else b''.join(data)) for offset, length, data in chunks]
 
 
     def read(self, version_uid, offset, length):
-        read_list = self._block_list(version_uid, offset, length)
-        data = []
-        for block, offset, length in read_list:
-            logger.debug('Reading block {}:{}:{}'.format(block, offset, length))
-            if block is None:
-                data.append(b'\0'*length)
+        return b''.join(b'\0'*length if data is None else data
+                for offset, length, data in self.read_chunks(version_uid, offset, length))
+
+
+    def extents(self, version_uid, offset, length):
+        """ Returns the allocation of a range as a list of (length, sparse).
+        Adjacent extents of the same kind are merged.
+        """
+        overlay = self.cow.get(version_uid)
+        extents = []
+        for block, block_offset, read_length in self._block_list(version_uid, offset, length):
+            if not read_length:
+                continue
+            sparse = self._sparse(overlay, block, block_offset, read_length)
+            if extents and extents[-1][1] == sparse:
+                extents[-1] = (extents[-1][0] + read_length, sparse)
             else:
-                data.append(self._read(block.uid, offset, length))
-        return b''.join(data)
+                extents.append((read_length, sparse))
+        return extents
 
 
     def get_cow_version(self, from_version):
-        cow_version_uid = self.backy.meta_backend.copy_version(from_version.uid, from_version.name, 'copy on write')
-        self.cow[cow_version_uid] = {}  # contains version_uid: dict() of block id -> uid
+        """ Creates a cow version of from_version. It's used by its fixation
+        until that's done (see release_version).
+        """
+        meta_backend = self.backy.meta_backend.clone()
+        try:
+            cow_version_uid = meta_backend.copy_version(from_version.uid, from_version.name, 'copy on write')
+        finally:
+            meta_backend.close()
+        overlay = CowOverlay(
+                os.path.join(self.cachedir, 'backy2-cow-{}'.format(cow_version_uid)),
+                self.backy.block_size,
+                # the cow version has been copied from the original one and so
+                # must use its hash function.
+                get_hash_function(from_version.hash_function),
+                )
+        with self._users_lock:
+            self.cow[cow_version_uid] = overlay
+            self._users[cow_version_uid] = 1
         return cow_version_uid
 
 
-    def _update(self, block_uid, data, offset=0):
-        # update a given block_uid
-        if self.backy.data_backend._SUPPORTS_PARTIAL_WRITES:
-            return self.backy.data_backend.update(block_uid, data, offset)
-        else:
-            # update local copy
-            with open(os.path.join(self.cachedir, block_uid), 'r+b') as f:
-                f.seek(offset)
-                return f.write(data)
-
-
-    def _save(self, data):
-        # update a given block_uid
-        if self.backy.data_backend._SUPPORTS_PARTIAL_WRITES:
-            return self.backy.data_backend.save(data, _sync=True)  # returns block uid
-        else:
-            new_uid = self.backy.data_backend._uid()
-            with open(os.path.join(self.cachedir, new_uid), 'wb') as f:
-                f.write(data)
-            self.block_cache.add(new_uid)
-            return new_uid
-
-
     def write(self, version_uid, offset, data):
         """ Copy on write backup writer """
-        dataio = BytesIO(data)
-        cow = self.cow[version_uid]
-        write_list = self._block_list(version_uid, offset, len(data))
-        for block, _offset, length in write_list:
-            if block is None:
+        overlay = self.cow[version_uid]
+        blocks = self._get_blocks(version_uid)
+        data = memoryview(data)
+        while data:
+            block_id, block_offset = divmod(offset, self.backy.block_size)
+            try:
+                length = min(blocks[block_id].size - block_offset, len(data))
+            except IndexError:
+                length = 0
+            if length <= 0:
                 logger.warning('Tried to save data beyond device (offset {})'.format(offset))
-                continue  # raise? That'd be a write outside the device...
-            if block.id in cow:
-                # the block is already copied, so update it.
-                block_uid = cow[block.id]
-                self._update(block_uid, dataio.read(length), _offset)
-                logger.debug('Updated cow changed block {} into {})'.format(block.id, block_uid))
-            else:
-                # read the block from the original, update it and write it back
-                write_data = BytesIO(self.backy.data_backend.read_raw(block.uid))
-                write_data.seek(_offset)
-                write_data.write(dataio.read(length))
-                write_data.seek(0)
-                block_uid = self._save(write_data.read())
-                cow[block.id] = block_uid
-                logger.debug('Wrote cow changed block {} into {})'.format(block.id, block_uid))
+                break  # raise? That'd be a write outside the device...
+            overlay.write(block_id, block_offset, data[:length])
+            offset += length
+            data = data[length:]
+
+
+    def write_zeroes(self, version_uid, offset, length):
+        """ Writes length zeroes at offset, at most one block at a time """
+        while length:
+            write_length = min(length, self.backy.block_size - offset % self.backy.block_size)
+            self.write(version_uid, offset, b'\0'*write_length)
+            offset += write_length
+            length -= write_length
 
 
     def flush(self):
@@ -152,41 +478,61 @@ class BackyStore():
         pass
 
 
-    def fixate(self, cow_version_uid):
-        # save blocks into version
-        logger.info('Fixating version {} with {} blocks (PLEASE WAIT)'.format(
-            cow_version_uid,
-            len(self.cow[cow_version_uid].items())
-            ))
-        for block_id, block_uid in self.cow[cow_version_uid].items():
-            logger.debug('Fixating block {} uid {}'.format(block_id, block_uid))
-            data = self._read(block_uid)
-            checksum = self.hash_function(data).hexdigest()
-            if not self.backy.data_backend._SUPPORTS_PARTIAL_WRITES:
-                # dump changed data
-                new_uid = self.backy.data_backend.save(data, _sync=True)
-                logger.debug('Stored block {} with local uid {} to uid {}'.format(block_id, block_uid, new_uid))
-                block_uid = new_uid
-
-            self.backy.meta_backend.set_block(block_id, cow_version_uid, block_uid, checksum, len(data), valid=1, _commit=False)
-        self.backy.meta_backend.set_version_valid(cow_version_uid)
-        self.backy.meta_backend._commit()
-        logger.info('Fixation done. Deleting temporary data (PLEASE WAIT)')
-        # TODO: Delete COW blocks and also those from block_cache
-        if self.backy.data_backend._SUPPORTS_PARTIAL_WRITES:
-            for block_uid in self.block_cache:
-                # TODO if this block is in the current version (and in no other?)
-                # rm this block from cache
-                # rm block uid from self.block_cache
-                pass
-            for block_id, block_uid in self.cow[cow_version_uid].items():
-                # TODO: rm block_uid from cache
-                pass
-        else:
-            # backends that support partial writes will be written to directly.
-            # So there's no need to cleanup.
-            pass
-        del(self.cow[cow_version_uid])
-        logger.info('Finished.')
+    def _fixate_block(self, overlay, block):
+        data = self._read_block(overlay, block, 0, block.size)
+        checksum = overlay.hash_function(data).digest()[:self.backy.checksum_length]
+        block_uid = self.backy.data_backend.save(data, _sync=True)
+        logger.debug('Stored block {} to uid {}'.format(block.id, block_uid))
+        return block.id, block_uid, checksum, len(data)
+
+
+    def fixate_data(self, cow_version_uid):
+        """ Stores the changed blocks of a cow version in the data backend
+        (fixate_workers in parallel) and returns (block id, uid, checksum,
+        size) for each of them. This doesn't use the meta backend, so it can
+        run in the background.
+        """
+        overlay = self.cow[cow_version_uid]
+        blocks = self._get_blocks(cow_version_uid)
+        block_ids = overlay.block_ids()
+        logger.info('Fixating version {} with {} blocks'.format(cow_version_uid, len(block_ids)))
+        result = []
+        t_progress = time.time()
+        for fixated in self._fixate_executor.map(lambda block_id: self._fixate_block(overlay, blocks[block_id]), block_ids):
+            result.append(fixated)
+            if time.time() - t_progress >= self.FIXATE_PROGRESS_INTERVAL:
+                t_progress = time.time()
+                logger.info('Fixating version {}: {}/{} blocks ({:.1f}%)'.format(
+                    cow_version_uid, len(result), len(block_ids), len(result) / len(block_ids) * 100))
+        return result
+
+
+    def fixate(self, cow_version_uid, blocks=None):
+        """ Writes the blocks from fixate_data (which is called if they
+        aren't given) to the cow version, marks it valid and releases it.
+        Connections which still read it keep using the overlay on top of
+        the original blocks, which is the same data.
+        """
+        if blocks is None:
+            blocks = self.fixate_data(cow_version_uid)
+        meta_backend = self.backy.meta_backend.clone()
+        try:
+            for block_id, block_uid, checksum, size in blocks:
+                meta_backend.set_block(block_id, cow_version_uid, block_uid, checksum, size, valid=1, _commit=False)
+            meta_backend.set_version_valid(cow_version_uid)
+            meta_backend._commit()
+        finally:
+            meta_backend.close()
+        self.release_version(cow_version_uid)
+        logger.info('Fixation of version {} done.'.format(cow_version_uid))
+
+
+    def close(self):
+        self._readahead_executor.shutdown()
+        self._fixate_executor.shutdown()
+        self.cache.close()
+        logger.info('Block cache: {hits_memory} memory hits, {hits_disk} disk hits, {misses} misses '
+            '(hit ratio {hit_ratio:.2f}), {evictions_memory} memory evictions, {evictions_disk} disk evictions.'.format(
+                **self.cache.status()))
 
 
@@ -29,9 +29,13 @@ THE SOFTWARE.
 import struct
 import logging
 import math
+import os
 
+import errno
 import signal
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 class AbortedNegotiationError(IOError):
     pass
@@ -51,53 +55,223 @@ class Server(object):
     NBD_OPT_EXPORTNAME = 1
     NBD_OPT_ABORT = 2
     NBD_OPT_LIST = 3
+    NBD_OPT_INFO = 6
+    NBD_OPT_GO = 7
+    NBD_OPT_STRUCTURED_REPLY = 8
+    NBD_OPT_LIST_META_CONTEXT = 9
+    NBD_OPT_SET_META_CONTEXT = 10
 
     NBD_REP_ACK = 1
     NBD_REP_SERVER = 2
+    NBD_REP_INFO = 3
+    NBD_REP_META_CONTEXT = 4
     NBD_REP_ERR_UNSUP = 2**31 + 1
+    NBD_REP_ERR_INVALID = 2**31 + 3
+    NBD_REP_ERR_UNKNOWN = 2**31 + 6
+
+    NBD_INFO_EXPORT = 0
 
     NBD_CMD_READ = 0
     NBD_CMD_WRITE = 1
     NBD_CMD_DISC = 2
     NBD_CMD_FLUSH = 3
-
-    # fixed newstyle handshake
-    NBD_HANDSHAKE_FLAGS = (1 << 0)
-
-    # has flags, supports flush
-    NBD_EXPORT_FLAGS = (1 << 0) ^ (1 << 2)
+    NBD_CMD_TRIM = 4
+    NBD_CMD_WRITE_ZEROES = 6
+    NBD_CMD_BLOCK_STATUS = 7
+
+    NBD_CMD_FLAG_DF = (1 << 2)
+    NBD_CMD_FLAG_REQ_ONE = (1 << 3)
+
+    NBD_STRUCTURED_REPLY = 0x668e33ef
+    NBD_REPLY_FLAG_DONE = (1 << 0)
+    NBD_REPLY_TYPE_NONE = 0
+    NBD_REPLY_TYPE_OFFSET_DATA = 1
+    NBD_REPLY_TYPE_OFFSET_HOLE = 2
+    NBD_REPLY_TYPE_BLOCK_STATUS = 5
+    NBD_REPLY_TYPE_ERROR = 2**15 + 1
+
+    # the only metadata context. Its block status reports sparse blocks as
+    # holes which read as zeroes.
+    BASE_ALLOCATION = 'base:allocation'
+    BASE_ALLOCATION_ID = 1
+    NBD_STATE_HOLE = (1 << 0)
+    NBD_STATE_ZERO = (1 << 1)
+
+    # fixed newstyle handshake, no zeroes
+    NBD_HANDSHAKE_FLAGS = (1 << 0) ^ (1 << 1)
+    NBD_FLAG_C_NO_ZEROES = (1 << 1)
+
+    # has flags, supports flush, trim and write zeroes
+    NBD_EXPORT_FLAGS = (1 << 0) ^ (1 << 2) ^ (1 << 5) ^ (1 << 6)
     NBD_RO_FLAG = (1 << 1)
+    NBD_DF_FLAG = (1 << 7)
+    NBD_MULTI_CONN_FLAG = (1 << 8)
 
 
-    def __init__(self, addr, store, read_only=True):
+    # requests which are processed concurrently per connection
+    MAX_IN_FLIGHT = 64
+
+    def __init__(self, addr, store, read_only=True, workers=8):
         self.log = logging.getLogger(__package__)
 
         self.address = addr
         self.store = store
         self.read_only = read_only
+        # reads, writes, flushes and creating cow versions block, so they run
+        # in these threads. The other store methods use the meta backend,
+        # which must stay in the event loop's thread.
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.fixations = set()  # tasks
+        # cow version uid -> future, which is done when the cow version has
+        # been fixated (result True) or its fixation failed (False).
+        self.fixated = {}
+
+
+    async def run(self, f, *args):
+        """ Runs the blocking f(*args) in the executor """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(f, *args))
+
+
+    async def request(self, writer, host, port, handle, slots, reply, f, *args):
+        """ Processes a request and sends its result (or error) with
+        reply(writer, handle, result, error). The reply may overtake the
+        replies of earlier requests.
+        """
+        try:
+            try:
+                result = await self.run(f, *args)
+            except Exception as ex:
+                self.log.error("[%s:%s] %s" % (host, port, ex))
+                await reply(writer, handle, error=getattr(ex, 'errno', None) or errno.EIO)
+            else:
+                await reply(writer, handle, result)
+        except (ConnectionError, RuntimeError) as ex:
+            self.log.error("[%s:%s] Unable to reply: %s" % (host, port, ex))
+        finally:
+            slots.release()
+
+
+    async def fixate(self, cow_version_uid):
+        """ Fixates a cow version in the background, so the client doesn't
+        wait for it.
+        """
+        fixated = False
+        try:
+            # the store uses its own meta backend session for this
+            await asyncio.get_running_loop().run_in_executor(None, self.store.fixate, cow_version_uid)
+            fixated = True
+        except Exception as ex:
+            self.log.error("Fixation of version %s failed: %s" % (cow_version_uid, ex))
+        finally:
+            # a failed fixation stays known, so no cow version is made
+            # from the unfixated version.
+            future = self.fixated.pop(cow_version_uid) if fixated else self.fixated[cow_version_uid]
+            future.set_result(fixated)
 
 
-    @asyncio.coroutine
-    def nbd_response(self, writer, handle, error=0, data=None):
+    async def nbd_response(self, writer, handle, data=None, error=0):
         writer.write(struct.pack('>LLQ', self.NBD_RESPONSE, error, handle))
         if data:
             writer.write(data)
-        yield from writer.drain()
-
-
-    @asyncio.coroutine
-    def handler(self, reader, writer):
+        await writer.drain()
+
+
+    def nbd_structured_reply(self, writer, handle, reply_type, *payload, done=True):
+        writer.write(struct.pack('>LHHQL', self.NBD_STRUCTURED_REPLY, self.NBD_REPLY_FLAG_DONE if done else 0,
+            reply_type, handle, sum(len(p) for p in payload)))
+        for p in payload:
+            writer.write(p)
+
+
+    async def nbd_error_reply(self, writer, handle, error):
+        message = os.strerror(error).encode('utf-8')
+        self.nbd_structured_reply(writer, handle, self.NBD_REPLY_TYPE_ERROR,
+            struct.pack('>LH', error, len(message)), message)
+        await writer.drain()
+
+
+    async def nbd_read_reply(self, writer, handle, chunks=None, error=0, df=False):
+        """ Sends the (offset, length, data) chunks of a read as structured
+        reply. Sparse chunks (data None) are sent as holes unless the client
+        doesn't allow fragmentation (df).
+        """
+        if error:
+            return await self.nbd_error_reply(writer, handle, error)
+        if df and chunks:
+            chunks = [(chunks[0][0], None, b''.join(b'\0'*length if data is None else data
+                for offset, length, data in chunks))]
+        if not chunks:
+            self.nbd_structured_reply(writer, handle, self.NBD_REPLY_TYPE_NONE)
+        for i, (offset, length, data) in enumerate(chunks):
+            done = i == len(chunks) - 1
+            if data is None:
+                self.nbd_structured_reply(writer, handle, self.NBD_REPLY_TYPE_OFFSET_HOLE,
+                    struct.pack('>QL', offset, length), done=done)
+            else:
+                self.nbd_structured_reply(writer, handle, self.NBD_REPLY_TYPE_OFFSET_DATA,
+                    struct.pack('>Q', offset), data, done=done)
+        await writer.drain()
+
+
+    async def nbd_block_status_reply(self, writer, handle, extents=None, error=0, req_one=False):
+        """ Sends the (length, sparse) extents of base:allocation """
+        if not error and not extents:
+            error = errno.EINVAL
+        if error:
+            return await self.nbd_error_reply(writer, handle, error)
+        if req_one:
+            extents = extents[:1]
+        self.nbd_structured_reply(writer, handle, self.NBD_REPLY_TYPE_BLOCK_STATUS,
+            struct.pack('>L', self.BASE_ALLOCATION_ID),
+            *[struct.pack('>LL', length, self.NBD_STATE_HOLE ^ self.NBD_STATE_ZERO if sparse else 0)
+                for length, sparse in extents])
+        await writer.drain()
+
+
+    async def nbd_option_reply(self, writer, opt, reply, data=b''):
+        writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, reply, len(data)))
+        writer.write(data)
+        await writer.drain()
+
+
+    def _unpack_string(self, data, pos):
+        """ Returns the string with a 32 bit length at pos and the position
+        after it.
+        """
+        (length, ) = struct.unpack_from(">L", data, pos)
+        pos += 4
+        if pos + length > len(data):
+            raise struct.error("string exceeds the option data")
+        return data[pos:pos + length].decode("utf-8"), pos + length
+
+
+    def export_flags(self, structured):
+        export_flags = self.NBD_EXPORT_FLAGS
+        if structured:
+            export_flags ^= self.NBD_DF_FLAG
+        if self.read_only:
+            # every connection writes to its own cow version, so only
+            # read only exports are consistent across connections.
+            export_flags ^= self.NBD_RO_FLAG ^ self.NBD_MULTI_CONN_FLAG
+        return export_flags
+
+
+    async def handler(self, reader, writer):
         """Handle the connection"""
+        in_flight = set()  # tasks
+        opened = []  # versions to release
+        slots = asyncio.Semaphore(self.MAX_IN_FLIGHT)
         try:
             host, port = writer.get_extra_info("peername")
             version, cow_version_uid = None, None
+            structured, base_allocation = False, False
             self.log.info("Incoming connection from %s:%s" % (host,port))
 
             # initial handshake
             writer.write(b"NBDMAGIC" + struct.pack(">QH", self.NBD_HANDSHAKE, self.NBD_HANDSHAKE_FLAGS))
-            yield from writer.drain()
+            await writer.drain()
 
-            data = yield from reader.readexactly(4)
+            data = await reader.readexactly(4)
             try:
                 client_flag = struct.unpack(">L", data)[0]
             except struct.error:
@@ -111,10 +285,11 @@ class Server(object):
                 fixed = True
             else:
                 raise IOError("Handshake failed, disconnecting")
+            no_zeroes = client_flag & self.NBD_FLAG_C_NO_ZEROES
 
             # negotiation phase
             while True:
-                header = yield from reader.readexactly(16)
+                header = await reader.readexactly(16)
                 try:
                     (magic, opt, length) = struct.unpack(">QLL", header)
                 except struct.error as ex:
@@ -124,11 +299,11 @@ class Server(object):
                     raise IOError("Negotiation failed: bad magic number: %s" % magic)
 
                 if length:
-                    data = yield from reader.readexactly(length)
+                    data = await reader.readexactly(length)
                     if(len(data) != length):
                         raise IOError("Negotiation failed: %s bytes expected" % length)
                 else:
-                    data = None
+                    data = b''
 
                 self.log.debug("[%s:%s]: opt=%s, len=%s, data=%s" % (host, port, opt, length, data))
 
@@ -142,45 +317,92 @@ class Server(object):
                             raise IOError("Negotiation failed: unknown export name")
 
                         writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ERR_UNSUP, 0))
-                        yield from writer.drain()
+                        await writer.drain()
                         continue
 
                     # we have negotiated a version and it will be used
                     # until the client disconnects
                     version = self.store.get_version(data)
 
-                    self.log.info("[%s:%s] Negotiated export: %s" % (host, port, version.uid))
-
-                    export_flags = self.NBD_EXPORT_FLAGS
-                    if self.read_only:
-                        export_flags ^= self.NBD_RO_FLAG
-                        self.log.info("nbd is read only.")
-                    else:
-                        self.log.info("nbd is read/write.")
-
                     # in case size_bytes is not %4096, we need to extend it to match
                     # block sizes.
                     size_bytes = math.ceil(version.size_bytes/4096)*4096
-                    writer.write(struct.pack('>QH', size_bytes, export_flags))
-                    writer.write(b"\x00"*124)
-                    yield from writer.drain()
+                    writer.write(struct.pack('>QH', size_bytes, self.export_flags(structured)))
+                    if not no_zeroes:
+                        writer.write(b"\x00"*124)
+                    await writer.drain()
 
                     break
 
+                elif opt in (self.NBD_OPT_INFO, self.NBD_OPT_GO):
+                    try:
+                        name, pos = self._unpack_string(data, 0)
+                        struct.unpack_from(">H", data, pos)  # requested information, we send the export only
+                    except (struct.error, UnicodeDecodeError):
+                        await self.nbd_option_reply(writer, opt, self.NBD_REP_ERR_INVALID)
+                        continue
+                    if name not in [v.uid for v in self.store.get_versions()]:
+                        await self.nbd_option_reply(writer, opt, self.NBD_REP_ERR_UNKNOWN)
+                        continue
+
+                    _version = self.store.get_version(name)
+                    size_bytes = math.ceil(_version.size_bytes/4096)*4096
+                    await self.nbd_option_reply(writer, opt, self.NBD_REP_INFO,
+                        struct.pack('>HQH', self.NBD_INFO_EXPORT, size_bytes, self.export_flags(structured)))
+                    await self.nbd_option_reply(writer, opt, self.NBD_REP_ACK)
+                    if opt == self.NBD_OPT_GO:
+                        version = _version
+                        break
+
+                elif opt == self.NBD_OPT_STRUCTURED_REPLY:
+                    if data:
+                        await self.nbd_option_reply(writer, opt, self.NBD_REP_ERR_INVALID)
+                        continue
+                    structured = True
+                    await self.nbd_option_reply(writer, opt, self.NBD_REP_ACK)
+
+                elif opt in (self.NBD_OPT_LIST_META_CONTEXT, self.NBD_OPT_SET_META_CONTEXT):
+                    try:
+                        if opt == self.NBD_OPT_SET_META_CONTEXT and not structured:
+                            raise ValueError("structured replies have not been negotiated")
+                        name, pos = self._unpack_string(data, 0)
+                        (num_queries, ) = struct.unpack_from(">L", data, pos)
+                        pos += 4
+                        queries = []
+                        for i in range(num_queries):
+                            query, pos = self._unpack_string(data, pos)
+                            queries.append(query)
+                    except (struct.error, ValueError):
+                        await self.nbd_option_reply(writer, opt, self.NBD_REP_ERR_INVALID)
+                        continue
+                    if name not in [v.uid for v in self.store.get_versions()]:
+                        await self.nbd_option_reply(writer, opt, self.NBD_REP_ERR_UNKNOWN)
+                        continue
+
+                    if opt == self.NBD_OPT_LIST_META_CONTEXT:
+                        # no queries or the namespace list all contexts
+                        match = not queries or any(q in (self.BASE_ALLOCATION, 'base:') for q in queries)
+                    else:
+                        match = base_allocation = self.BASE_ALLOCATION in queries
+                    if match:
+                        await self.nbd_option_reply(writer, opt, self.NBD_REP_META_CONTEXT,
+                            struct.pack('>L', self.BASE_ALLOCATION_ID) + self.BASE_ALLOCATION.encode("utf-8"))
+                    await self.nbd_option_reply(writer, opt, self.NBD_REP_ACK)
+
                 elif opt == self.NBD_OPT_LIST:
                     for _version in self.store.get_versions():
                         writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_SERVER, len(_version.uid) + 4))
                         version_encoded = _version.uid.encode("utf-8")
                         writer.write(struct.pack(">L", len(version_encoded)))
                         writer.write(version_encoded)
-                        yield from writer.drain()
+                        await writer.drain()
 
                     writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ACK, 0))
-                    yield from writer.drain()
+                    await writer.drain()
 
                 elif opt == self.NBD_OPT_ABORT:
                     writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ACK, 0))
-                    yield from writer.drain()
+                    await writer.drain()
 
                     raise AbortedNegotiationError()
                 else:
@@ -189,63 +411,112 @@ class Server(object):
                         raise IOError("Unsupported option")
 
                     writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ERR_UNSUP, 0))
-                    yield from writer.drain()
+                    await writer.drain()
+
+            # the version has been negotiated and it will be used until the
+            # client disconnects
+            readahead = self.store.open_version(version.uid)
+            opened.append(version.uid)
+            self.log.info("[%s:%s] Negotiated export: %s%s" % (host, port, version.uid,
+                " (structured replies)" if structured else ""))
+            if self.read_only:
+                self.log.info("nbd is read only.")
+            else:
+                self.log.info("nbd is read/write.")
 
             # operation phase
             while True:
-                header = yield from reader.readexactly(28)
+                header = await reader.readexactly(28)
                 try:
-                    (magic, cmd, handle, offset, length) = struct.unpack(">LLQQL", header)
+                    (magic, flags, cmd, handle, offset, length) = struct.unpack(">LHHQQL", header)
                 except struct.error:
                     raise IOError("Invalid request, disconnecting")
 
                 if magic != self.NBD_REQUEST:
                     raise IOError("Bad magic number, disconnecting")
 
-                self.log.debug("[%s:%s]: cmd=%s, handle=%s, offset=%s, len=%s" % (host, port, cmd, handle, offset, length))
+                self.log.debug("[%s:%s]: cmd=%s, flags=%s, handle=%s, offset=%s, len=%s" % (host, port, cmd, flags, handle, offset, length))
 
                 if cmd == self.NBD_CMD_DISC:
                     self.log.info("[%s:%s] disconnecting" % (host, port))
                     break
 
-                elif cmd == self.NBD_CMD_WRITE:
-                    data = yield from reader.readexactly(length)
-                    if(len(data) != length):
-                        raise IOError("%s bytes expected, disconnecting" % length)
-                    if not cow_version_uid:
-                        cow_version_uid = self.store.get_cow_version(version)
-                    try:
-                        self.store.write(cow_version_uid, offset, data)
-                    # TODO: Fix exception
-                    except Exception as ex:
-                        self.log.error("[%s:%s] %s" % (host, port, ex))
-                        yield from self.nbd_response(writer, handle, error=ex.errno)
+                elif cmd in (self.NBD_CMD_WRITE, self.NBD_CMD_WRITE_ZEROES, self.NBD_CMD_TRIM):
+                    if cmd == self.NBD_CMD_WRITE:
+                        data = await reader.readexactly(length)
+                        if(len(data) != length):
+                            raise IOError("%s bytes expected, disconnecting" % length)
+                    if self.read_only:
+                        await self.nbd_response(writer, handle, error=errno.EPERM)
                         continue
-
-                    yield from self.nbd_response(writer, handle)
+                    if cmd == self.NBD_CMD_TRIM:
+                        # trimming is advisory and the data stays as it is.
+                        await self.nbd_response(writer, handle)
+                        continue
+                    if not cow_version_uid:
+                        fixated = self.fixated.get(version.uid)
+                        if fixated is not None:
+                            # this is a cow version whose changes are still
+                            # in its overlay. A copy would lose them.
+                            self.log.info("[%s:%s] Waiting for the fixation of %s" % (host, port, version.uid))
+                            await asyncio.wait([fixated])
+                            if not fixated.result():
+                                self.log.error("[%s:%s] Version %s could not be fixated, refusing to write" % (host, port, version.uid))
+                                await self.nbd_response(writer, handle, error=errno.EIO)
+                                continue
+                        # copies the version's metadata, so it mustn't block the loop
+                        cow_version_uid = await self.run(self.store.get_cow_version, version)
+                        self.fixated[cow_version_uid] = asyncio.get_running_loop().create_future()
+                        readahead = self.store.open_version(cow_version_uid)
+                        opened.append(cow_version_uid)
+                    await slots.acquire()
+                    if cmd == self.NBD_CMD_WRITE:
+                        task = asyncio.ensure_future(self.request(writer, host, port, handle, slots,
+                            self.nbd_response, self.store.write, cow_version_uid, offset, data))
+                    else:
+                        task = asyncio.ensure_future(self.request(writer, host, port, handle, slots,
+                            self.nbd_response, self.store.write_zeroes, cow_version_uid, offset, length))
 
                 elif cmd == self.NBD_CMD_READ:
-                    try:
-                        if cow_version_uid:
-                            data = self.store.read(cow_version_uid, offset, length)
+                    readahead.read(offset, length)
+                    await slots.acquire()
+                    if structured:
+                        # sparse regions are sent as holes
+                        task = asyncio.ensure_future(self.request(writer, host, port, handle, slots,
+                            partial(self.nbd_read_reply, df=flags & self.NBD_CMD_FLAG_DF),
+                            self.store.read_chunks, cow_version_uid or version.uid, offset, length))
+                    else:
+                        task = asyncio.ensure_future(self.request(writer, host, port, handle, slots,
+                            self.nbd_response, self.store.read, cow_version_uid or version.uid, offset, length))
+
+                elif cmd == self.NBD_CMD_BLOCK_STATUS:
+                    if not base_allocation:
+                        if structured:
+                            await self.nbd_error_reply(writer, handle, errno.EINVAL)
                         else:
-                            data = self.store.read(version.uid, offset, length)
-                    # TODO: Fix exception
-                    except Exception as ex:
-                        self.log.error("[%s:%s] %s" % (host, port, ex))
-                        yield from self.nbd_response(writer, handle, error=ex.errno)
+                            await self.nbd_response(writer, handle, error=errno.EINVAL)
                         continue
-
-                    yield from self.nbd_response(writer, handle, data=data)
+                    await slots.acquire()
+                    task = asyncio.ensure_future(self.request(writer, host, port, handle, slots,
+                        partial(self.nbd_block_status_reply, req_one=flags & self.NBD_CMD_FLAG_REQ_ONE),
+                        self.store.extents, cow_version_uid or version.uid, offset, length))
 
                 elif cmd == self.NBD_CMD_FLUSH:
-                    self.store.flush()
-                    yield from self.nbd_response(writer, handle)
+                    # all writes which have been replied to before must be
+                    # flushed, so wait for those in flight.
+                    if in_flight:
+                        await asyncio.wait(in_flight)
+                    await slots.acquire()
+                    task = asyncio.ensure_future(self.request(writer, host, port, handle, slots,
+                        self.nbd_response, self.store.flush))
 
                 else:
                     self.log.warning("[%s:%s] Unknown cmd %s, disconnecting" % (host, port, cmd))
                     break
 
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
         except AbortedNegotiationError:
             self.log.info("[%s:%s] Client aborted negotiation" % (host, port))
 
@@ -253,8 +524,14 @@ class Server(object):
             self.log.error("[%s:%s] %s" % (host, port, ex))
 
         finally:
+            if in_flight:
+                await asyncio.wait(in_flight)
+            for version_uid in opened:
+                self.store.release_version(version_uid)
             if cow_version_uid:
-                self.store.fixate(cow_version_uid)
+                fixation = asyncio.ensure_future(self.fixate(cow_version_uid))
+                self.fixations.add(fixation)
+                fixation.add_done_callback(self.fixations.discard)
             writer.close()
 
 
@@ -262,8 +539,9 @@ class Server(object):
         """Create and run the asyncio loop"""
         addr, port = self.address
 
-        loop = asyncio.get_event_loop()
-        coro = asyncio.start_server(self.handler, addr, port, loop=loop)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        coro = asyncio.start_server(self.handler, addr, port)
         server = loop.run_until_complete(coro)
 
         loop.add_signal_handler(signal.SIGTERM, loop.stop)
@@ -273,5 +551,9 @@ class Server(object):
 
         server.close()
         loop.run_until_complete(server.wait_closed())
+        if self.fixations:
+            self.log.info("Waiting for %s fixations to finish" % len(self.fixations))
+            loop.run_until_complete(asyncio.wait(self.fixations))
         loop.close()
+        self.executor.shutdown()
 
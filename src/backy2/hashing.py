@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from backy2.logging import logger
+from concurrent.futures import Future
+import hashlib
+import os
+import queue
+import threading
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+STATUS_NOTHING = 0
+STATUS_HASHING = 1
+
+DEFAULT_HASH_FUNCTION = 'sha512'
+
+# Deduplication trusts the checksums, so shorter (truncated) checksums would
+# merge different blocks whose checksums collide.
+MIN_CHECKSUM_LENGTH = 16
+
+# Hash functions by name. The name is stored with each version, so a name
+# must never be reused for a different algorithm.
+HASH_FUNCTIONS = {
+    'sha512': hashlib.sha512,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+if blake3 is not None:
+    HASH_FUNCTIONS['blake3'] = blake3.blake3
+if xxhash is not None:
+    HASH_FUNCTIONS['xxh128'] = xxhash.xxh3_128
+
+
+def get_hash_function(name):
+    """ Returns the hash function (a hashlib compatible constructor) for
+    name. Other algorithms from hashlib (e.g. sha384) are still accepted, as
+    they could be configured before.
+    """
+    try:
+        return HASH_FUNCTIONS[name]
+    except KeyError:
+        if name in hashlib.algorithms_guaranteed and not name.startswith('shake_'):
+            return getattr(hashlib, name)
+        raise NotImplementedError('Hash function {} unsupported (missing module?). Available: {}'.format(
+            name,
+            ', '.join(sorted(HASH_FUNCTIONS)),
+            ))
+
+
+_zeroes = {}
+_zeroes_lock = threading.Lock()
+
+
+def zeroes(size):
+    """ Returns a (cached) buffer of size zero bytes. This is called from
+    many threads (e.g. the hash workers).
+    """
+    with _zeroes_lock:
+        buffer = _zeroes.get(size)
+        if buffer is None:
+            if len(_zeroes) > 16:  # only block_size and a few tails are expected
+                _zeroes.clear()
+            buffer = _zeroes[size] = bytes(size)
+        return buffer
+
+
+def is_zero(data):
+    """ Returns True if data consists of zero bytes only. This compares
+    against a cached buffer (i.e. memcmp) instead of allocating one for each
+    block.
+    """
+    return data == zeroes(len(data))
+
+
+class HashPool():
+    """ A pool of threads computing checksums. hashlib releases the GIL for
+    larger buffers, so this scales with the number of cores.
+    Jobs are added via submit(data, payload) and results are returned
+    unordered as (payload, digest) tuples by get(). Other threads (e.g. the
+    io readers during backup) can also wait for a digest via digest(data).
+    """
+
+    QUEUE_LENGTH = 20
+
+    def __init__(self, hash_function, workers=None):
+        self.hash_function = hash_function
+        self.workers = workers or os.cpu_count() or 1
+        self.pending = 0  # number of submitted but not yet fetched jobs
+        self._inqueue = queue.Queue(self.workers + self.QUEUE_LENGTH)
+        self._outqueue = queue.Queue()  # only contains payloads and digests
+        self._worker_threads = []
+        self.worker_thread_status = {}
+        for i in range(self.workers):
+            _worker_thread = threading.Thread(target=self._worker, args=(i,))
+            _worker_thread.daemon = True
+            _worker_thread.start()
+            self._worker_threads.append(_worker_thread)
+            self.worker_thread_status[i] = STATUS_NOTHING
+
+
+    def _worker(self, id_):
+        """ self._inqueue contains (data, payload, future) to be hashed.
+        self._outqueue contains (payload, digest) of the jobs without future.
+        """
+        while True:
+            entry = self._inqueue.get()
+            if entry is None:
+                logger.debug("Hash worker {} finishing.".format(id_))
+                self._inqueue.task_done()
+                break
+            data, payload, future = entry
+            self.worker_thread_status[id_] = STATUS_HASHING
+            digest = self.hash_function(data).digest()
+            self.worker_thread_status[id_] = STATUS_NOTHING
+            if future is not None:
+                future.set_result(digest)
+            else:
+                self._outqueue.put((payload, digest))
+            self._inqueue.task_done()
+
+
+    def submit(self, data, payload=None):
+        """ Adds a hash job. Blocks when all workers are busy and the queue
+        is full.
+        """
+        self._inqueue.put((data, payload, None))
+        self.pending += 1
+
+
+    def digest(self, data):
+        """ Returns the digest of data once a worker has computed it. This
+        may be called from any thread.
+        """
+        future = Future()
+        self._inqueue.put((data, None, future))
+        return future.result()
+
+
+    def get(self, block=True, timeout=None):
+        """ Returns (payload, digest) of a finished job. Raises queue.Empty
+        if block is False or timeout is reached and no result is available.
+        """
+        result = self._outqueue.get(block=block, timeout=timeout)
+        self._outqueue.task_done()
+        self.pending -= 1
+        return result
+
+
+    def finished(self):
+        """ Yields all results which are available without waiting. """
+        while self.pending:
+            try:
+                yield self.get(block=False)
+            except queue.Empty:
+                break
+
+
+    def drain(self):
+        """ Yields all outstanding results, waiting for them. """
+        while self.pending:
+            yield self.get()
+
+
+    def queue_status(self):
+        return {
+            'hq_filled': self._inqueue.qsize() / self._inqueue.maxsize,  # 0..1
+        }
+
+
+    def thread_status(self):
+        return "HASH: N{} H{} QL{}".format(
+                len([t for t in self.worker_thread_status.values() if t==STATUS_NOTHING]),
+                len([t for t in self.worker_thread_status.values() if t==STATUS_HASHING]),
+                self._inqueue.qsize(),
+                )
+
+
+    def close(self):
+        for _worker_thread in self._worker_threads:
+            self._inqueue.put(None)  # ends the threads
+        for _worker_thread in self._worker_threads:
+            _worker_thread.join()
@@ -3,10 +3,19 @@
 
 class IO():
 
+    hash_pool = None  # computes the checksums of read blocks if set
+
     def __init__(self, config, block_size, hash_function):
         pass
 
 
+    def digest(self, data):
+        """ Returns the checksum of a read block """
+        if self.hash_pool is not None:
+            return self.hash_pool.digest(data)
+        return self.hash_function(data).digest()
+
+
     def open(self, io_name, mode='r', force=False):
         """ Prepare and check anything needed by the ios,
         possibly open files and start threads. If mode is 'w', then
@@ -39,6 +48,15 @@ class IO():
         raise NotImplementedError()
 
 
+    def changed_extents(self, from_snapshot=None):
+        """ Yield (offset, length, exists) tuples of the regions which changed
+        since from_snapshot (or of all allocated regions if from_snapshot is
+        None), in the same format as hints. Only ios which can compute
+        differences natively implement this.
+        """
+        raise NotImplementedError()
+
+
     def queue_status(self):
         return {
             'rq_filled': 0.0,
@@ -112,7 +112,7 @@ class IO(_IO):
 
     def _reader(self, id_):
         """ self._inqueue contains block_ids to be read.
-        self._outqueue contains (block_id, data, data_checksum)
+        self._outqueue contains (block_id, data, data_checksum, metadata)
         """
         while True:
             entry = self._inqueue.get()
@@ -135,7 +135,7 @@ class IO(_IO):
                 if not data:
                     raise RuntimeError('EOF reached on source when there should be data.')
 
-                data_checksum = self.hash_function(data).hexdigest()
+                data_checksum = self.digest(data)
 
                 self._outqueue.put((block_id, data, data_checksum, metadata))
             self._inqueue.task_done()
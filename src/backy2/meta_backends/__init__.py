@@ -7,9 +7,11 @@ class MetaBackend():
     def __init__(self):
         pass
 
-    def set_version(self, version_name, snapshot_name, size, size_bytes):
+    def set_version(self, version_name, snapshot_name, size, size_bytes, valid, protected=0, hash_function='sha512'):
         """ Creates a new version with a given name and snapshot_name.
         size is the number of blocks this version will contain.
+        hash_function is the name of the hash function used for the
+        checksums of this version's blocks.
         Returns a uid for this version.
         """
         raise NotImplementedError()
@@ -79,6 +81,15 @@ class MetaBackend():
         raise NotImplementedError()
 
 
+    def get_block_writer(self):
+        """ Returns a block writer which buffers blocks and stores them in
+        batches. It has the methods add(id, version_uid, block_uid, checksum,
+        size, valid), get_block_by_checksum(checksum) for blocks which are
+        not yet stored and flush().
+        """
+        raise NotImplementedError()
+
+
     def set_blocks_invalid(self, uid, checksum):
         """ Set blocks pointing to this block uid with the given checksum invalid.
         This happens, when a block is found invalid during read or scrub.
@@ -86,8 +97,11 @@ class MetaBackend():
         raise NotImplementedError()
 
 
-    def get_block_by_checksum(self, checksum):
-        """ Get a block by its checksum. This is useful for deduplication """
+    def get_block_by_checksum(self, checksum, hash_function=None):
+        """ Get a block by its checksum. This is useful for deduplication.
+        If hash_function is given, only blocks of versions using this hash
+        function are found.
+        """
         raise NotImplementedError()
 
 
@@ -101,6 +115,26 @@ class MetaBackend():
         raise NotImplementedError()
 
 
+    def get_blocks_by_version_paged(self, version_uid):
+        """ Yields the blocks of a version ordered by id. Unlike
+        get_blocks_by_version, no cursor stays open between the pages, so
+        blocks may be written while iterating.
+        """
+        raise NotImplementedError()
+
+
+    def get_block_window(self, version_uid, first_id, last_id):
+        """ Returns (id, uid, size) of the blocks of a version with
+        first_id <= id < last_id. Must be callable from any thread.
+        """
+        raise NotImplementedError()
+
+
+    def get_block_id_ranges_by_version(self, version_uid):
+        """ Returns the ids of all blocks of a version as a RangeSet """
+        raise NotImplementedError()
+
+
     def rm_version(self, version_uid):
         """ Remove a version from the meta data store """
         raise NotImplementedError()
@@ -111,7 +145,37 @@ class MetaBackend():
 
 
     def get_all_block_uids(self, prefix=None):
-        """ Get all block uids existing in the meta data store """
+        """ Yields all (distinct) block uids existing in the meta data store
+        in ascending (byte) order.
+        """
+        raise NotImplementedError()
+
+
+    def update_block_uids(self, uid_map):
+        """ Replaces the uids of blocks (dict old uid -> new uid) after their
+        data has been moved. The old uids become delete candidates.
+        """
+        raise NotImplementedError()
+
+
+    def count_checksums(self, hash_function=None):
+        """ Returns the number of valid blocks with a checksum (of versions
+        using hash_function if given)
+        """
+        raise NotImplementedError()
+
+
+    def get_all_checksums(self, hash_function=None):
+        """ Yields the checksums of all valid blocks (of versions using
+        hash_function if given). May contain duplicates.
+        """
+        raise NotImplementedError()
+
+
+    def get_all_checksum_blocks(self, hash_function=None):
+        """ Yields (checksum, uid, size) of all valid blocks (of versions using
+        hash_function if given). May contain duplicates.
+        """
         raise NotImplementedError()
 
 
@@ -123,6 +187,13 @@ class MetaBackend():
         raise NotImplementedError()
 
 
+    def clone(self):
+        """ Returns a meta backend on the same database with its own session,
+        so it may be used from another thread. It must be closed when done.
+        """
+        raise NotImplementedError()
+
+
     def close(self):
         pass
 
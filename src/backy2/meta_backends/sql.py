@@ -2,13 +2,16 @@
 # -*- encoding: utf-8 -*-
 from backy2.logging import logger
 from backy2.meta_backends import MetaBackend as _MetaBackend
+from backy2.utils import RangeSet
+from backy2.utils import grouper
 from collections import namedtuple
-from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey
-from sqlalchemy import func, distinct, desc
+from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey, LargeBinary
+from sqlalchemy import func, distinct, desc, exists
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, query
 from sqlalchemy.sql import text
 from sqlalchemy.types import DateTime, Date
+import copy
 import csv
 import datetime
 import os
@@ -18,7 +21,7 @@ import time
 import uuid
 
 
-METADATA_VERSION = '2.10'
+METADATA_VERSION = '2.11'
 
 DELETE_CANDIDATE_MAYBE = 0
 DELETE_CANDIDATE_SURE = 1
@@ -57,6 +60,7 @@ class Version(Base):
     size_bytes = Column(BigInteger, nullable=False)
     valid = Column(Integer, nullable=False)
     protected = Column(Integer, nullable=False)
+    hash_function = Column(String(32), nullable=False, server_default='sha512', default='sha512')
     tags = sqlalchemy.orm.relationship(
             "Tag",
             backref="version",
@@ -86,7 +90,7 @@ class Block(Base):
     version_uid = Column(String(36), ForeignKey('versions.uid'), primary_key=True, nullable=False)
     id = Column(Integer, primary_key=True, nullable=False)
     date = Column("date", DateTime , default=func.now(), nullable=False)
-    checksum = Column(String(128), index=True, nullable=True)
+    checksum = Column(LargeBinary(64), index=True, nullable=True)
     size = Column(BigInteger, nullable=True)
     valid = Column(Integer, nullable=False)
 
@@ -129,15 +133,90 @@ class DeletedBlock(Base):
                             self.id, self.uid)
 
 
+class BlockWriter():
+    """ Collects blocks and inserts them in bulk. A batch is committed when it
+    reaches batch_size blocks or when commit_interval seconds have passed since
+    the last commit.
+    Only add blocks whose data is already stored in the data backend. Then a
+    crash loses at most the uncommitted batch and the version can still be
+    continued.
+    """
+
+    def __init__(self, meta_backend, batch_size, commit_interval):
+        self.meta_backend = meta_backend
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._blocks = []
+        self._checksums = {}  # checksum -> block of the pending batch (for dedup)
+        self._last_commit = time.time()
+
+
+    def add(self, id, version_uid, block_uid, checksum, size, valid=1):
+        block = {
+            'id': id,
+            'version_uid': version_uid,
+            'date': datetime.datetime.utcnow(),  # as func.now creates timezone stamps...
+            'uid': block_uid,
+            'checksum': checksum,
+            'size': size,
+            'valid': 1 if valid else 0,
+        }
+        self._blocks.append(block)
+        if block_uid and checksum and block['valid']:
+            self._checksums[checksum] = block
+        if len(self._blocks) >= self.batch_size or time.time() - self._last_commit >= self.commit_interval:
+            self.flush()
+
+
+    def get_block_by_checksum(self, checksum):
+        """ Find a block in the pending (not yet committed) batch """
+        block = self._checksums.get(checksum)
+        if block is None:
+            return None
+        return DereferencedBlock(**block)
+
+
+    def flush(self):
+        """ Insert and commit all pending blocks """
+        if self._blocks:
+            t1 = time.time()
+            self.meta_backend.session.bulk_insert_mappings(Block, self._blocks)
+            self.meta_backend.session.commit()
+            t2 = time.time()
+            logger.debug('Committed {} blocks to meta backend in {:.2f}s'.format(len(self._blocks), t2-t1))
+            self._blocks = []
+            self._checksums = {}
+        self._last_commit = time.time()
+
+
 class MetaBackend(_MetaBackend):
     """ Stores meta data in an sql database """
 
     FLUSH_EVERY_N_BLOCKS = 1000
+    BLOCK_WRITER_BATCH_SIZE = 1000
+    BLOCK_WRITER_COMMIT_INTERVAL = 5  # seconds
+    DELETE_CANDIDATES_BATCH_SIZE = 10000  # deleted blocks per query during cleanup
+    DELETE_CANDIDATES_IN_SIZE = 500  # uids per IN clause
+    BLOCKS_PAGE_SIZE = 1000  # blocks per query when paging through a version
 
     def __init__(self, config):
         _MetaBackend.__init__(self)
-        # engine = sqlalchemy.create_engine(config.get('engine'), echo=True)
-        self.engine = sqlalchemy.create_engine(config.get('engine'))
+        engine = config.get('engine')
+        # engine = sqlalchemy.create_engine(engine, echo=True)
+        if engine.startswith('postgresql'):
+            # let psycopg2 send bulk inserts as multi-row VALUES instead of
+            # one statement per row.
+            try:
+                self.engine = sqlalchemy.create_engine(engine, executemany_mode='values')
+            except TypeError:  # sqlalchemy < 1.3.7
+                self.engine = sqlalchemy.create_engine(engine)
+        else:
+            self.engine = sqlalchemy.create_engine(engine)
+        self.block_writer_batch_size = config.getint('block_writer_batch_size', self.BLOCK_WRITER_BATCH_SIZE)
+        self.block_writer_commit_interval = config.getfloat('block_writer_commit_interval', self.BLOCK_WRITER_COMMIT_INTERVAL)
+        # The hash function was configured globally before it was stored with
+        # each version. The migration needs it for the existing versions.
+        self._configured_hash_function = dict(config.items('DEFAULTS', [])).get('hash_function')
 
 
     def open(self):
@@ -163,6 +242,7 @@ class MetaBackend(_MetaBackend):
         alembic_cfg = Config(os.path.join(os.path.dirname(os.path.realpath(__file__)), "sql_migrations", "alembic.ini"))
         with self.engine.begin() as connection:
             alembic_cfg.attributes['connection'] = connection
+            alembic_cfg.attributes['hash_function'] = self._configured_hash_function
             #command.upgrade(alembic_cfg, "head", sql=True)
             command.upgrade(alembic_cfg, "head")
 
@@ -190,7 +270,7 @@ class MetaBackend(_MetaBackend):
         self.session.commit()
 
 
-    def set_version(self, version_name, snapshot_name, size, size_bytes, valid, protected=0):
+    def set_version(self, version_name, snapshot_name, size, size_bytes, valid, protected=0, hash_function='sha512'):
         uid = self._uid()
         version = Version(
             uid=uid,
@@ -201,6 +281,7 @@ class MetaBackend(_MetaBackend):
             size_bytes=size_bytes,
             valid=valid,
             protected=protected,
+            hash_function=hash_function,
             )
         self.session.add(version)
         self.session.commit()
@@ -210,21 +291,21 @@ class MetaBackend(_MetaBackend):
     def copy_version(self, from_version_uid, version_name, snapshot_name=''):
         """ Copy version to a new uid and name, snapshot_name"""
         old_version = self.get_version(from_version_uid)
-        new_version_uid = self.set_version(version_name, snapshot_name, old_version.size, old_version.size_bytes, old_version.valid)
-        old_blocks = self.get_blocks_by_version(from_version_uid)
+        new_version_uid = self.set_version(version_name, snapshot_name, old_version.size, old_version.size_bytes, old_version.valid, hash_function=old_version.hash_function)
+        # The block writer commits, so no cursor may stay open meanwhile.
+        old_blocks = self.get_blocks_by_version_paged(from_version_uid)
         logger.info('Copying version...')
-        for i, block in enumerate(old_blocks.yield_per(1000)):
-            self.set_block(
+        block_writer = self.get_block_writer()
+        for i, block in enumerate(old_blocks):
+            block_writer.add(
                     i,
                     new_version_uid,
                     block.uid,
                     block.checksum,
                     block.size,
                     block.valid,
-                    _commit=False,
-                    _upsert=False,
                     )
-        self._commit()
+        block_writer.flush()
         logger.info('Done copying version...')
         return new_version_uid
 
@@ -454,6 +535,10 @@ class MetaBackend(_MetaBackend):
         return block
 
 
+    def get_block_writer(self):
+        return BlockWriter(self, self.block_writer_batch_size, self.block_writer_commit_interval)
+
+
     def set_blocks_invalid(self, uid, checksum):
         _affected_version_uids = self.session.query(distinct(Block.version_uid)).filter_by(uid=uid, checksum=checksum).all()
         affected_version_uids = [v[0] for v in _affected_version_uids]
@@ -461,7 +546,7 @@ class MetaBackend(_MetaBackend):
         self.session.commit()
         logger.info('Marked block invalid (UID {}, Checksum {}. Affected versions: {}'.format(
             uid,
-            checksum,
+            checksum.hex() if checksum else None,
             ', '.join(affected_version_uids)
             ))
         for version_uid in affected_version_uids:
@@ -473,19 +558,60 @@ class MetaBackend(_MetaBackend):
         return self.session.query(Block).filter_by(uid=uid).first()
 
 
-    def get_block_by_checksum(self, checksum):
-        return self.session.query(Block).filter_by(checksum=checksum, valid=1).first()
+    def get_block_by_checksum(self, checksum, hash_function=None):
+        query = self.session.query(Block).filter_by(checksum=checksum, valid=1)
+        if hash_function:
+            # equal checksums only mean equal data for the same algorithm
+            query = query.join(Version).filter(Version.hash_function == hash_function)
+        return query.first()
 
 
     def get_blocks_by_version(self, version_uid):
         return self.session.query(Block).filter_by(version_uid=version_uid).order_by(Block.id)
 
 
+    def get_blocks_by_version_paged(self, version_uid):
+        """ Yields the (dereferenced) blocks of a version ordered by id. Each
+        page of BLOCKS_PAGE_SIZE blocks is read completely by its own query
+        (keyset pagination on id), so the session may be committed while
+        iterating.
+        """
+        last_id = None
+        while True:
+            query = self.session.query(Block).filter_by(version_uid=version_uid)
+            if last_id is not None:
+                query = query.filter(Block.id > last_id)
+            blocks = [block.deref() for block in query.order_by(Block.id).limit(self.BLOCKS_PAGE_SIZE)]
+            if not blocks:
+                return
+            yield from blocks
+            last_id = blocks[-1].id
+
+
+    def get_block_window(self, version_uid, first_id, last_id):
+        """ Returns (id, uid, size) of the blocks of a version with
+        first_id <= id < last_id. This uses its own connection, so it may be
+        called from any thread.
+        """
+        query = sqlalchemy.select([Block.id, Block.uid, Block.size]).where(sqlalchemy.and_(
+            Block.version_uid == version_uid, Block.id >= first_id, Block.id < last_id))
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+
     def get_block_ids_by_version(self, version_uid):
         _b = self.session.query(Block.id).filter_by(version_uid=version_uid).order_by(Block.id)
         return [v[0] for v in _b.values('id')]
 
 
+    def get_block_id_ranges_by_version(self, version_uid):
+        """ Streams the block ids of a version into a RangeSet, so they are
+        never all in memory at once.
+        """
+        _b = self.session.query(Block.id).filter_by(version_uid=version_uid).order_by(Block.id)
+        return RangeSet.from_ids(id_ for id_, in _b.yield_per(10000))
+
+
     def rm_version(self, version_uid):
         affected_blocks = self.session.query(Block).filter_by(version_uid=version_uid)
         num_blocks = affected_blocks.count()
@@ -510,55 +636,51 @@ class MetaBackend(_MetaBackend):
 
 
     def get_delete_candidates(self, dt=3600):
-        _stat_i = 0
+        """ Yields sets of uids which aren't referenced by any block and
+        whose blocks have been deleted more than dt seconds ago.
+        The deleted blocks are processed in batches by id (keyset
+        pagination) and each batch is resolved with a single query.
+        """
         _stat_remove_from_delete_candidates = 0
         _stat_delete_candidates = 0
+        max_time = inttime() - dt
+        last_id = None
         while True:
-            delete_candidates = self.session.query(
-                DeletedBlock
-            ).filter(
-                DeletedBlock.time < (inttime() - dt)
-            ).limit(250).all()  # http://stackoverflow.com/questions/7389759/memory-efficient-built-in-sqlalchemy-iterator-generator
-            if not delete_candidates:
+            query = self.session.query(DeletedBlock.id, DeletedBlock.uid).filter(DeletedBlock.time < max_time)
+            if last_id is not None:
+                query = query.filter(DeletedBlock.id > last_id)
+            rows = query.order_by(DeletedBlock.id).limit(self.DELETE_CANDIDATES_BATCH_SIZE).all()
+            if not rows:
                 break
+            first_id, last_id = rows[0][0], rows[-1][0]
+            batch = (DeletedBlock.id >= first_id, DeletedBlock.id <= last_id, DeletedBlock.time < max_time)
 
-            _remove_from_delete_candidate_uids = set()
-            _delete_candidates = set()
-            for candidate in delete_candidates:
-                _stat_i += 1
-                if _stat_i%1000 == 0:
-                    logger.info("Cleanup-fast: {} false positives, {} data deletions.".format(
-                        _stat_remove_from_delete_candidates,
-                        _stat_delete_candidates,
-                        ))
-
-                block = self.session.query(
-                    Block
-                ).filter(
-                    Block.uid == candidate.uid
-                ).limit(1).scalar()
-                if block:
-                    _remove_from_delete_candidate_uids.add(candidate.uid)
-                    _stat_remove_from_delete_candidates += 1
-                else:
-                    _delete_candidates.add(candidate.uid)
-                    _stat_delete_candidates += 1
-
-            if _remove_from_delete_candidate_uids:
-                logger.debug("Cleanup-fast: Removing {} false positive delete candidates".format(len(_remove_from_delete_candidate_uids)))
+            _delete_candidates = set(uid for uid, in self.session.query(
+                distinct(DeletedBlock.uid)
+            ).filter(
+                *batch
+            ).filter(
+                DeletedBlock.uid != None,
+                ~exists().where(Block.uid == DeletedBlock.uid),
+            ))
+            _stat_delete_candidates += len(_delete_candidates)
+            _stat_remove_from_delete_candidates += len(set(uid for id_, uid in rows) - _delete_candidates)
+            logger.info("Cleanup-fast: {} false positives, {} data deletions.".format(
+                _stat_remove_from_delete_candidates,
+                _stat_delete_candidates,
+                ))
+
+            self.session.query(DeletedBlock).filter(*batch).delete(synchronize_session=False)
+            # later batches must not yield these uids again
+            for uids in grouper(self.DELETE_CANDIDATES_IN_SIZE, _delete_candidates):
                 self.session.query(
                     DeletedBlock
                 ).filter(
-                    DeletedBlock.uid.in_(_remove_from_delete_candidate_uids)
+                    DeletedBlock.uid.in_(uids)
                 ).delete(synchronize_session=False)
 
             if _delete_candidates:
                 logger.debug("Cleanup-fast: Sending {} delete candidates for final deletion".format(len(_delete_candidates)))
-                self.session.query(
-                    DeletedBlock
-                ).filter(
-                    DeletedBlock.uid.in_(_delete_candidates)
-                ).delete(synchronize_session=False)
                 yield(_delete_candidates)
 
         logger.info("Cleanup-fast: Cleanup finished. {} false positives, {} data deletions.".format(
@@ -568,11 +690,48 @@ class MetaBackend(_MetaBackend):
 
 
     def get_all_block_uids(self, prefix=None):
+        uid = Block.uid
+        if self.engine.dialect.name == 'postgresql':
+            uid = uid.collate('C')  # byte order, like the data backends' listings
+        rows = self.session.query(distinct(uid)).filter(Block.uid != None)
         if prefix:
-            rows = self.session.query(distinct(Block.uid)).filter(Block.uid.like('{}%'.format(prefix))).all()
-        else:
-            rows = self.session.query(distinct(Block.uid)).all()
-        return [b[0] for b in rows]
+            rows = rows.filter(Block.uid.like('{}%'.format(prefix)))
+        for row in rows.order_by(uid).yield_per(10000):
+            yield row[0]
+
+
+    def update_block_uids(self, uid_map):
+        for old_uid, new_uid in uid_map.items():
+            self.session.query(Block).filter_by(uid=old_uid).update({'uid': new_uid}, synchronize_session=False)
+            self.session.add(DeletedBlock(
+                uid=old_uid,
+                size=None,
+                delete_candidate=DELETE_CANDIDATE_MAYBE,
+            ))
+        self.session.commit()
+
+
+    def _checksums_query(self, hash_function=None, *columns):
+        query = self.session.query(Block.checksum, *columns).filter(Block.valid == 1, Block.checksum != None)
+        if hash_function:
+            query = query.join(Version).filter(Version.hash_function == hash_function)
+        return query
+
+
+    def count_checksums(self, hash_function=None):
+        return self._checksums_query(hash_function).count()
+
+
+    def get_all_checksums(self, hash_function=None):
+        rows = self._checksums_query(hash_function)
+        for row in rows.yield_per(10000):
+            yield row[0]
+
+
+    def get_all_checksum_blocks(self, hash_function=None):
+        rows = self._checksums_query(hash_function, Block.uid, Block.size)
+        for row in rows.yield_per(10000):
+            yield row[0], row[1], row[2]
 
 
     def export(self, version_uid, f):
@@ -590,6 +749,7 @@ class MetaBackend(_MetaBackend):
             version.valid,
             version.protected,
             version.expire.strftime('%Y-%m-%d') if version.expire else '',
+            version.hash_function,
             ])
         for block in blocks:
             _csv.writerow([
@@ -597,7 +757,7 @@ class MetaBackend(_MetaBackend):
                 block.version_uid,
                 block.id,
                 block.date.strftime('%Y-%m-%d %H:%M:%S'),
-                block.checksum,
+                block.checksum.hex() if block.checksum else None,
                 block.size,
                 block.valid,
                 ])
@@ -613,6 +773,8 @@ class MetaBackend(_MetaBackend):
             self.import_2_2(_csv)
         elif signature[0] == 'backy2 Version 2.10 metadata dump':
             self.import_2_10(_csv)
+        elif signature[0] == 'backy2 Version 2.11 metadata dump':
+            self.import_2_11(_csv)
         else:
             raise ValueError('Wrong import format.')
 
@@ -642,7 +804,7 @@ class MetaBackend(_MetaBackend):
                 version_uid=version_uid,
                 id=id,
                 date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                checksum=checksum,
+                checksum=bytes.fromhex(checksum) if checksum else None,
                 size=size,
                 valid=valid,
             )
@@ -691,7 +853,7 @@ class MetaBackend(_MetaBackend):
                     version_uid=version_uid,
                     id=id,
                     date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                    checksum=checksum,
+                    checksum=bytes.fromhex(checksum) if checksum else None,
                     size=size,
                     valid=valid,
                 )
@@ -744,7 +906,7 @@ class MetaBackend(_MetaBackend):
                     version_uid=version_uid,
                     id=id,
                     date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                    checksum=checksum,
+                    checksum=bytes.fromhex(checksum) if checksum else None,
                     size=size,
                     valid=valid,
                 )
@@ -755,6 +917,67 @@ class MetaBackend(_MetaBackend):
             self.session.commit()
 
 
+    def import_2_11(self, _csv):
+        version_uid, version_date, version_name, version_snapshot_name, version_size, version_size_bytes, version_valid, version_protected, version_expire, version_hash_function = next(_csv)
+        try:
+            self.get_version(version_uid)
+        except KeyError:
+            pass  # does not exist
+        else:
+            raise KeyError('Version {} already exists and cannot be imported.'.format(version_uid))
+        version = Version(
+            uid=version_uid,
+            date=datetime.datetime.strptime(version_date, '%Y-%m-%d %H:%M:%S'),
+            name=version_name,
+            snapshot_name=version_snapshot_name,
+            size=version_size,
+            size_bytes=version_size_bytes,
+            valid=version_valid,
+            protected=version_protected,
+            expire=datetime.datetime.strptime(version_expire, '%Y-%m-%d').date() if version_expire else None,
+            hash_function=version_hash_function,
+            )
+        self.session.add(version)
+        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+        # SQLAlchemy Bug
+        # https://stackoverflow.com/questions/10154343/is-sqlalchemy-saves-order-in-adding-objects-to-session
+        #
+        # """
+        # Within the same class, the order is indeed determined by the order
+        # that add was called. However, you may see different orderings in the
+        # INSERTs between different classes. If you add object a of type A and
+        # later add object b of type B, but a turns out to have a foreign key
+        # to b, you'll see an INSERT for b before the INSERT for a.
+        # """
+        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+        self.session.commit()
+        # and because of this bug we must also try/except here instead of
+        # simply leaving this to the database's transaction handling.
+        try:
+            for uid, version_uid, id, date, checksum, size, valid in _csv:
+                block = Block(
+                    uid=uid,
+                    version_uid=version_uid,
+                    id=id,
+                    date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
+                    checksum=bytes.fromhex(checksum) if checksum else None,
+                    size=size,
+                    valid=valid,
+                )
+                self.session.add(block)
+        except:  # see above
+            self.rm_version(version_uid)
+        finally:
+            self.session.commit()
+
+
+    def clone(self):
+        meta_backend = copy.copy(self)
+        meta_backend.session = sessionmaker(bind=self.engine)()
+        meta_backend._flush_block_counter = 0
+        return meta_backend
+
+
     def close(self):
         self.session.commit()
         self.session.close()
@@ -0,0 +1,54 @@
+"""Store block checksums as binary digests instead of hex strings.
+
+Revision ID: 5b3e1c7d9a2f
+Revises: 85966fcda5e6
+Create Date: 2026-10-15 10:12:41.311204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b3e1c7d9a2f'
+down_revision = '85966fcda5e6'
+branch_labels = None
+depends_on = None
+
+
+def _convert(from_type, to_type, expression):
+    """ Generic conversion for databases which can't convert the column in
+    place (e.g. sqlite): Fill a new column with the converted checksums
+    (expression) and replace the old one by it. This is a single UPDATE, so
+    the blocks are never loaded into python.
+    """
+    op.add_column('blocks', sa.Column('checksum_new', to_type, nullable=True))
+    op.execute('UPDATE blocks SET checksum_new = {} WHERE checksum IS NOT NULL'.format(expression))
+    op.drop_index('ix_blocks_checksum', table_name='blocks')
+    with op.batch_alter_table('blocks') as batch_op:
+        batch_op.drop_column('checksum')
+        batch_op.alter_column('checksum_new', new_column_name='checksum', existing_type=to_type)
+    op.create_index('ix_blocks_checksum', 'blocks', ['checksum'], unique=False)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_index('ix_blocks_checksum', table_name='blocks')
+        op.execute("ALTER TABLE blocks ALTER COLUMN checksum TYPE bytea USING decode(checksum, 'hex')")
+        op.create_index('ix_blocks_checksum', 'blocks', ['checksum'], unique=False)
+    elif bind.dialect.name == 'sqlite':
+        # unhex() is only built into sqlite >= 3.41
+        bind.connection.create_function('backy2_unhex', 1, bytes.fromhex)
+        _convert(sa.String(length=128), sa.LargeBinary(length=64), 'backy2_unhex(checksum)')
+    else:
+        _convert(sa.String(length=128), sa.LargeBinary(length=64), 'unhex(checksum)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_blocks_checksum', table_name='blocks')
+        op.execute("ALTER TABLE blocks ALTER COLUMN checksum TYPE varchar(128) USING encode(checksum, 'hex')")
+        op.create_index('ix_blocks_checksum', 'blocks', ['checksum'], unique=False)
+    else:
+        _convert(sa.LargeBinary(length=64), sa.String(length=128), 'lower(hex(checksum))')
@@ -0,0 +1,64 @@
+"""Added hash_function to versions
+
+Revision ID: d2a8f4c61e07
+Revises: 5b3e1c7d9a2f
+Create Date: 2026-10-15 13:40:18.502113
+
+"""
+from alembic import context
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a8f4c61e07'
+down_revision = '5b3e1c7d9a2f'
+branch_labels = None
+depends_on = None
+
+
+# Before, the hash function was configured globally and the full digest
+# was stored. So the stored checksums must have its digest length.
+DIGEST_LENGTHS = {
+    16: ['md5'],
+    20: ['sha1'],
+    28: ['sha224', 'sha3_224'],
+    32: ['sha256', 'sha3_256', 'blake2s'],
+    48: ['sha384', 'sha3_384'],
+    64: ['sha512', 'sha3_512', 'blake2b'],
+}
+
+
+def _hash_function(configured, length):
+    """ Returns the hash function of a version with checksums of length
+    bytes. This is the configured one if it fits, else the only one with
+    this digest length. Ambiguous lengths raise.
+    """
+    candidates = DIGEST_LENGTHS.get(length, [])
+    if configured in candidates:
+        return configured
+    if len(candidates) == 1:
+        return candidates[0]
+    raise RuntimeError('Can\'t tell the hash function of checksums with {} bytes (configured: {}, '
+        'possible: {}). Please set hash_function in the config to the one your backups have been '
+        'made with.'.format(length, configured, ', '.join(candidates) or 'none'))
+
+
+def upgrade():
+    # the hash_function of the config passed to backy2 (see MetaBackend.migrate_db)
+    configured = context.config.attributes.get('hash_function') or 'sha512'
+    op.add_column('versions', sa.Column('hash_function', sa.String(length=32), server_default='sha512', nullable=False))
+    bind = op.get_bind()
+    versions = sa.table('versions', sa.column('uid'), sa.column('hash_function'))
+    blocks = sa.table('blocks', sa.column('version_uid'), sa.column('checksum'))
+    for version_uid, in bind.execute(sa.select([versions.c.uid])).fetchall():
+        length = bind.execute(sa.select([sa.func.length(blocks.c.checksum)]).where(sa.and_(
+            blocks.c.version_uid == version_uid, blocks.c.checksum != None)).limit(1)).scalar()
+        hash_function = configured if length is None else _hash_function(configured, length)
+        if hash_function != 'sha512':
+            bind.execute(versions.update().where(versions.c.uid == version_uid).values(hash_function=hash_function))
+
+
+def downgrade():
+    with op.batch_alter_table('versions') as batch_op:
+        batch_op.drop_column('hash_function')
@@ -11,7 +11,6 @@ from prettytable import PrettyTable
 import argparse
 import csv
 import fileinput
-import hashlib
 import logging
 import sys
 
@@ -74,7 +73,7 @@ class Commands():
             print('|'.join(map(str, values)))
 
 
-    def backup(self, name, snapshot_name, source, rbd, from_version, tag=None, expire=None, continue_version=None):
+    def backup(self, name, snapshot_name, source, rbd, from_version, tag=None, expire=None, continue_version=None, rbd_diff=None):
         expire_date = None
         if expire:
             try:
@@ -92,7 +91,7 @@ class Commands():
             tags = [t.strip() for t in list(csv.reader(StringIO(tag)))[0]]
         else:
             tags = None
-        version_uid = backy.backup(name, snapshot_name, source, hints, from_version, tags, expire_date, continue_version)
+        version_uid = backy.backup(name, snapshot_name, source, hints, from_version, tags, expire_date, continue_version, rbd_diff)
         if self.machine_output:
             print(version_uid)
         backy.close()
@@ -160,6 +159,7 @@ class Commands():
                 'protected': int(version.protected),
                 'tags': ",".join([t.name for t in version.tags]),
                 'expire': version.expire if version.expire else '',
+                'hash_function': version.hash_function,
             })
         if self.machine_output:
             self._machine_output(fields, values, humanize_columns=('size_bytes',))
@@ -323,21 +323,26 @@ class Commands():
         from backy2.enterprise.nbd import BackyStore
         backy = self.backy()
         config_NBD = self.Config(section='NBD')
-        config_DEFAULTS = self.Config(section='DEFAULTS')
-        hash_function = getattr(hashlib, config_DEFAULTS.get('hash_function', 'sha512'))
         store = BackyStore(
                 backy, cachedir=config_NBD.get('cachedir'),
-                hash_function=hash_function,
+                cache_memory_size=config_NBD.getint('cache_memory_size', BackyStore.CACHE_MEMORY_SIZE),
+                cache_disk_size=config_NBD.getint('cache_disk_size', BackyStore.CACHE_DISK_SIZE),
+                readahead_blocks=config_NBD.getint('readahead_blocks', BackyStore.READAHEAD_BLOCKS),
+                readahead_workers=config_NBD.getint('readahead_workers', BackyStore.READAHEAD_WORKERS),
+                fixate_workers=config_NBD.getint('fixate_workers', BackyStore.FIXATE_WORKERS),
                 )
         addr = (bind_address, bind_port)
-        server = NbdServer(addr, store, read_only)
+        server = NbdServer(addr, store, read_only, workers=config_NBD.getint('workers', 8))
         logger.info("Starting to serve nbd on %s:%s" % (addr[0], addr[1]))
         logger.info("You may now start")
         logger.info("  nbd-client -l %s -p %s" % (addr[0], addr[1]))
         logger.info("and then get the backup via")
         logger.info("  modprobe nbd")
         logger.info("  nbd-client -N <version> %s -p %s /dev/nbd0" % (addr[0], addr[1]))
-        server.serve_forever()
+        try:
+            server.serve_forever()
+        finally:
+            store.close()
 
 
     def import_(self, filename='-'):
@@ -502,6 +507,10 @@ def main():
         help='Backup name (e.g. the hostname)')
     p.add_argument('-s', '--snapshot-name', default='', help='Snapshot name (e.g. the name of the rbd snapshot)')
     p.add_argument('-r', '--rbd', default=None, help='Hints as rbd json format')
+    p.add_argument(
+        '-d', '--rbd-diff', nargs='?', const='', default=None, metavar='FROM_SNAP',
+        help='Let ceph compute the hints (rbd sources only): the changes since rbd snapshot FROM_SNAP or, '
+        'without FROM_SNAP, the used blocks of the image')
     p.add_argument('-f', '--from-version', default=None, help='Use this version-uid as base')
     p.add_argument('-c', '--continue-version', default=None, help='Continue backup on this version-uid')
     p.add_argument(
@@ -603,7 +612,7 @@ def main():
     p.add_argument('-e', '--expired', action='store_true', default=False,
             help="Only list expired versions (expired < now)")
     p.add_argument('-f', '--fields', default="date,name,snapshot_name,size,size_bytes,uid,valid,protected,tags,expire",
-            help="Show these fields (comma separated). Available: date,name,snapshot_name,size,size_bytes,uid,valid,protected,tags,expire")
+            help="Show these fields (comma separated). Available: date,name,snapshot_name,size,size_bytes,uid,valid,protected,tags,expire,hash_function")
 
 
     p.set_defaults(func='ls')
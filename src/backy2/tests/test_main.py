@@ -1,4 +1,5 @@
 import pytest
+import collections
 import os
 import sys
 import backy2.backy
@@ -41,7 +42,7 @@ def backy(request):
     snapshot_name = 'snapname'
     version_uid = backy.meta_backend.set_version(version_name, snapshot_name, TESTLEN, BLOCK_SIZE*TESTLEN, 1)
     block_uids = [uuid.uuid1().hex for i in range(TESTLEN)]
-    checksums = [uuid.uuid1().hex for i in range(TESTLEN)]
+    checksums = [uuid.uuid1().bytes for i in range(TESTLEN)]
 
     for id in range(TESTLEN):
         backy.meta_backend.set_block(id, version_uid, block_uids[id], checksums[id], BLOCK_SIZE, 1)
@@ -68,6 +69,41 @@ def test_blocks_from_hints():
     assert sorted(list(cfh)) == [0, 1, 2, 4, 5, 6, 8, 9, 13, 15, 16]
 
 
+def test_block_ranges_from_hints():
+    # hints may be streamed (e.g. from rbd diff_iterate), so use a generator
+    hints = ((offset, length, exists) for offset, length, exists in [
+        (0, 1024, True),
+        (1024, 1, False),
+        (3000, 2000, True),
+        ])
+    block_size = 1024
+    ranges = list(backy2.backy.block_ranges_from_hints(hints, block_size, 5000))
+    assert ranges == [(0, 1, True), (1, 2, False), (2, 5, True)]
+    with pytest.raises(ValueError):
+        list(backy2.backy.block_ranges_from_hints([(4096, 1024, True)], block_size, 5000))
+
+
+def test_range_set():
+    from backy2.utils import RangeSet
+    range_set = RangeSet([(10, 20), (0, 5)])
+    range_set.add(5)  # adjacent ranges are merged
+    range_set.add(30, 40)
+    range_set.add(25, 31)
+    assert list(range_set.ranges()) == [(0, 6), (10, 20), (25, 40)]
+    assert len(range_set) == 31
+    assert 5 in range_set and 6 not in range_set and 39 in range_set and 40 not in range_set
+    assert RangeSet.from_ids([0, 1, 2, 3, 4, 5, 7]) == RangeSet([(0, 6), (7, 8)])
+
+    difference = RangeSet([(0, 100)]) - range_set - RangeSet([(50, 60)])
+    assert list(difference.ranges()) == [(6, 10), (20, 25), (40, 50), (60, 100)]
+    assert sorted(difference) == sorted(set(range(100)) - set(range_set) - set(range(50, 60)))
+
+    sample = difference.sample(10)
+    assert len(set(sample)) == 10
+    assert all(i in difference for i in sample)
+    assert sorted(RangeSet([(3, 5)]).sample(10)) == [3, 4]
+
+
 def test_FileBackend_path(test_path):
     uid = 'c2cac25a7afd11e5b45aa44e314f9270'
 
@@ -136,7 +172,7 @@ def test_metabackend_block(test_path):
     name = 'backup-mysystem1-20150110140015'
     snapshot_name = 'snapname'
     block_uid = 'asdfgh'
-    checksum = '1234567890'
+    checksum = b'1234567890'
     size = 5000
     id = 0
     version_uid = backend.set_version(name, snapshot_name, 10, 5000, 1)
@@ -160,7 +196,7 @@ def test_metabackend_blocks_by_version(test_path):
     snapshot_name = 'snapname'
     version_uid = backend.set_version(version_name, snapshot_name, TESTLEN, 5000, 1)
     block_uids = [uuid.uuid1().hex for i in range(TESTLEN)]
-    checksums = [uuid.uuid1().hex for i in range(TESTLEN)]
+    checksums = [uuid.uuid1().bytes for i in range(TESTLEN)]
     size = 5000
 
     for id in range(TESTLEN):
@@ -204,3 +240,696 @@ def test_backystore_readlist(backy):
     assert read_list_length == length
     print('Trying with offset {} and length {} resulted in {} blocks.'.format(offset, length, len(read_list)))
 
+
+
+@pytest.fixture(scope="function")
+def meta_backend(test_path):
+    from backy2.config import Config
+    from backy2.meta_backends.sql import MetaBackend
+    config = Config(cfg="""
+[MetaBackend]
+engine: sqlite:///{}/backy.sqlite
+block_writer_batch_size: 3
+""".format(test_path), section='MetaBackend')
+    backend = MetaBackend(config)
+    backend.initdb()
+    backend.open()
+    yield backend
+    backend.close()
+
+
+def test_metabackend_block_writer(meta_backend):
+    version_uid = meta_backend.set_version('backup', 'snapname', 5, 5000, 0)
+    block_writer = meta_backend.get_block_writer()
+    for id in range(5):
+        block_writer.add(id, version_uid, 'uid{}'.format(id), b'checksum%d' % id, 1000, 1)
+    # the first batch of 3 is committed, the rest is pending
+    assert meta_backend.get_block_ids_by_version(version_uid) == [0, 1, 2]
+    assert block_writer.get_block_by_checksum(b'checksum4').uid == 'uid4'
+    assert block_writer.get_block_by_checksum(b'checksum0') is None
+    block_writer.flush()
+    assert meta_backend.get_block_ids_by_version(version_uid) == [0, 1, 2, 3, 4]
+    assert list(meta_backend.get_block_id_ranges_by_version(version_uid).ranges()) == [(0, 5)]
+    assert meta_backend.get_block_by_checksum(b'checksum4').uid == 'uid4'
+
+
+def test_metabackend_copy_version(meta_backend):
+    # more blocks than a cursor chunk, while the block writer commits
+    version_uid = meta_backend.set_version('backup', 'snapname', 2500, 2500000, 1)
+    block_writer = meta_backend.get_block_writer()
+    for id in range(2500):
+        block_writer.add(id, version_uid, 'uid{}'.format(id), b'checksum%d' % id, 1000, 1)
+    block_writer.flush()
+    new_version_uid = meta_backend.copy_version(version_uid, 'copy')
+    blocks = list(meta_backend.get_blocks_by_version(new_version_uid))
+    assert [block.id for block in blocks] == list(range(2500))
+    assert blocks[2499].uid == 'uid2499'
+    assert blocks[2499].checksum == b'checksum2499'
+
+
+def test_backup_differential(test_path):
+    from functools import partial
+    from backy2.config import Config as _Config
+    from backy2.utils import backy_from_config
+    Config = partial(_Config, cfg="""
+[DEFAULTS]
+logfile: {path}/backy.log
+block_size: 512
+lock_dir: {path}
+process_name: backy2
+
+[MetaBackend]
+type: backy2.meta_backends.sql
+engine: sqlite:///{path}/backy.sqlite
+
+[DataBackend]
+type: backy2.data_backends.file
+path: {path}
+simultaneous_writes: 5
+simultaneous_reads: 5
+
+[io_file]
+simultaneous_reads: 5
+""".format(path=os.path.abspath(test_path)))
+    # more blocks than a batch of the block writer, which commits while the
+    # blocks of the old version are read
+    source = os.path.join(test_path, 'source')
+    data = bytearray(os.urandom(512 * 2500))
+    with open(source, 'wb') as f:
+        f.write(data)
+    backy = backy_from_config(Config)(initdb=True)
+    version_uid = backy.backup('backup', 'snapname', 'file://' + source, None, None)
+    backy.close()
+    data[512 * 2000:512 * 2001] = os.urandom(512)
+    with open(source, 'wb') as f:
+        f.write(data)
+    hints = [(512 * 2000, 512, True)]
+    backy = backy_from_config(Config)()
+    new_version_uid = backy.backup('backup', 'snapname', 'file://' + source, hints, version_uid)
+    blocks = backy.meta_backend.get_blocks_by_version(new_version_uid)
+    assert [block.id for block in blocks] == list(range(2500))
+    assert blocks[2000].uid != backy.meta_backend.get_blocks_by_version(version_uid)[2000].uid
+    assert blocks[2001].uid == backy.meta_backend.get_blocks_by_version(version_uid)[2001].uid
+    backy.close()
+
+
+def test_metabackend_export_import_checksums(meta_backend):
+    import io
+    import hashlib
+    version_uid = meta_backend.set_version('backup', 'snapname', 2, 2000, 1, hash_function='blake2b')
+    checksum = hashlib.blake2b(b'data').digest()
+    meta_backend.set_block(0, version_uid, 'uid0', checksum, 1000, 1)
+    meta_backend.set_block(1, version_uid, None, None, 1000, 1)
+    f = io.StringIO()
+    meta_backend.export(version_uid, f)
+    assert checksum.hex() in f.getvalue()
+    meta_backend.rm_version(version_uid)
+    f.seek(0)
+    meta_backend.import_(f)
+    assert meta_backend.get_version(version_uid).hash_function == 'blake2b'
+    blocks = meta_backend.get_blocks_by_version(version_uid)
+    assert blocks[0].checksum == checksum
+    assert blocks[1].checksum is None
+
+
+def test_metabackend_delete_candidates(meta_backend):
+    version_uids = [meta_backend.set_version('backup', 'snapname', 5, 5000, 1) for i in range(3)]
+    for i, version_uid in enumerate(version_uids):
+        for id in range(5):
+            # uid0 and uid1 are in all versions, uidN-2..4 only in version N
+            meta_backend.set_block(id, version_uid, 'uid{}'.format(id) if id < 2 else 'uid{}-{}'.format(i, id), None, 1000, 1)
+    meta_backend.rm_version(version_uids[0])
+    meta_backend.rm_version(version_uids[1])
+    meta_backend.DELETE_CANDIDATES_BATCH_SIZE = 3
+    candidates = list(meta_backend.get_delete_candidates(dt=-1))
+    assert sorted(uid for uids in candidates for uid in uids) == sorted(
+        'uid{}-{}'.format(i, id) for i in range(2) for id in range(2, 5))
+    # all deleted blocks have been processed
+    assert list(meta_backend.get_delete_candidates(dt=-1)) == []
+
+
+def test_sorted_difference():
+    from backy2.utils import sorted_difference
+    assert list(sorted_difference(['a', 'b', 'c', 'e'], ['b', 'b', 'd', 'e', 'f'])) == ['a', 'c']
+    assert list(sorted_difference(['a', 'b'], [])) == ['a', 'b']
+    assert list(sorted_difference([], ['a'])) == []
+    # unsorted input must never lead to wrong results
+    with pytest.raises(ValueError):
+        list(sorted_difference(['a', 'b', 'c'], ['b', 'a']))
+    with pytest.raises(ValueError):
+        list(sorted_difference(['b', 'a'], ['c']))
+
+
+def test_bloom_filter():
+    from backy2.dedup import BloomFilter
+    bloom_filter = BloomFilter(1000)
+    keys = [uuid.uuid1().hex for i in range(1000)]
+    for key in keys:
+        bloom_filter.add(key)
+    assert all(key in bloom_filter for key in keys)
+    false_positives = [key for key in (uuid.uuid4().hex for i in range(1000)) if key in bloom_filter]
+    assert len(false_positives) < 20
+
+
+def test_dedup_index(meta_backend, monkeypatch):
+    from backy2.dedup import DedupIndex
+    version_uid = meta_backend.set_version('backup', 'snapname', 5, 5000, 0)
+    block_writer = meta_backend.get_block_writer()
+    block_writer.add(0, version_uid, 'uid0', b'checksum0', 1000, 1)
+    block_writer.flush()
+    dedup_index = DedupIndex(meta_backend, block_writer).load()
+    block_writer.add(1, version_uid, 'uid1', b'checksum1', 1000, 1)
+    dedup_index.add(b'checksum1', 'uid1', 1000)
+    assert dedup_index.get_block_by_checksum(b'checksum0').uid == 'uid0'
+    assert dedup_index.get_block_by_checksum(b'checksum1').uid == 'uid1'
+    assert dedup_index.get_block_by_checksum(b'checksum2') is None
+    assert dedup_index.stats['hits'] == 2
+    assert dedup_index.stats['misses'] == 1
+    # mapped hits don't need the database
+    block_writer.flush()
+    with monkeypatch.context() as m:
+        m.setattr(meta_backend, 'get_block_by_checksum', None)
+        assert dedup_index.get_block_by_checksum(b'checksum1') == ('uid1', 1000)
+        assert dedup_index.get_block_by_checksum(b'checksum0').size == 1000
+    assert dedup_index.stats['hits_mapped'] == 3
+
+    # with a limited map, probable hits are looked up in the database
+    dedup_index = DedupIndex(meta_backend, block_writer, max_mapped=1).load()
+    assert len(dedup_index.blocks) == 1
+    assert dedup_index.get_block_by_checksum(b'checksum0').uid == 'uid0'
+    assert dedup_index.get_block_by_checksum(b'checksum1').uid == 'uid1'
+    assert dedup_index.get_block_by_checksum(b'checksum2') is None
+    assert dedup_index.stats['hits'] == 2
+    assert dedup_index.stats['hits_mapped'] == 1
+
+
+def test_is_zero():
+    from backy2.hashing import is_zero
+    assert is_zero(b'\0' * 4096)
+    assert is_zero(b'')
+    assert not is_zero(b'\0' * 4095 + b'\1')
+
+
+def test_hash_pool():
+    import hashlib
+    from backy2.hashing import HashPool
+    hash_pool = HashPool(hashlib.sha512, workers=4)
+    blocks = [os.urandom(4096) for i in range(100)]
+    for i, data in enumerate(blocks):
+        hash_pool.submit(data, i)
+    results = dict(hash_pool.drain())
+    assert hash_pool.pending == 0
+    assert results == {i: hashlib.sha512(data).digest() for i, data in enumerate(blocks)}
+    # e.g. io readers wait for their digests
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(hash_pool.digest, blocks)) == [hashlib.sha512(data).digest() for data in blocks]
+    hash_pool.close()
+
+
+def test_get_hash_function():
+    import hashlib
+    from backy2.hashing import get_hash_function
+    assert get_hash_function('sha512') is hashlib.sha512
+    assert get_hash_function('blake2b') is hashlib.blake2b
+    assert get_hash_function('sha384') is hashlib.sha384  # any hashlib algorithm
+    with pytest.raises(NotImplementedError):
+        get_hash_function('nohash')
+
+
+def test_checksum_length():
+    from backy2.backy import Backy
+    # truncated checksums would merge different blocks in deduplication
+    with pytest.raises(ValueError):
+        Backy(None, None, None, checksum_length=8)
+
+
+def test_metabackend_clone(meta_backend):
+    from concurrent.futures import ThreadPoolExecutor
+    version_uid = meta_backend.set_version('backup', 'snapname', 2, 8192, 1)
+    meta_backend.set_block(0, version_uid, 'uid0', b'checksum0', 4096, 1)
+    def copy_version():
+        # sessions must not be shared across threads
+        clone = meta_backend.clone()
+        try:
+            return clone.copy_version(version_uid, 'copy')
+        finally:
+            clone.close()
+    with ThreadPoolExecutor(1) as executor:
+        copy_uid = executor.submit(copy_version).result()
+    assert meta_backend.get_version(copy_uid).name == 'copy'
+    assert [block.uid for block in meta_backend.get_blocks_by_version(copy_uid)] == ['uid0']
+
+
+def test_metabackend_dedup_by_hash_function(meta_backend):
+    sha512_version_uid = meta_backend.set_version('backup', 'snapname', 1, 1000, 1, hash_function='sha512')
+    blake2b_version_uid = meta_backend.set_version('backup', 'snapname', 1, 1000, 1, hash_function='blake2b')
+    meta_backend.set_block(0, sha512_version_uid, 'uid0', b'checksum', 1000, 1)
+    assert meta_backend.get_block_by_checksum(b'checksum', 'sha512').uid == 'uid0'
+    assert meta_backend.get_block_by_checksum(b'checksum', 'blake2b') is None
+    assert meta_backend.count_checksums('blake2b') == 0
+    meta_backend.set_block(0, blake2b_version_uid, 'uid1', b'checksum', 1000, 1)
+    assert meta_backend.get_block_by_checksum(b'checksum', 'blake2b').uid == 'uid1'
+    assert list(meta_backend.get_all_checksums('blake2b')) == [b'checksum']
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'lz4', 'zstd'])
+def test_file_backend_compression(test_path, compression):
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    config = Config(cfg="""
+[DataBackend]
+path: {}
+simultaneous_writes: 1
+compression: {}
+""".format(test_path, compression), section='DataBackend')
+    try:
+        backend = DataBackend(config)
+    except NotImplementedError:
+        pytest.skip('compression {} not available'.format(compression))
+    datas = [b'\0' * 4096, os.urandom(4096), b'BKY2' + os.urandom(100)]
+    uids = [backend.save(data, _sync=True) for data in datas]
+    for uid, data in zip(uids, datas):
+        assert backend.read_raw(uid) == data
+    # blobs written before the headers existed, whose data starts with BKY2
+    for header in [b'BKY2\x07', b'BKY2\x01\x63', b'BKY2\x01\x01', b'BKY2\x01\x00']:
+        data = header + os.urandom(100)
+        assert backend._decode('uid', data) == data
+    stored_size = os.path.getsize(backend._filename(uids[0]))
+    if compression == 'none':
+        assert stored_size == 4096
+    else:
+        assert stored_size < 4096
+    backend.close()
+
+
+def test_file_backend_encryption(test_path):
+    pytest.importorskip('cryptography')
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    keys = '1:{} 2:{}'.format('11' * 32, '22' * 32)
+    def backend(encryption, key_id):
+        return DataBackend(Config(cfg="""
+[DataBackend]
+path: {}
+simultaneous_writes: 1
+compression: zlib
+encryption: {}
+encryption_keys: {}
+encryption_key_id: {}
+""".format(test_path, encryption, keys, key_id), section='DataBackend'))
+    backend1 = backend('aes-256-gcm', 1)
+    data = b'\0' * 4096
+    uid1 = backend1.save(data, _sync=True)
+    assert data[:100] not in open(backend1._filename(uid1), 'rb').read()
+    backend1.close()
+    # rotate to a new key and cipher, old blobs are still readable
+    backend2 = backend('chacha20-poly1305', 2)
+    uid2 = backend2.save(data, _sync=True)
+    assert backend2.read_raw(uid1) == data
+    assert backend2.read_raw(uid2) == data
+    # blobs are bound to their uid
+    os.rename(backend2._filename(uid2), backend2._filename(uid1))
+    from cryptography.exceptions import InvalidTag
+    with pytest.raises(InvalidTag):
+        backend2.read_raw(uid1)
+    # unencrypted blobs are only read when allowed
+    with open(backend2._filename(uid1), 'wb') as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        backend2.read_raw(uid1)
+    backend2.allow_unencrypted_reads = True
+    assert backend2.read_raw(uid1) == data
+    backend2.close()
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_file_backend_ranged_read(test_path, compression):
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    backend = DataBackend(Config(cfg="""
+[DataBackend]
+path: {}
+simultaneous_writes: 1
+compression: {}
+""".format(test_path, compression), section='DataBackend'))
+    data = os.urandom(BLOCK_SIZE)
+    uid = backend.save(data, _sync=True)
+    escaped_data = b'BKY2' + os.urandom(BLOCK_SIZE - 4)
+    escaped_uid = backend.save(escaped_data, _sync=True)
+    for offset, length in ((0, 4096), (100, 1), (BLOCK_SIZE - 4096, 4096)):
+        assert backend.read_raw(uid, offset, length) == data[offset:offset + length]
+        assert backend.read_raw(escaped_uid, offset, length) == escaped_data[offset:offset + length]
+    assert backend.read_raw(uid, 4096) == data[4096:]
+    backend.close()
+
+
+def test_file_backend_listing(test_path):
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    backend = DataBackend(Config(cfg="""
+[DataBackend]
+path: {}
+simultaneous_writes: 2
+list_workers: 3
+""".format(test_path), section='DataBackend'))
+    backend.LIST_AHEAD = 1
+    uids = sorted(backend.save(os.urandom(10), _sync=True) for i in range(200))
+    assert list(backend.get_all_blob_uids()) == uids
+    for prefix in (uids[0][:1], uids[50][:3], uids[100][:5], uids[150], 'x'):
+        assert list(backend.get_all_blob_uids(prefix)) == [uid for uid in uids if uid.startswith(prefix)]
+    backend.close()
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_file_backend_packing(test_path, compression):
+    from backy2.config import Config
+    from backy2.data_backends import packed_location
+    from backy2.data_backends.file import DataBackend
+    backend = DataBackend(Config(cfg="""
+[DataBackend]
+path: {}
+simultaneous_writes: 2
+compression: {}
+pack_size: 10000
+""".format(test_path, compression), section='DataBackend'))
+    datas = [os.urandom(4096) for i in range(10)]
+    uids = {}
+    for data in datas:
+        assert backend.save(data, callback=lambda uid, data=data: uids.__setitem__(data, uid)) is None
+    backend.close()  # writes the open segments
+    assert len(uids) == 10
+    segment_keys = set(packed_location(uid)[0] for uid in uids.values())
+    assert len(segment_keys) < 10
+    assert sorted(backend.get_all_blob_uids()) == sorted(segment_keys)
+    for data, uid in uids.items():
+        assert backend.read_raw(uid) == data
+        assert backend.read_raw(uid, 1000, 10) == data[1000:1010]
+        # ranges don't reach into the next blob of the segment
+        assert backend.read_raw(uid, 4000, 1000) == data[4000:]
+        assert backend.read_raw(uid, 4096, 10) == b''
+    # compaction moves blobs to new segments
+    uid_map = backend.compact(list(uids.values())[:3])
+    assert len(set(packed_location(uid)[0] for uid in uid_map.values()) & segment_keys) == 0
+    for uid, new_uid in uid_map.items():
+        assert backend.read_raw(new_uid) == backend.read_raw(uid)
+
+
+def test_block_cache(test_path):
+    from backy2.enterprise.blockcache import BlockCache
+    path = os.path.join(test_path, 'cache')
+    cache = BlockCache(path, memory_size=2000, disk_size=2000)
+    datas = {'uid{}'.format(i): os.urandom(1000) for i in range(5)}
+    assert cache.get('uid0') is None
+    assert not cache.admit('uid0')
+    assert cache.admit('uid0')  # the second miss admits
+    for uid, data in datas.items():
+        cache.put(uid, data)
+    # uid0..2 have been moved to disk and uid0 has been evicted from there
+    assert cache.get('uid0') is None
+    assert cache.get('uid1', 10, 20) == datas['uid1'][10:30]
+    assert cache.get('uid4', 990) == datas['uid4'][990:]
+    status = cache.status()
+    assert (status['memory_blobs'], status['disk_blobs']) == (2, 2)
+    assert (status['hits_memory'], status['hits_disk'], status['misses']) == (1, 1, 2)
+    assert (status['evictions_memory'], status['evictions_disk']) == (3, 1)
+    cache.close()
+    # the disk tier survives, the memory tier has been moved there
+    open(os.path.join(path, 'orphan'), 'wb').write(b'x')
+    cache = BlockCache(path, memory_size=2000, disk_size=2000)
+    assert sorted(os.listdir(path)) == ['index.json', 'uid3', 'uid4']
+    assert cache.get('uid3') == datas['uid3']
+    # empty blobs are read from disk without mmap
+    cache.put('empty', b'')
+    for uid in ('uid5', 'uid6', 'uid7'):
+        cache.put(uid, os.urandom(1000))
+    assert cache.status()['disk_blobs'] == 3
+    assert cache.get('empty') == b''
+    cache.close()
+
+    # concurrent use, disk io happens outside of the lock
+    from concurrent.futures import ThreadPoolExecutor
+    path = os.path.join(test_path, 'cache2')
+    cache = BlockCache(path, memory_size=5000, disk_size=5000)
+    datas = {'uid{}'.format(i): os.urandom(1000) for i in range(50)}
+    def use(uid):
+        cache.put(uid, datas[uid])
+        for other_uid in random.sample(sorted(datas), 10):
+            data = cache.get(other_uid, 10, 100)
+            assert data is None or data == datas[other_uid][10:110]
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(use, sorted(datas) * 4))
+    status = cache.status()
+    assert status['memory_bytes'] <= 5000 and status['disk_bytes'] <= 5000
+    cache.close()
+    assert sorted(os.listdir(path)) == sorted(['index.json'] + [uid for uid, size in cache._disk.items()])
+
+
+def test_nbd_readahead():
+    from backy2.enterprise.nbd import Readahead
+    class Store():
+        backy = collections.namedtuple('Backy', 'block_size')(4096)
+        prefetched = []
+        def prefetch(self, version_uid, block_id):
+            self.prefetched.append(block_id)
+    store = Store()
+    readahead = Readahead(store, 'version', max_blocks=8)
+    readahead.read(40960, 4096)  # random
+    readahead.read(0, 4096)
+    readahead.read(4096, 4096)
+    assert store.prefetched == []
+    readahead.read(8192, 4096)  # sequential, fetch one block ahead
+    assert store.prefetched == [3]
+    readahead.read(12288, 4096)
+    assert store.prefetched == [3, 4]
+    # the client reads 10 blocks while one block is fetched
+    readahead.read_rate, readahead.fetch_time = 40960, 1
+    assert readahead.window() == 8
+    readahead.read(16384, 4096)
+    assert store.prefetched == [3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+    readahead.read(0, 4096)  # random again
+    readahead.read(4096, 4096)
+    assert len(store.prefetched) == 10
+
+
+def test_nbd_extents(test_path):
+    from backy2.enterprise.nbd import BackyStore
+    blocks = [(0, 'uid0', 4096), (1, None, 4096), (2, None, 4096), (3, 'uid3', 4096)]
+    class MetaBackend():
+        def get_version(self, uid):
+            return collections.namedtuple('Version', 'size')(len(blocks))
+        def get_block_window(self, version_uid, first_id, last_id):
+            return [block for block in blocks if first_id <= block[0] < last_id]
+    class DataBackend():
+        def read_raw(self, uid, offset=0, length=None):
+            data = uid.encode('ascii') * 1024
+            return data[offset:] if length is None else data[offset:offset + length]
+    Backy = collections.namedtuple('Backy', 'block_size meta_backend data_backend')
+    store = BackyStore(Backy(4096, MetaBackend(), DataBackend()), test_path)
+    assert store.extents('version', 0, 16384) == [(4096, False), (8192, True), (4096, False)]
+    assert store.extents('version', 5000, 100) == [(100, True)]
+    chunks = store.read_chunks('version', 4000, 8296)
+    assert chunks == [(4000, 96, (b'uid0' * 1024)[4000:]), (4096, 8192, None), (12288, 8, b'uid3uid3')]
+    assert store.read('version', 4000, 8296) == (b'uid0' * 1024)[4000:] + b'\0' * 8192 + b'uid3uid3'
+    store.close()
+
+
+def test_nbd_cow_overlay(test_path):
+    from backy2.enterprise.nbd import BackyStore, CowOverlay
+    import hashlib
+    overlay = CowOverlay(os.path.join(test_path, 'cow'), 4096, hashlib.sha512)
+    overlay.write(1, 100, b'a' * 100)
+    overlay.write(1, 150, b'b' * 100)
+    overlay.write(3, 0, b'c' * 4096)
+    assert overlay.block_ids() == [1, 3]
+    assert overlay.written(1, 0, 4096) == [(100, 250)]
+    assert overlay.written(1, 200, 10) == [(200, 210)]
+    assert overlay.written(2, 0, 4096) == []
+    assert overlay.read(1, 140, 20) == b'a' * 10 + b'b' * 10
+    # reads merge the overlay into the original blocks, block 3 isn't read
+    class DataBackend():
+        def read_raw(self, uid, offset=0, length=None):
+            assert uid == 'uid0'
+            data = b'x' * 4096
+            return data[offset:] if length is None else data[offset:offset + length]
+    Backy = collections.namedtuple('Backy', 'block_size data_backend')
+    store = BackyStore(Backy(4096, DataBackend()), test_path)
+    Block = collections.namedtuple('Block', 'id uid size')
+    assert store._read_block(overlay, Block(1, 'uid0', 4096), 90, 20) == b'x' * 10 + b'a' * 10
+    assert store._read_block(overlay, Block(1, None, 4096), 240, 20) == b'b' * 10 + b'\0' * 10
+    assert store._read_block(overlay, Block(3, 'uid3', 4096), 0, 4096) == b'c' * 4096
+    assert not store._sparse(overlay, Block(1, None, 4096), 0, 4096)
+    assert store._sparse(overlay, Block(1, None, 4096), 0, 100)
+    store.close()
+    overlay.close()
+    assert not os.path.exists(os.path.join(test_path, 'cow'))
+
+
+def test_nbd_cow_lifetime(test_path):
+    from backy2.enterprise.nbd import BackyStore
+    Version = collections.namedtuple('Version', 'uid name size hash_function')
+    class MetaBackend():
+        blocks = {'version': [(0, 'uid0', 4096), (1, 'uid1', 4096)]}
+        def get_version(self, uid):
+            return Version(uid, 'name', 2, 'sha512')
+        def copy_version(self, from_version_uid, version_name, snapshot_name=''):
+            self.blocks['cow'] = list(self.blocks[from_version_uid])
+            return 'cow'
+        def get_block_window(self, version_uid, first_id, last_id):
+            return [block for block in self.blocks[version_uid] if first_id <= block[0] < last_id]
+        def set_block(self, id, version_uid, block_uid, checksum, size, valid, _commit=True):
+            self.blocks[version_uid][id] = (id, block_uid, size)
+        def set_version_valid(self, uid):
+            pass
+        def _commit(self):
+            pass
+        def clone(self):
+            return self
+        def close(self):
+            pass
+    class DataBackend():
+        saved = {}
+        def read_raw(self, uid, offset=0, length=None):
+            data = self.saved.get(uid, uid.encode('ascii') * 1024)
+            return data[offset:] if length is None else data[offset:offset + length]
+        def save(self, data, _sync=False):
+            self.saved['new'] = data
+            return 'new'
+    Backy = collections.namedtuple('Backy', 'block_size meta_backend data_backend checksum_length')
+    store = BackyStore(Backy(4096, MetaBackend(), DataBackend(), None), test_path)
+    store.open_version('version')
+    cow_version_uid = store.get_cow_version(Version('version', 'name', 2, 'sha512'))
+    store.open_version(cow_version_uid)  # the writing connection
+    store.write(cow_version_uid, 4096, b'a' * 10)
+    store.open_version(cow_version_uid)  # another connection reads it
+    store.release_version(cow_version_uid)  # the writer disconnects
+    store.fixate(cow_version_uid)
+    # the overlay is kept for the reader, which still sees the changes
+    overlay_path = os.path.join(test_path, 'backy2-cow-cow')
+    assert os.path.exists(overlay_path)
+    assert store.read(cow_version_uid, 4096, 20) == b'a' * 10 + (b'uid1' * 1024)[10:20]
+    store.release_version(cow_version_uid)
+    assert not os.path.exists(overlay_path)
+    assert cow_version_uid not in store.blocks and cow_version_uid not in store.cow
+    # new connections see the fixated blocks
+    store.open_version(cow_version_uid)
+    assert store.read(cow_version_uid, 4096, 20) == b'a' * 10 + (b'uid1' * 1024)[10:20]
+    store.release_version(cow_version_uid)
+    store.release_version('version')
+    assert store.blocks == {}
+    store.close()
+
+
+def test_nbd_block_map():
+    from backy2.enterprise.nbd import BlockMap
+    class MetaBackend():
+        windows = []
+        def get_block_window(self, version_uid, first_id, last_id):
+            self.windows.append(first_id)
+            # block 5 is missing, block 7 is the last and short
+            return [(id_, None if id_ % 2 else 'uid{}'.format(id_), 100 if id_ == 7 else 4096)
+                for id_ in range(first_id, min(last_id, 8)) if id_ != 5]
+    meta_backend = MetaBackend()
+    block_map = BlockMap(meta_backend, 'version', 8, 4096)
+    block_map.WINDOW, block_map.MAX_WINDOWS = 4, 1
+    assert meta_backend.windows == []  # nothing is loaded before the first access
+    assert block_map[0] == (0, 'uid0', 4096)
+    assert block_map[1] == (1, None, 4096)
+    assert block_map[5] == (5, None, 4096)
+    assert block_map[7] == (7, None, 100)
+    assert block_map[6] == (6, 'uid6', 4096)
+    assert block_map[2] == (2, 'uid2', 4096)
+    assert meta_backend.windows == [0, 4, 0]
+    with pytest.raises(IndexError):
+        block_map[8]
+
+
+def test_s3_backend_listing(test_path):
+    moto_server = pytest.importorskip('moto.server')
+    from backy2.config import Config
+    from backy2.data_backends.s3 import DataBackend
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        checkpoint = os.path.join(test_path, 'list_checkpoint')
+        backend = DataBackend(Config(cfg="""
+[DataBackend]
+aws_access_key_id: key
+aws_secret_access_key: secret
+region_name: us-east-1
+endpoint_url: http://{}:{}
+bucket_name: backy2-listing
+list_shards: 16
+list_workers: 8
+list_checkpoint: {}
+""".format(host, port, checkpoint), section='DataBackend'))
+        backend.client.create_bucket(Bucket='backy2-listing')
+        keys = ['{:02x}{}'.format(i, c) for i in range(0, 256, 8) for c in '0f'] + ['1', '1f', 'A', 'ff', 'g', 'z0']
+        for key in keys:
+            backend.client.put_object(Body=b'', Key=key, Bucket='backy2-listing')
+        assert list(backend.get_all_blob_uids()) == sorted(keys)
+        assert list(backend.get_all_blob_uids('1')) == sorted(k for k in keys if k.startswith('1'))
+
+        # an abandoned listing stops its threads
+        uids = backend.get_all_blob_uids()
+        assert next(uids) == '000'
+        uids.close()
+
+        # the caller sets the checkpoint when it has processed the keys
+        backend.LIST_CHECKPOINT_INTERVAL = 0
+        backend.set_list_checkpoint(None, '7f0')
+        assert list(backend.get_all_blob_uids()) == sorted(k for k in keys if k > '7f0')
+        assert list(backend.get_all_blob_uids('1')) == sorted(k for k in keys if k.startswith('1'))
+        backend.set_list_checkpoint(None, None)
+        assert not os.path.exists(checkpoint)
+        assert list(backend.get_all_blob_uids()) == sorted(keys)
+        backend.close()
+    finally:
+        server.stop()
+
+
+def test_s3async_backend(test_path):
+    pytest.importorskip('aiobotocore')
+    moto_server = pytest.importorskip('moto.server')
+    from backy2.config import Config
+    from backy2.data_backends.s3async import DataBackend
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        backend = DataBackend(Config(cfg="""
+[DataBackend]
+aws_access_key_id: key
+aws_secret_access_key: secret
+region_name: us-east-1
+endpoint_url: http://{}:{}
+bucket_name: backy2
+simultaneous_writes: 50
+simultaneous_reads: 50
+compression: zlib
+""".format(host, port), section='DataBackend'))
+        backend._run(backend.client.create_bucket(Bucket='backy2'))
+
+        datas = [os.urandom(1000) + b'\0' * i for i in range(200)]
+        uids = [backend.save(data) for data in datas]
+        backend.save(b'', _sync=True)  # waits for all writes
+        assert backend.last_exception is None
+        assert len(list(backend.get_all_blob_uids())) == 201
+
+        Block = collections.namedtuple('Block', 'id uid')
+        for i, uid in enumerate(uids):
+            backend.read(Block(i, uid))
+        for i in range(len(uids)):
+            block, offset, length, data = backend.read_get()
+            assert data == datas[block.id]
+        assert backend.read_raw(uids[0]) == datas[0]
+
+        assert backend.rm_many(uids[:150]) == []
+        backend.rm(uids[150])
+        with pytest.raises(FileNotFoundError):
+            backend.rm(uids[150])
+        assert len(list(backend.get_all_blob_uids())) == 50
+        backend.close()
+    finally:
+        server.stop()
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+from array import array
+from bisect import bisect_left, bisect_right
 from functools import partial
 from time import time
 from threading import Lock
 import itertools
-import hashlib
 import importlib
 import json
 import random
+import resource
 from datetime import timedelta, datetime
 
 
@@ -62,6 +64,11 @@ def humanize(num, suffix='B'):
     return "%.0f %s%s" % (num, 'Yi', suffix)
 
 
+def peak_rss():
+    """ Returns the peak resident set size of this process in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kB on linux
+
+
 def parse_expire_date(date_string):
     try:
         date = datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
@@ -88,10 +95,15 @@ def backy_from_config(Config):
     """
     config_DEFAULTS = Config(section='DEFAULTS')
     block_size = config_DEFAULTS.getint('block_size')
-    hash_function = getattr(hashlib, config_DEFAULTS.get('hash_function', 'sha512'))
+    hash_function = config_DEFAULTS.get('hash_function', 'sha512')
     lock_dir = config_DEFAULTS.get('lock_dir', None)
     process_name = config_DEFAULTS.get('process_name', 'backy2')
     dedup = config_DEFAULTS.getboolean('deduplication', True)
+    dedup_index = config_DEFAULTS.getboolean('deduplication_index', False)
+    dedup_index_entries = config_DEFAULTS.getint('deduplication_index_entries', 0)
+    checksum_length = config_DEFAULTS.getint('checksum_length', 0)
+    hash_workers = config_DEFAULTS.getint('hash_workers', 0)
+    pipeline_window = config_DEFAULTS.getint('pipeline_window', 1000)
 
     # configure meta backend
     config_MetaBackend = Config(section='MetaBackend')
@@ -121,6 +133,11 @@ def backy_from_config(Config):
             lock_dir=lock_dir,
             process_name=process_name,
             dedup=dedup,
+            dedup_index=dedup_index,
+            dedup_index_entries=dedup_index_entries,
+            checksum_length=checksum_length,
+            hash_workers=hash_workers,
+            pipeline_window=pipeline_window,
             )
     return backy
 
@@ -134,6 +151,152 @@ def grouper(n, iterable):
        yield chunk
 
 
+def _ascending(iterable, name):
+    last = None
+    for item in iterable:
+        if last is not None and item < last:
+            raise ValueError('{} is not sorted: {} follows {}.'.format(name, item, last))
+        last = item
+        yield item
+
+
+def sorted_difference(a, b):
+    """ Yields the items of the ascending iterable a which aren't in the
+    ascending iterable b, reading both only once. Raises ValueError as soon
+    as either isn't sorted.
+    """
+    b = _ascending(b, 'b')
+    current = next(b, None)
+    for item in _ascending(a, 'a'):
+        while current is not None and current < item:
+            current = next(b, None)
+        if current != item:
+            yield item
+
+
+class RangeSet():
+    """ A set of integers (block ids) stored as sorted, non-overlapping
+    ranges [start, end) in two arrays. Memory is O(ranges) instead of
+    O(integers), i.e. a full 100TB volume is a single range.
+    Membership tests are O(log(ranges)).
+    """
+
+    def __init__(self, ranges=()):
+        self._starts = array('q')
+        self._ends = array('q')
+        for start, end in ranges:
+            self.add(start, end)
+
+
+    @classmethod
+    def from_ids(cls, ids):
+        """ Builds a RangeSet from an iterable of integers. Sorted input
+        (e.g. from the database) is merged without any searching.
+        """
+        range_set = cls()
+        start = end = None
+        for id_ in ids:
+            if id_ == end:
+                end += 1
+                continue
+            if start is not None:
+                range_set.add(start, end)
+            start, end = id_, id_ + 1
+        if start is not None:
+            range_set.add(start, end)
+        return range_set
+
+
+    def add(self, start, end=None):
+        """ Adds the range [start, end) or the single integer start. """
+        if end is None:
+            end = start + 1
+        if start >= end:
+            return
+        starts, ends = self._starts, self._ends
+        if not ends or start > ends[-1]:
+            # common case: ranges are added in ascending order
+            starts.append(start)
+            ends.append(end)
+            return
+        # merge with all overlapping or adjacent ranges
+        i = bisect_left(ends, start)
+        j = bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j-1])
+        starts[i:j] = array('q', (start,))
+        ends[i:j] = array('q', (end,))
+
+
+    def ranges(self):
+        """ Yields (start, end) tuples in ascending order. """
+        return zip(self._starts, self._ends)
+
+
+    def sample(self, k):
+        """ Returns up to k distinct random integers from this set. """
+        indices = sorted(random.sample(range(len(self)), min(k, len(self))))
+        result = []
+        offset = 0  # number of integers in the ranges before start
+        ranges = self.ranges()
+        start = end = 0
+        for index in indices:
+            while index >= offset + end - start:
+                offset += end - start
+                start, end = next(ranges)
+            result.append(start + index - offset)
+        return result
+
+
+    def __sub__(self, other):
+        result = RangeSet()
+        other_starts, other_ends = other._starts, other._ends
+        j = 0
+        for start, end in self.ranges():
+            while j < len(other_ends) and other_ends[j] <= start:
+                j += 1
+            k = j
+            while k < len(other_starts) and other_starts[k] < end:
+                if other_starts[k] > start:
+                    result._starts.append(start)
+                    result._ends.append(other_starts[k])
+                start = max(start, other_ends[k])
+                k += 1
+            if start < end:
+                result._starts.append(start)
+                result._ends.append(end)
+        return result
+
+
+    def __contains__(self, value):
+        i = bisect_right(self._starts, value) - 1
+        return i >= 0 and value < self._ends[i]
+
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            yield from range(start, end)
+
+
+    def __len__(self):
+        return sum(end - start for start, end in self.ranges())
+
+
+    def __bool__(self):
+        return len(self._starts) > 0
+
+
+    def __eq__(self, other):
+        if not isinstance(other, RangeSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+
+    def __repr__(self):
+        return 'RangeSet({!r})'.format(list(self.ranges()))
+
+
 # token_bucket.py
 class TokenBucket:
     """